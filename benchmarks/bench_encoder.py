@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# bench_encoder.py
+#
+"""Measure how many withrottle commands per second can be queued, by command"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from withrottle import withrottle
+
+log = logging.getLogger("withrottle-logger")
+
+# Commands as they were built before the byte encoder: a str formatted with
+# %, a newline added, logged with eager formatting, then encoded
+class LegacyEncoder:
+
+    def __init__(self):
+        self.outgoing = bytearray()
+
+    def write(self, message):
+        message = message + '\n'
+        log.debug("Sending %s" % (message))
+        self.outgoing += message.encode()
+
+    def set_speed(self, id, speed, key='T'):
+        if (speed > withrottle.MAX_SPEED):
+            speed = withrottle.MAX_SPEED
+        message = "M%sA%s<;>V%d" % (key, id, speed)
+        self.write(message)
+
+    def set_forward(self, id, key='T'):
+        message = "M%sA%s<;>R1" % (key, id)
+        self.write(message)
+
+    def send_function(self, id, fn, is_pressed, key='T'):
+        if (is_pressed):
+            x = 0
+        else:
+            x = 1
+        message = "M%sA%s<;>F%d%s" % (key, id, x, fn)
+        self.write(message)
+
+# withrottle with nowhere to send to - commands stay in the buffer
+def encoder():
+    t = withrottle("localhost", 0, connect=False)
+    t.on_pending = lambda: None
+    for i in range(8):
+        t.add_loco("S%d" % (11 + i))
+    del t.outgoing[:]
+    return t
+
+IDS = ["S%d" % (11 + i) for i in range(8)]
+
+# Each path sends count commands spread over eight locos, emptying the buffer
+# every 1000 as flush() would
+def speeds(e, count):
+    ids = IDS
+    for i in range(count):
+        e.set_speed(ids[i & 7], i % 127)
+        if i % 1000 == 999:
+            del e.outgoing[:]
+
+def directions(e, count):
+    ids = IDS
+    for i in range(count):
+        e.set_forward(ids[i & 7])
+        if i % 1000 == 999:
+            del e.outgoing[:]
+
+def functions(e, count):
+    ids = IDS
+    for i in range(count):
+        e.send_function(ids[i & 7], i % 10, i & 8)
+        if i % 1000 == 999:
+            del e.outgoing[:]
+
+def measure(name, path, make, count, repeat):
+    best = None
+    for _ in range(repeat):
+        e = make()
+        start = time.perf_counter()
+        path(e, count)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print("%-20s %10.0f commands/sec" % (name, count / best))
+
+# Both encoders must put the same bytes on the wire
+def check():
+    (old, new) = (LegacyEncoder(), encoder())
+    for e in (old, new):
+        e.set_speed("S11", 5)
+        e.set_speed("S12", 200)
+        e.set_forward("S13")
+        e.send_function("S14", 3, True)
+        e.send_function("S14", 3, False)
+    assert bytes(old.outgoing) == bytes(new.outgoing), (old.outgoing, new.outgoing)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", help="Number of commands per run. Default: 500000", type=int, default=500000)
+    parser.add_argument("--repeat", help="Number of runs, best is reported. Default: 5", type=int, default=5)
+    parser.add_argument("--debug", help="Run with debug logging enabled (to nowhere)", action="store_true")
+    args = parser.parse_args()
+
+    log.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+    if args.debug:
+        log.addHandler(logging.NullHandler())
+        log.propagate = False
+    check()
+
+    for (name, path) in (("speed", speeds), ("direction", directions), ("function", functions)):
+        measure("legacy " + name, path, LegacyEncoder, args.commands, args.repeat)
+        measure("bytes " + name, path, encoder, args.commands, args.repeat)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# bench_handler.py
+#
+"""Measure how many MIDI events per second midiControl.handler can take"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import midiControl
+import profiles
+
+# Button as it was before the lookup table: created for every event
+class LegacyButton:
+
+    def __init__(self, control_number):
+        self.__set_control_number(control_number)
+
+    def __get_control_number(self):
+        return self.__control_number
+
+    def __get_channel(self):
+        return self.__channel
+
+    def __get_button(self):
+        return self.__button
+
+    def __set_control_number(self, control_number):
+        self.__control_number = control_number
+        self.__channel = control_number % 0x10
+        self.__button = control_number // 0x10
+
+    control_number = property(__get_control_number, __set_control_number)
+    channel = property(__get_channel)
+    button = property(__get_button)
+
+    def __eq__(self, other):
+        if not isinstance(other, LegacyButton):
+            return NotImplemented
+        return self.control_number == other.control_number
+
+_legacy_pressed = [False] * 0xFF
+_legacy_stop = LegacyButton(0x2A)
+
+# The handler as it was before the lookup table
+def legacy_handler(msg, callbacks):
+    button_callback, slider_callback = callbacks
+    message, delta = msg
+    try:
+        status_byte = message[0]
+    except IndexError:
+        return
+    if (status_byte >= 0xB0 and status_byte <= 0xBF):
+        try:
+            control_number = message[1]
+            value = message[2]
+        except IndexError:
+            return
+        if (control_number <= 0xF):
+            midiControl.log.debug("Slider %d value %d" % (control_number, value))
+            slider_callback(control_number, value)
+        if (control_number >= 0x20 and control_number <= 0x50):
+            _legacy_pressed[control_number] = value > 0
+            midiControl.log.debug("Calling button callback function")
+            button_callback(LegacyButton(control_number), value > 0)
+
+# The handler as it was before profiles: control changes only, looked up by
+# control number in a table fixed for the nanoKONTROL2
+def hardcoded_handler(msg, surface):
+    message = msg[0]
+    if len(message) != 3 or (message[0] & 0xF0) != 0xB0:
+        return
+    action = surface.dispatch[message[1]]
+    if action:
+        action(message[1], message[2])
+
+class HardcodedSurface:
+
+    def __init__(self, surface):
+        dispatch = [None] * 128
+        for control_number in range(0x10):
+            dispatch[control_number] = surface.trigger_slider
+        for control_number in range(0x20, 0x51):
+            dispatch[control_number] = surface.trigger_button
+        self.dispatch = dispatch
+
+# Eight faders sweeping, with a button press every so often
+def event_stream(count):
+    events = []
+    for i in range(count):
+        if i % 16 == 15:
+            events.append(([0xB0, 0x30 + (i % 8), 127 * ((i // 16) % 2)], 0.0))
+        else:
+            events.append(([0xB0, i % 8, i % 128], 0.001))
+    return events
+
+# The same on an X-Touch Mini: knobs on channel 11, buttons as notes
+def xtouch_stream(count):
+    events = []
+    for i in range(count):
+        if i % 16 == 15:
+            events.append(([0x9A if (i // 16) % 2 else 0x8A, 8 + (i % 8), 127], 0.0))
+        else:
+            events.append(([0xBA, 1 + (i % 8), i % 128], 0.001))
+    return events
+
+# Eight 14-bit NRPN faders sweeping - four messages for each move
+def nrpn_stream(count):
+    events = []
+    for i in range(count // 4):
+        value = (i * 37) % 0x4000
+        events.append(([0xB0, 99, 0], 0.001))
+        events.append(([0xB0, 98, i % 8], 0.0))
+        events.append(([0xB0, 6, value >> 7], 0.0))
+        events.append(([0xB0, 38, value & 0x7F], 0.0))
+    return events
+
+NRPN_PROFILE = {'name': "NRPN faders", 'controls': [{'nrpn': channel, 'slider': channel} for channel in range(8)]}
+
+def slider_callback(channel, value):
+    pass
+
+# Callbacks compare the button against a constant, as throttle.py does
+def legacy_button_callback(b, is_on):
+    return b == _legacy_stop
+
+def button_callback(b, is_on):
+    return b == midiControl.STOP_BUTTON
+
+def measure(name, handler, data, events, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for event in events:
+            handler(event, data)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print("%-8s %10.0f events/sec" % (name, len(events) / best))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", help="Number of MIDI events. Default: 200000", type=int, default=200000)
+    parser.add_argument("--repeat", help="Number of runs, best is reported. Default: 5", type=int, default=5)
+    args = parser.parse_args()
+
+    events = event_stream(args.events)
+    surface = midiControl.ControlSurface(None, None, button_callback, slider_callback)
+
+    measure("legacy", legacy_handler, (legacy_button_callback, slider_callback), events, args.repeat)
+    measure("table", hardcoded_handler, HardcodedSurface(surface), events, args.repeat)
+    measure("profile", midiControl.handler, surface, events, args.repeat)
+
+    xtouch = midiControl.ControlSurface(None, None, button_callback, slider_callback, profiles.load('xtouch-mini'))
+    measure("x-touch", midiControl.handler, xtouch, xtouch_stream(args.events), args.repeat)
+    nrpn = midiControl.ControlSurface(None, None, button_callback, slider_callback, profiles.parse(NRPN_PROFILE))
+    measure("nrpn", midiControl.handler, nrpn, nrpn_stream(args.events), args.repeat)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# bench_journal.py
+#
+"""Measure what keeping a journal costs, and how fast a big journal can be searched"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import journal
+import midiControl
+import midirecord
+from bench_encoder import encoder, IDS
+
+# Best time of repeat runs of path()
+def best(path, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        path()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def compare(name, count, plain, journaled, repeat):
+    (a, b) = (best(plain, repeat), best(journaled, repeat))
+    print("%-10s %10.0f/sec without journal, %10.0f/sec with (%.2f us more each)" % (
+        name, count / a, count / b, (b - a) / count * 1e6))
+
+# MIDI events through the handler, and the handler behind the journal
+def bench_handler(j, count, repeat):
+    surface = midirecord.virtual_start(0, None, None)
+    messages = [([0xB0, i & 7, i & 0x7F], 0) for i in range(count)]
+    def run(handler):
+        def path():
+            for message in messages:
+                handler(message, surface)
+        return path
+    compare("midi", count, run(midiControl.handler), run(journal.midi_handler(j, 0, midiControl.handler)), repeat)
+    midiControl.cleanup()
+
+# Speed commands queued
+def bench_sent(j, count, repeat):
+    def run(journaled):
+        def path():
+            e = encoder()
+            e.journal = j if journaled else None
+            ids = IDS
+            for i in range(count):
+                e.set_speed(ids[i & 7], i % 127)
+                if i % 1000 == 999:
+                    del e.outgoing[:]
+        return path
+    compare("sent", count, run(False), run(True), repeat)
+
+# Server lines split and parsed
+def bench_received(j, count, repeat):
+    data = b"".join(b"MTAS%d<;>V%d\n" % (11 + (i & 7), i % 127) for i in range(1000))
+    def run(journaled):
+        def path():
+            e = encoder()
+            e.partial = b""
+            e.journal = j if journaled else None
+            for _ in range(count // 1000):
+                e.feed(data)
+        return path
+    compare("received", count, run(False), run(True), repeat)
+
+# Fill a journal, then time finding one loco in all of it, and the last second of it
+def bench_reader(size):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bench.journal")
+        j = journal.Journal(filename, size)
+        # Fill it twice over, at 10000 records a second
+        j.offset = time.time() - time.monotonic() - 2 * j.capacity / 10000.0
+        start = time.perf_counter()
+        for i in range(2 * j.capacity):
+            j.record(journal.SENT, 0, b"MTAS%d<;>V%d\n" % (i % 100, i % 127))
+            j.offset += 0.0001
+        elapsed = time.perf_counter() - start
+        j.close()
+        print("journal of %d MB: %d records written in %.2f s" % (size, 2 * j.capacity, elapsed))
+
+        start = time.perf_counter()
+        reader = journal.Reader(filename)
+        patterns = journal.loco_patterns(["S42"])
+        found = sum(1 for record in reader.records() if journal.about(record[3], patterns))
+        print("  one loco:    %d of %d records in %.2f s" % (found, reader.last - reader.first, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        last = reader.time(reader.last - 1)
+        found = sum(1 for record in reader.records(last - 1))
+        print("  last second: %d records in %.4f s" % (found, time.perf_counter() - start))
+        reader.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", help="Events per run. Default: 200000", type=int, default=200000)
+    parser.add_argument("--repeat", help="Number of runs, best is reported. Default: 5", type=int, default=5)
+    parser.add_argument("--size", help="Size in MB of the journal to search. Default: 64", type=int, default=64)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        j = journal.Journal(os.path.join(directory, "bench.journal"), 4)
+        bench_handler(j, args.events, args.repeat)
+        bench_sent(j, args.events, args.repeat)
+        bench_received(j, args.events, args.repeat)
+        j.close()
+    bench_reader(args.size)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# bench_parser.py
+#
+"""Measure withrottle input parsing speed by replaying a JMRI session"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from withrottle import withrottle
+
+# Build a session that looks like a busy evening on a club layout
+def synthetic_session(lines):
+    header = [
+        "VN2.0",
+        "RL3]\\[Class 66 Freight}|{66}|{L]\\[Shunter}|{11}|{S]\\[Pacific}|{4472}|{L",
+        "PPA1",
+        "PTL]\\[LT1}|{Station North}|{2]\\[LT2}|{Station South}|{4",
+        "PW12080",
+        "*10",
+    ]
+    traffic = []
+    for i in range(8):
+        id = "S%d" % (11 + i)
+        traffic += [
+            "MT+%s<;>" % id,
+            "MTA%s<;>F00" % id,
+            "MTA%s<;>F11" % id,
+            "MTA%s<;>V%d" % (id, i * 15),
+            "MTA%s<;>R%d" % (id, i % 2),
+            "MTA%s<;>s1" % id,
+            "PTA%dLT%d" % (2 + (i % 2) * 2, i % 2 + 1),
+            "MT-%s<;>" % id,
+        ]
+    session = list(header)
+    while len(session) < lines:
+        session.extend(traffic)
+    return ("\n".join(session[:lines]) + "\n").encode()
+
+# The regular expression parser used before the line framer
+def legacy_parse(message):
+    lines = message.split('\n')
+    r = []
+    for line in lines:
+        m = re.match("MT\\+(.*?)\\<;\\>", line)
+        if m:
+            r.append((withrottle.ADDED, m.group(1)))
+        m = re.match("MT\\-(.*?)\\<;\\>", line)
+        if m:
+            r.append((withrottle.REMOVED, m.group(1)))
+        m = re.match("MTA(.*?)\\<;\\>R0", line)
+        if m:
+            r.append((withrottle.REVERSE, m.group(1)))
+        m = re.match("MTA(.*?)\\<;\\>R1", line)
+        if m:
+            r.append((withrottle.FORWARD, m.group(1)))
+        m = re.match("PW(.*)", line)
+        if m:
+            r.append((withrottle.CONNECTED, m.group(1)))
+        m = re.match("PPA0", line)
+        if m:
+            r.append((withrottle.POWER_OFF, 1))
+        m = re.match("PPA1", line)
+        if m:
+            r.append((withrottle.POWER_ON, 0))
+        m = re.match("\\*(\\d*)", line)
+        if m:
+            r.append((withrottle.HEARTBEAT, m.group(1)))
+    return r
+
+# Cut the session into socket-sized reads, so lines straddle chunk boundaries
+def chunks(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+def bench_legacy(reads):
+    for data in reads:
+        legacy_parse(data.decode(errors='replace'))
+
+def bench_framer(reads):
+    # Parser state only, no socket needed
+    t = withrottle.__new__(withrottle)
+    t.partial = b''
+    t.journal = None
+    for data in reads:
+        t.feed(data)
+
+def measure(name, fn, reads, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(reads)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print("%-8s %10.0f lines/sec" % (name, lines / best))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", nargs="?", help="Captured withrottle session to replay. Default: synthetic session")
+    parser.add_argument("--lines", help="Lines in synthetic session. Default: 200000", type=int, default=200000)
+    parser.add_argument("--chunk", help="Bytes per simulated socket read. Default: 1400", type=int, default=1400)
+    parser.add_argument("--repeat", help="Number of runs, best is reported. Default: 5", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_session(args.lines)
+
+    lines = data.count(b'\n')
+    reads = chunks(data, args.chunk)
+    print("%d lines in %d reads of %d bytes" % (lines, len(reads), args.chunk))
+
+    measure("legacy", bench_legacy, reads, lines, args.repeat)
+    measure("framer", bench_framer, reads, lines, args.repeat)
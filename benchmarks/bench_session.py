@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# bench_session.py
+#
+"""Run scripted sessions against the stand-in server and report throughput, latency and traffic"""
+
+import argparse
+import asyncio
+import bisect
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import config
+import midiControl
+import midirecord
+import throttle
+from fakeserver import FakeServer
+from withrottle import withrottle
+
+ADDRESSES = ["S%d" % (i + 1) for i in range(8)]
+
+# Value below which the given percentage of samples fall
+def percentile(samples, percent):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+def report_latency(name, samples):
+    print("  %-22s n=%-6d p50 %7.2f ms  p90 %7.2f ms  p99 %7.2f ms  max %7.2f ms" % (
+        name, len(samples), percentile(samples, 50) * 1000, percentile(samples, 90) * 1000,
+        percentile(samples, 99) * 1000, max(samples or [0]) * 1000))
+
+# Let everything already handed to the event loop by on_loop() run
+async def drain(loop):
+    done = loop.create_future()
+    loop.call_soon_threadsafe(done.set_result, None)
+    await done
+
+# A throttle.py instance on a virtual surface, connected to a stand-in server
+class Session:
+
+    def __init__(self, args, status_port=None, fader_filter=None, start=midirecord.virtual_start, workers=False):
+        self.args = args
+        self.start = start
+        self.workers = workers
+        self.status_port = status_port
+        self.fader_filter = fader_filter
+        self.server = FakeServer(args.latency, args.split)
+        self.controller = throttle.Controller(throttle.THROTTLE_KEYS[0], None, config.SurfaceConfig(list(ADDRESSES), [{} for a in ADDRESSES]))
+        self.task = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        port = await self.server.start()
+        self.task = loop.create_task(throttle.run([(0, self.controller)], "127.0.0.1", port,
+            self.args.update_interval, True, start=self.start, status_port=self.status_port,
+            fader_filter=self.fader_filter, workers=self.workers))
+
+        # Wait for start up, then take control of all eight locos
+        while throttle.throttle is None or self.controller.scheduler is None or not self.server.lines("*"):
+            await asyncio.sleep(0.01)
+        await midirecord.replay(midirecord.acquire(len(ADDRESSES)), self.controller.surface, None)
+        while None in self.controller.train:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        self.server.clear()
+        self.bytes_sent = throttle.throttle.bytes_sent
+        self.send_calls = throttle.throttle.send_calls
+        return self
+
+    async def __aexit__(self, *exc):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.server.stop()
+        throttle.throttle = None
+        midiControl.cleanup()
+
+    # Replay events, calling note(message) as each one goes in
+    async def play(self, events, speed, note=None):
+        surface = self.controller.surface
+        def handler(msg, surface):
+            if note:
+                note(msg[0])
+            midiControl.handler(msg, surface)
+        await midirecord.replay(events, surface, speed, handler)
+
+    def traffic(self):
+        print("  %d lines, %d bytes received by server in %d send calls" % (
+            len(self.server.received), self.server.bytes_received, throttle.throttle.send_calls - self.send_calls))
+        surface = self.controller.surface
+        print("  %d LED messages sent to surface, %d unchanged LEDs skipped" % (surface.led_messages, surface.led_skipped))
+
+# How many events per second go through the handler to the controller
+async def bench_throughput(args):
+    events = midirecord.fader_sweep(8, args.sweeps)
+    async with Session(args) as session:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        await session.play(events, None)
+        await drain(loop)
+        elapsed = time.perf_counter() - start
+        print("throughput: %d fader events" % len(events))
+        print("  %.0f events/sec through handler and slider_callback" % (len(events) / elapsed))
+        await asyncio.sleep(args.update_interval * 2)
+        session.traffic()
+
+# Latency of each speed line the server received, from the latest time its
+# fader was at that value. injected is when each (channel, value) went in,
+# as faders pass through values more than once.
+def fader_latencies(received, injected):
+    latencies = []
+    for (t, line) in received:
+        if "<;>V" not in line:
+            continue
+        (command, value) = line.split("<;>V")
+        channel = ADDRESSES.index(command[3:])
+        value = int(value)
+        times = injected.get((channel, value), [])
+        if value == withrottle.MAX_SPEED:
+            times = sorted(times + injected.get((channel, value + 1), []))
+        i = bisect.bisect_right(times, t)
+        if i:
+            latencies.append(t - times[i - 1])
+    return latencies
+
+# Eight faders sweeping in real time: latency from fader to server, and traffic
+async def bench_sweep(args):
+    events = midirecord.fader_sweep(8, args.sweeps)
+    injected = {}
+    def note(message):
+        if message[1] < 8:
+            injected.setdefault((message[1], message[2]), []).append(time.perf_counter())
+
+    async with Session(args) as session:
+        await session.play(events, 1.0, note)
+        await asyncio.sleep(args.update_interval * 2)
+        latencies = fader_latencies(session.server.received, injected)
+
+        print("sweep: %d fader events over %.1f seconds" % (len(events), events[-1][0]))
+        report_latency("fader to server", latencies)
+        session.traffic()
+
+# Stop pressed over and over: time from press to every loco's stop reaching the server
+async def bench_stop_storm(args):
+    events = midirecord.stop_storm(args.stops)
+    pressed = []
+    def note(message):
+        if message[1] == midiControl.STOP_BUTTON.control_number and message[2]:
+            pressed.append(time.perf_counter())
+
+    async with Session(args) as session:
+        await session.play(events, 1.0, note)
+        await asyncio.sleep(0.2)
+
+        stops = [t for (t, line) in session.server.received if line.endswith("<;>X")]
+        # One '*' stop per press if the server takes wildcards, otherwise one per loco
+        per_press = len(stops) // len(pressed) if pressed else 0
+        latencies = []
+        for (i, t) in enumerate(pressed):
+            batch = stops[i * per_press:(i + 1) * per_press]
+            if batch:
+                latencies.append(batch[-1] - t)
+
+        print("stop storm: %d presses of Stop with no loco selected, %d stop lines each" % (len(pressed), per_press))
+        report_latency("stop to wire (all)", latencies)
+        session.traffic()
+
+# Stop pressed while all eight faders sweep: stop-to-wire latency under load,
+# and speeds dropped because a stop overtook them
+async def bench_estop(args):
+    events = sorted(midirecord.fader_sweep(8, args.sweeps) + midirecord.stop_storm(args.stops, 0.1))
+    pressed = []
+    def note(message):
+        if message[1] == midiControl.STOP_BUTTON.control_number and message[2]:
+            pressed.append(time.perf_counter())
+
+    async with Session(args) as session:
+        cancelled = throttle.throttle.cancelled
+        await session.play(events, 1.0, note)
+        await asyncio.sleep(0.2)
+
+        stops = [t for (t, line) in session.server.received if line.endswith("<;>X")]
+        latencies = []
+        for t in pressed:
+            # First stop to reach the server after the press
+            i = bisect.bisect_left(stops, t)
+            if i < len(stops):
+                latencies.append(stops[i] - t)
+
+        print("estop: %d presses of Stop while eight faders sweep" % len(pressed))
+        report_latency("stop to wire", latencies)
+        print("  %d waiting speeds cancelled by stops" % (throttle.throttle.cancelled - cancelled))
+        session.traffic()
+
+# Faders flickering between two values: server traffic with and without the fader filter
+async def bench_jitter(args):
+    events = midirecord.fader_jitter(8, args.jitter_seconds)
+    for fader_filter in (None, {'deadband': args.deadband}):
+        async with Session(args, fader_filter=fader_filter) as session:
+            await session.play(events, 1.0)
+            await asyncio.sleep(args.update_interval * 2)
+            speeds = len([line for line in session.server.lines("MTA") if "<;>V" in line])
+            if fader_filter:
+                f = session.controller.surface.slider_filter
+                print("jitter: deadband %d, %d of %d fader events suppressed" % (args.deadband, f.suppressed, f.events))
+            else:
+                print("jitter: no filter, %d fader events" % len(events))
+            print("  %d speed messages sent to server" % speeds)
+            session.traffic()
+
+BENCHMARKS = {
+    'throughput': bench_throughput,
+    'sweep': bench_sweep,
+    'stop': bench_stop_storm,
+    'estop': bench_estop,
+    'jitter': bench_jitter,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run (%s). Default: all" % ", ".join(BENCHMARKS))
+    parser.add_argument("--update-interval", help="Update interval passed to throttle. Default: %s" % throttle.UPDATE_INTERVAL, type=float, default=throttle.UPDATE_INTERVAL)
+    parser.add_argument("--latency", help="Server reply delay in seconds. Default: 0", type=float, default=0)
+    parser.add_argument("--split", help="Server writes replies this many bytes at a time", type=int)
+    parser.add_argument("--sweeps", help="Number of fader sweeps. Default: 2", type=int, default=2)
+    parser.add_argument("--jitter-seconds", help="How long faders flicker for. Default: 2", type=float, default=2)
+    parser.add_argument("--deadband", help="Deadband for the jitter benchmark. Default: 1", type=int, default=1)
+    parser.add_argument("--stops", help="Number of stop presses. Default: 50", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    async def main():
+        for name in args.benchmarks or BENCHMARKS:
+            await BENCHMARKS[name](args)
+
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# bench_status.py
+#
+"""Many WebSocket clients watching the status API while faders sweep: what they cost the control path"""
+
+import argparse
+import asyncio
+import base64
+import bisect
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import midirecord
+import statusapi
+import throttle
+from bench_session import ADDRESSES, Session, report_latency
+from withrottle import withrottle
+
+# A dashboard: connects to /ws and counts what it is sent
+class WatchClient:
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+    async def connect(self, port):
+        (self.reader, self.writer) = await asyncio.open_connection("127.0.0.1", port)
+        key = base64.b64encode(os.urandom(16))
+        self.writer.write(b"GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          b"Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n" % key)
+        await self.reader.readuntil(b"\r\n\r\n")
+        self.task = asyncio.get_running_loop().create_task(self.watch())
+
+    async def watch(self):
+        try:
+            while True:
+                (opcode, payload) = await statusapi.read_frame(self.reader)
+                self.frames += 1
+                self.bytes += len(payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    # Send a command, as a client would (masked)
+    def send(self, message):
+        payload = json.dumps(message).encode()
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for (i, b) in enumerate(payload))
+        self.writer.write(bytes([0x81, 0x80 | len(payload)]) + mask + masked)
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+# Fader to server latency while faders sweep, with n clients watching
+async def bench_clients(args, n):
+    events = midirecord.fader_sweep(8, args.sweeps)
+    injected = {}
+    def note(message):
+        if message[1] < 8:
+            injected.setdefault((message[1], message[2]), []).append(time.perf_counter())
+
+    async with Session(args, 0) as session:
+        server = throttle.status_server
+        port = server.server.sockets[0].getsockname()[1]
+        clients = [WatchClient() for i in range(n)]
+        for client in clients:
+            await client.connect(port)
+        await asyncio.sleep(0.2)
+        (publishes, publish_time) = (server.publishes, server.publish_time)
+
+        await session.play(events, 1.0, note)
+        await asyncio.sleep(args.update_interval * 2)
+
+        latencies = []
+        for (t, line) in session.server.received:
+            if "<;>V" not in line:
+                continue
+            (command, value) = line.split("<;>V")
+            channel = ADDRESSES.index(command[3:])
+            value = int(value)
+            times = injected.get((channel, value), [])
+            if value == withrottle.MAX_SPEED:
+                times = sorted(times + injected.get((channel, value + 1), []))
+            i = bisect.bisect_right(times, t)
+            if i:
+                latencies.append(t - times[i - 1])
+
+        # Stop all from one of the clients, timed to the last stop reaching the server
+        stop_time = None
+        if clients:
+            session.server.clear()
+            start = time.perf_counter()
+            clients[0].send({'command': 'stop_all'})
+            while len(session.server.lines("MTA")) < len(ADDRESSES) and time.perf_counter() - start < 1:
+                await asyncio.sleep(0.001)
+            stops = [t for (t, line) in session.server.received if line.endswith("<;>X")]
+            if stops:
+                stop_time = stops[-1] - start
+
+        ticks = server.publishes - publishes
+        print("%d clients: %d fader events over %.1f seconds" % (n, len(events), events[-1][0]))
+        report_latency("fader to server", latencies)
+        if ticks:
+            print("  %d updates, %.3f ms each to gather, diff and write to all clients" % (ticks, (server.publish_time - publish_time) / ticks * 1000))
+        if clients:
+            print("  %d frames, %d bytes sent; each client got %d frames, %d bytes" % (
+                server.frames_sent, server.bytes_sent, clients[-1].frames, clients[-1].bytes))
+        if stop_time is not None:
+            print("  stop all from a client to last stop at server: %.2f ms" % (stop_time * 1000))
+        for client in clients:
+            client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", help="Number of WebSocket clients. Default: 200", type=int, default=200)
+    parser.add_argument("--update-interval", help="Update interval passed to throttle. Default: %s" % throttle.UPDATE_INTERVAL, type=float, default=throttle.UPDATE_INTERVAL)
+    parser.add_argument("--sweeps", help="Number of fader sweeps. Default: 4", type=int, default=4)
+    args = parser.parse_args()
+    args.latency = 0
+    args.split = None
+
+    logging.basicConfig(level=logging.ERROR)
+
+    async def main():
+        for n in (0, args.clients):
+            await bench_clients(args, n)
+
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# bench_workers.py
+#
+"""Compare handling MIDI in the throttle process with handling it in worker processes"""
+
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import midiControl
+import midirecord
+import midiworker
+import throttle
+from bench_session import Session, fader_latencies, report_latency
+
+# Feed events to the surface's handler from the current thread, as rtmidi
+# does, in real time (scaled by speed) or as fast as possible if speed is
+# None. Returns (channel, value, time) for each fader event.
+def inject(events, surface, speed):
+    injected = []
+    start = time.perf_counter()
+    for (t, message) in events:
+        if speed:
+            delay = start + t / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        now = time.perf_counter()
+        midiControl.handler((message, 0), surface)
+        if message[1] < 8:
+            injected.append((message[1], message[2], now))
+    return injected
+
+# Stands in for the surface's MIDI input: waits to be told to go, then
+# injects events and hands back when each went in. Works in a worker, or on a
+# thread of the throttle process.
+class Feed:
+
+    def __init__(self, events, speed):
+        self.events = events
+        self.speed = speed
+        self.go = midiworker._context.Event()
+        self.times = midiworker._context.Queue()
+
+    def __call__(self, surface):
+        self.go.wait()
+        self.times.put(inject(self.events, surface, self.speed))
+
+# A session on a virtual surface whose MIDI arrives on a thread of the
+# throttle process (single) or in a worker process
+def session(args, feed, mode):
+    if mode == 'workers':
+        return Session(args, start=functools.partial(midiworker.start, worker_start=midirecord.virtual_start, feed=feed), workers=True)
+    return Session(args)
+
+# Start the feed, and wait for count fader events to reach the controller
+async def run_feed(session, feed, mode, count):
+    received = [0]
+    callback = session.controller.slider_callback
+    def counted(channel, value):
+        received[0] += 1
+        callback(channel, value)
+    # Counted on the event loop, however events get there
+    session.controller.surface.slider_callback = counted if mode == 'workers' else throttle.on_loop(counted)
+
+    if mode != 'workers':
+        threading.Thread(target=feed, args=(session.controller.surface,), daemon=True).start()
+    start = time.perf_counter()
+    feed.go.set()
+    while received[0] < count:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    injected = await asyncio.get_running_loop().run_in_executor(None, feed.times.get)
+    return (elapsed, injected)
+
+# Fader events as fast as they can be made: how many a second reach the controller
+async def bench_throughput(args, mode):
+    events = midirecord.fader_sweep(8, args.sweeps)
+    feed = Feed(events, None)
+    async with session(args, feed, mode) as s:
+        (elapsed, injected) = await run_feed(s, feed, mode, len(events))
+        print("throughput (%s): %d fader events" % (mode, len(events)))
+        print("  %.0f events/sec to slider_callback" % (len(events) / elapsed))
+        if mode == 'workers':
+            print("  worker found the ring full %d times" % s.controller.surface.midiin.events.full)
+
+# Eight faders sweeping in real time: latency from fader to server
+async def bench_sweep(args, mode):
+    events = midirecord.fader_sweep(8, args.sweeps)
+    feed = Feed(events, 1.0)
+    async with session(args, feed, mode) as s:
+        (elapsed, injected) = await run_feed(s, feed, mode, len(events))
+        await asyncio.sleep(args.update_interval * 2)
+        times = {}
+        for (channel, value, t) in injected:
+            times.setdefault((channel, value), []).append(t)
+        print("sweep (%s): %d fader events over %.1f seconds" % (mode, len(events), events[-1][0]))
+        report_latency("fader to server", fader_latencies(s.server.received, times))
+
+BENCHMARKS = {
+    'throughput': bench_throughput,
+    'sweep': bench_sweep,
+}
+
+MODES = ('single', 'workers')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run (%s). Default: all" % ", ".join(BENCHMARKS))
+    parser.add_argument("--mode", help="Run only in this mode. Default: both", choices=MODES)
+    parser.add_argument("--update-interval", help="Update interval passed to throttle. Default: %s" % throttle.UPDATE_INTERVAL, type=float, default=throttle.UPDATE_INTERVAL)
+    parser.add_argument("--latency", help="Server reply delay in seconds. Default: 0", type=float, default=0)
+    parser.add_argument("--split", help="Server writes replies this many bytes at a time", type=int)
+    parser.add_argument("--sweeps", help="Number of fader sweeps. Default: 2", type=int, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    async def main():
+        for name in args.benchmarks or BENCHMARKS:
+            for mode in [args.mode] if args.mode else MODES:
+                await BENCHMARKS[name](args, mode)
+
+    asyncio.run(main())
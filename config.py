@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+#
+# config.py
+#
+"""Load, validate and watch controller config files"""
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import re
+
+import midiControl
+from withrottle import withrottle
+
+log = logging.getLogger("config-logger")
+
+# Shift states for function buttons (TRACK L / TRACK R held down)
+NORMAL = 0
+LSHIFT = 1
+RSHIFT = 2
+
+SHIFT_STATES = {'normal': NORMAL, 'lshift': LSHIFT, 'rshift': RSHIFT}
+
+# Buttons that can be mapped to loco functions in the config file
+FUNCTION_BUTTONS = {
+    'rec': midiControl.REC_BUTTON.control_number,
+    'play': midiControl.PLAY_BUTTON.control_number,
+    'ff': midiControl.FF_BUTTON.control_number,
+    'rw': midiControl.RW_BUTTON.control_number,
+}
+
+# Highest DCC function number
+MAX_FUNCTION = 28
+
+# How often to check the config file when inotify isn't available (in seconds)
+POLL_INTERVAL = 2
+
+# Wait this long after a change before reloading, so a half-written file isn't read
+SETTLE_TIME = 0.2
+
+# Speed for each slider position when no curve or max speed is given
+LINEAR = bytes(min(value, withrottle.MAX_SPEED) for value in range(128))
+
+DCC_ADDRESS = re.compile(r"^[SL][0-9]+$")
+
+# inotify event flags
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+# Parsed config for one control surface
+class SurfaceConfig:
+
+    def __init__(self, dcc_address_list, functions, roster_names=None, speed_tables=None, momentum=None, consists=None, latching=None):
+        # List of DCC addresses, corresponding to sliders 0-7 (None if not known yet)
+        self.dcc_address_list = dcc_address_list
+        # Function lookup for each slider, keyed by (shift state, control number)
+        self.functions = functions
+        # Roster name for each slider, or None if it was given a DCC address
+        self.roster_names = roster_names or [None] * len(dcc_address_list)
+        # Speed to send for each slider position (0-127), for each slider
+        self.speed_tables = speed_tables or [LINEAR] * len(dcc_address_list)
+        # (acceleration, braking) in speed steps per second for each slider, or None
+        self.momentum = momentum or [None] * len(dcc_address_list)
+        # [(DCC address, facing backwards)] for sliders that drive a consist, otherwise None.
+        # The first loco leads, and is the one in dcc_address_list.
+        self.consists = consists or [None] * len(dcc_address_list)
+        # Function numbers that latch (each press turns them on or off) for
+        # each slider. The rest are momentary: on while the button is held.
+        self.latching = latching or [frozenset()] * len(dcc_address_list)
+
+    # Copy with roster names turned into DCC addresses by lookup(name),
+    # which returns None for names it doesn't know
+    def resolve(self, lookup):
+        if not any(self.roster_names):
+            return self
+        dcc_address_list = []
+        for (address, name) in zip(self.dcc_address_list, self.roster_names):
+            dcc_address_list.append(lookup(name) if name else address)
+        return SurfaceConfig(dcc_address_list, self.functions, self.roster_names, self.speed_tables, self.momentum, self.consists, self.latching)
+
+# Turn a 'functions' entry into {(shift state, control number): function}
+def compile_functions(banks):
+    functions = {}
+    if banks is None:
+        return functions
+    if not isinstance(banks, dict):
+        raise ValueError("functions must be an object")
+    for (bank, buttons) in banks.items():
+        if bank not in SHIFT_STATES:
+            raise ValueError("Unknown function bank '%s'" % bank)
+        if not isinstance(buttons, dict):
+            raise ValueError("Function bank '%s' must be an object" % bank)
+        for (name, function) in buttons.items():
+            if name not in FUNCTION_BUTTONS:
+                raise ValueError("Unknown function button '%s'" % name)
+            if not isinstance(function, int) or function < 0 or function > MAX_FUNCTION:
+                raise ValueError("Function for '%s' must be a number from 0 to %d" % (name, MAX_FUNCTION))
+            functions[(SHIFT_STATES[bank], FUNCTION_BUTTONS[name])] = function
+    return functions
+
+# Check a 'latching' entry, giving the set of function numbers that latch
+def compile_latching(latching):
+    if latching is None:
+        return frozenset()
+    if not isinstance(latching, list):
+        raise ValueError("latching must be a list of function numbers")
+    for function in latching:
+        if not isinstance(function, int) or isinstance(function, bool) or function < 0 or function > MAX_FUNCTION:
+            raise ValueError("Latching functions must be numbers from 0 to %d" % MAX_FUNCTION)
+    return frozenset(latching)
+
+# Turn 'speed_curve' and 'max_speed' entries into a table of the speed to send
+# for each slider position. A curve is either an exponent (2 gives finer control
+# at low speeds) or a list of [slider position, speed] points to join up.
+def compile_speed_table(curve, max_speed):
+    if max_speed is None:
+        top = withrottle.MAX_SPEED
+    elif isinstance(max_speed, int) and not isinstance(max_speed, bool) and 0 < max_speed <= withrottle.MAX_SPEED:
+        top = max_speed
+    else:
+        raise ValueError("max_speed must be a number from 1 to %d" % withrottle.MAX_SPEED)
+
+    if curve is None:
+        if max_speed is None:
+            return LINEAR
+        curve = 1
+
+    if isinstance(curve, (int, float)) and not isinstance(curve, bool):
+        if curve <= 0:
+            raise ValueError("speed_curve exponent must be more than 0")
+        return bytes(int(round((value / 127.0) ** curve * top)) for value in range(128))
+
+    if not isinstance(curve, list) or len(curve) < 2:
+        raise ValueError("speed_curve must be an exponent or a list of at least two points")
+    points = []
+    for point in curve:
+        if (not isinstance(point, list) or len(point) != 2
+                or not all(isinstance(n, int) and not isinstance(n, bool) for n in point)
+                or not 0 <= point[0] <= 127 or not 0 <= point[1] <= withrottle.MAX_SPEED):
+            raise ValueError("speed_curve points must be [slider 0-127, speed 0-%d]" % withrottle.MAX_SPEED)
+        if points and point[0] <= points[-1][0]:
+            raise ValueError("speed_curve points must be in order of slider position")
+        points.append(point)
+
+    # Straight lines between the points, level before the first and after the last
+    table = bytearray(128)
+    for value in range(128):
+        if value <= points[0][0]:
+            speed = points[0][1]
+        elif value >= points[-1][0]:
+            speed = points[-1][1]
+        else:
+            i = 1
+            while points[i][0] < value:
+                i += 1
+            ((x0, y0), (x1, y1)) = (points[i - 1], points[i])
+            speed = int(round(y0 + (y1 - y0) * (value - x0) / float(x1 - x0)))
+        table[value] = min(speed, top)
+    return bytes(table)
+
+# Check a 'momentum' entry, giving (acceleration, braking) in speed steps per second
+def compile_momentum(momentum):
+    if momentum is None:
+        return None
+    if not isinstance(momentum, dict):
+        raise ValueError("momentum must be an object")
+    rates = []
+    for name in ('acceleration', 'braking'):
+        rate = momentum.get(name)
+        if rate is not None and (isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0):
+            raise ValueError("momentum %s must be more than 0 speed steps per second" % name)
+        rates.append(rate)
+    for name in momentum:
+        if name not in ('acceleration', 'braking'):
+            raise ValueError("Unknown momentum setting '%s'" % name)
+    return tuple(rates)
+
+# Check a 'consist' entry, giving [(DCC address, facing backwards)]
+def compile_consist(consist):
+    if not isinstance(consist, list) or len(consist) < 2:
+        raise ValueError("consist must be a list of at least two locos")
+    units = []
+    for unit in consist:
+        if not isinstance(unit, dict) or 'dcc_address' not in unit:
+            raise ValueError("Missing DCC address in consist")
+        address = unit['dcc_address']
+        if not isinstance(address, str) or not DCC_ADDRESS.match(address):
+            raise ValueError("Invalid DCC address %r" % (address,))
+        if address in [a for (a, flipped) in units]:
+            raise ValueError("%s is in the consist twice" % address)
+        flipped = unit.get('reverse', False)
+        if not isinstance(flipped, bool):
+            raise ValueError("reverse must be true or false")
+        units.append((address, flipped))
+    return units
+
+# Check a decoded config file and build a SurfaceConfig from it
+def parse(config):
+    if not isinstance(config, list):
+        raise ValueError("Config must be a list of locos")
+    if len(config) > 8:
+        raise ValueError("Config has %d locos, but there are only 8 sliders" % len(config))
+
+    dcc_address_list = []
+    functions = []
+    roster_names = []
+    speed_tables = []
+    momentum = []
+    consists = []
+    latching = []
+
+    for entry in config:
+        if not isinstance(entry, dict):
+            raise ValueError("Missing DCC address or roster name in config")
+        given = [name for name in ('dcc_address', 'roster', 'consist') if name in entry]
+        if not given:
+            raise ValueError("Missing DCC address or roster name in config")
+        if len(given) > 1:
+            raise ValueError("Give one of a DCC address, a roster name or a consist, not %s" % " and ".join(given))
+
+        consist = None
+        if 'consist' in entry:
+            # Driven through the first loco's address
+            consist = compile_consist(entry['consist'])
+            name = None
+            address = consist[0][0]
+            log.debug("Adding consist %s" % ", ".join(a for (a, flipped) in consist))
+        elif 'roster' in entry:
+            # Looked up in the server's roster once connected
+            name = entry['roster']
+            if not isinstance(name, str) or not name:
+                raise ValueError("Invalid roster name %r" % (name,))
+            address = None
+            log.debug("Adding roster entry %s" % name)
+        else:
+            name = None
+            address = entry['dcc_address']
+            if not isinstance(address, str) or not DCC_ADDRESS.match(address):
+                raise ValueError("Invalid DCC address %r" % (address,))
+            log.debug("Adding DCC address %s" % address)
+        dcc_address_list.append(address)
+        roster_names.append(name)
+        consists.append(consist)
+        functions.append(compile_functions(entry.get('functions')))
+        speed_tables.append(compile_speed_table(entry.get('speed_curve'), entry.get('max_speed')))
+        momentum.append(compile_momentum(entry.get('momentum')))
+        latching.append(compile_latching(entry.get('latching')))
+
+    return SurfaceConfig(dcc_address_list, functions, roster_names, speed_tables, momentum, consists, latching)
+
+# Parsed configs, by path: (file signature, SurfaceConfig)
+_cache = {}
+
+# Something that changes whenever the file is rewritten or replaced
+def _signature(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+# Load a config file, reusing the last parse if the file hasn't changed.
+# Raises OSError or ValueError if it can't be read or isn't valid.
+def load(path):
+    signature = _signature(path)
+    cached = _cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    with open(path, 'r') as f:
+        config = parse(json.load(f))
+    _cache[path] = (signature, config)
+    return config
+
+# Roster name -> DCC address maps from each server, saved between runs so that
+# locos given by roster name can be acquired before the server sends its roster
+class RosterCache:
+
+    def __init__(self, path, server):
+        self.path = path
+        # Entries are kept by "host:port"
+        self.server = server
+        self.servers = {}
+        try:
+            with open(path, 'r') as f:
+                servers = json.load(f)
+            if isinstance(servers, dict):
+                self.servers = servers
+        except (OSError, ValueError) as e:
+            log.debug("No roster cache loaded from %s: %s" % (path, e))
+
+    # Addresses by roster name, as the server had them last time
+    def addresses(self):
+        addresses = self.servers.get(self.server)
+        if not isinstance(addresses, dict):
+            return {}
+        return dict((name, address) for (name, address) in addresses.items()
+                    if isinstance(address, str) and DCC_ADDRESS.match(address))
+
+    # Save the server's current roster (only written if it has changed)
+    def update(self, addresses):
+        if self.servers.get(self.server) == addresses:
+            return
+        self.servers[self.server] = addresses
+        temp = self.path + '.tmp'
+        try:
+            with open(temp, 'w') as f:
+                json.dump(self.servers, f, indent=1, sort_keys=True)
+            os.replace(temp, self.path)
+        except OSError as e:
+            log.warning("Unable to save roster cache %s: %s" % (self.path, e))
+
+# Open an inotify descriptor watching a directory, or None if not available
+def _inotify(directory):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    # Watch the directory, as editors often replace the file rather than write to it
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+# Calls callback(config) on the event loop whenever the config file changes
+# to something valid. Invalid changes are logged and ignored.
+class ConfigWatcher:
+
+    def __init__(self, loop, path, callback):
+        self.loop = loop
+        self.path = path
+        self.callback = callback
+        self.current = load(path)
+        self.timer = None
+        self.fd = _inotify(os.path.dirname(os.path.abspath(path)))
+        if self.fd is not None:
+            loop.add_reader(self.fd, self.notified)
+            log.debug("Watching %s with inotify" % path)
+        else:
+            self.timer = loop.call_later(POLL_INTERVAL, self.poll)
+            log.debug("Polling %s for changes" % path)
+
+    # Something in the directory changed - drain the events and check soon
+    def notified(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        if self.timer is None:
+            self.timer = self.loop.call_later(SETTLE_TIME, self.check)
+
+    def poll(self):
+        self.check()
+        self.timer = self.loop.call_later(POLL_INTERVAL, self.poll)
+
+    def check(self):
+        if self.fd is not None:
+            self.timer = None
+        try:
+            config = load(self.path)
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring changes to %s: %s" % (self.path, e))
+            return
+        if config is not self.current:
+            log.info("Reloaded %s" % self.path)
+            self.current = config
+            self.callback(config)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
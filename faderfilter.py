@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# faderfilter.py
+#
+"""Filter fader noise before it turns into speed messages"""
+
+import logging
+
+log = logging.getLogger("faderfilter-logger")
+
+# Smoothing modes
+NONE = 'none'
+MEDIAN = 'median'
+EXPONENTIAL = 'exponential'
+SMOOTHING = (NONE, MEDIAN, EXPONENTIAL)
+
+# Exponential smoothing is done in fixed point with this many fraction bits
+FRACTION_BITS = 8
+
+# Highest fader value
+TOP = 127
+
+# Sits between the MIDI handler and the slider callback, dropping values
+# that are only noise. Each channel keeps its own state in preallocated
+# lists, so filtering an event doesn't build anything.
+#
+# deadband: a fader that turns back must move more than this many steps
+#   before the change is passed on (hysteresis). Moving on in the same
+#   direction is passed on straight away, as are 0 and 127.
+# smoothing: NONE, MEDIAN (of the last three values - drops single-event
+#   spikes) or EXPONENTIAL (with weight alpha for the newest value)
+# snap_to_zero: values up to this count as 0
+#
+# Values from 14-bit faders come in as fractions of a step, and are passed on
+# as they are unless smoothed.
+class FaderFilter:
+
+    __slots__ = ('deadband', 'smoothing', 'alpha', 'snap_to_zero',
+                 'last', 'direction', 'previous', 'before', 'smoothed',
+                 'events', 'passed', 'suppressed')
+
+    def __init__(self, deadband=1, smoothing=NONE, alpha=0.5, snap_to_zero=0, channels=16):
+        if smoothing not in SMOOTHING:
+            raise ValueError("Unknown smoothing '%s'" % smoothing)
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be more than 0 and at most 1")
+        self.deadband = deadband
+        self.smoothing = smoothing
+        self.alpha = int(alpha * (1 << FRACTION_BITS))
+        self.snap_to_zero = snap_to_zero
+
+        # Value last passed on (-1 before the first), and which way it last moved
+        self.last = [-1] * channels
+        self.direction = [0] * channels
+        # Last two raw values, for the median
+        self.previous = [-1] * channels
+        self.before = [-1] * channels
+        # Smoothed value in fixed point (-1 before the first)
+        self.smoothed = [-1] * channels
+
+        # Counters
+        self.events = 0
+        self.passed = 0
+        self.suppressed = 0
+
+    # Value to pass on for a fader event, or None if it should be dropped
+    def filter(self, channel, value):
+        self.events += 1
+
+        if self.smoothing == MEDIAN:
+            a = self.previous[channel]
+            b = self.before[channel]
+            self.before[channel] = a
+            self.previous[channel] = value
+            if b >= 0 and value != 0 and value != TOP:
+                value = max(min(a, b), min(max(a, b), value))
+        elif self.smoothing == EXPONENTIAL:
+            s = self.smoothed[channel]
+            if s < 0 or value == 0 or value == TOP:
+                # Ends are passed straight through, so the fader can always reach them
+                s = int(value * (1 << FRACTION_BITS))
+            else:
+                s += ((int(value * (1 << FRACTION_BITS)) - s) * self.alpha) >> FRACTION_BITS
+            self.smoothed[channel] = s
+            value = (s + (1 << (FRACTION_BITS - 1))) >> FRACTION_BITS
+
+        if value <= self.snap_to_zero:
+            value = 0
+
+        last = self.last[channel]
+        if value == last:
+            self.suppressed += 1
+            return None
+        if last >= 0:
+            step = 1 if value > last else -1
+            direction = self.direction[channel]
+            if step != direction:
+                # The first move after the first value sets the direction
+                if direction and abs(value - last) <= self.deadband and value != 0 and value != TOP:
+                    # Turned back by less than the deadband - noise
+                    self.suppressed += 1
+                    return None
+                self.direction[channel] = step
+
+        self.last[channel] = value
+        self.passed += 1
+        return value
+
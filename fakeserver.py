@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# fakeserver.py
+#
+"""Stand-in withrottle server for running without JMRI"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+log = logging.getLogger("fakeserver-logger")
+
+# Stands in for JMRI: answers the part of the withrottle protocol that
+# withrottle.py uses, and records everything it receives.
+class FakeServer:
+
+    def __init__(self, latency=0, split=None, heartbeat=10, roster=None):
+        # Delay before each reply (in seconds)
+        self.latency = latency
+        # If set, replies are written this many bytes at a time
+        self.split = split
+        self.heartbeat = heartbeat
+        # List of (name, address) pairs sent as the roster
+        self.roster = roster or []
+
+        self.power = False
+        # Function states, by address
+        self.functions = {}
+        # Addresses held by each throttle key, for '*' commands
+        self.throttles = {}
+
+        # (time.perf_counter(), line) for every line received
+        self.received = []
+        self.bytes_received = 0
+        self.connections = 0
+        self.writers = []
+        self.tasks = set()
+        self.server = None
+
+    # Start listening. Returns the port number.
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        self.disconnect()
+        # Let client handlers see the connection close and finish
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        await self.server.wait_closed()
+
+    # Drop every client, as if JMRI had restarted
+    def disconnect(self):
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+
+    # Lines received that start with prefix
+    def lines(self, prefix=""):
+        return [line for (t, line) in self.received if line.startswith(prefix)]
+
+    def clear(self):
+        self.received = []
+        self.bytes_received = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        roster = "".join("]\\[%s}|{%s}|{%s" % (name, address[1:], address[0]) for (name, address) in self.roster)
+        await self.send(writer, [
+            "VN2.0",
+            "RL%d%s" % (len(self.roster), roster),
+            "PPA%d" % self.power,
+            "PW12080",
+            "*%d" % self.heartbeat,
+        ])
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.bytes_received += len(line)
+                line = line.rstrip(b"\r\n").decode(errors="replace")
+                self.received.append((time.perf_counter(), line))
+                reply = self.respond(line)
+                if reply:
+                    await self.send(writer, reply)
+        except ConnectionError:
+            pass
+        finally:
+            if writer in self.writers:
+                self.writers.remove(writer)
+            self.tasks.discard(task)
+            writer.close()
+
+    # Replies for one line from a client
+    def respond(self, line):
+        if line.startswith("PPA"):
+            self.power = line == "PPA1"
+            return [line]
+        if not line.startswith("M") or "<;>" not in line:
+            return []
+
+        (command, value) = line.split("<;>", 1)
+        prefix = command[:3]
+        address = command[3:]
+        key = command[1]
+        held = self.throttles.setdefault(key, [])
+
+        if prefix[2] == "+":
+            if address not in held:
+                held.append(address)
+            return ["M%s+%s<;>" % (key, address), "M%sA%s<;>R1" % (key, address), "M%sA%s<;>V0" % (key, address)]
+        if prefix[2] == "-":
+            released = list(held) if address == "*" else [address]
+            for loco in released:
+                if loco in held:
+                    held.remove(loco)
+            return ["M%s-%s<;>" % (key, loco) for loco in released]
+        if prefix[2] != "A":
+            return []
+
+        # Wildcard - the same action on every loco the throttle holds
+        if address == "*":
+            replies = []
+            for loco in held:
+                replies += self.respond("M%sA%s<;>%s" % (key, loco, value))
+            return replies
+
+        # Actions on one loco
+        if value.startswith("V") or value.startswith("R"):
+            return ["%s<;>%s" % (command, value)]
+        if value == "X":
+            return ["%s<;>V0" % (command)]
+        if value.startswith("F") and len(value) > 2:
+            function = value[2:]
+            if value[1] == "1":
+                # Press toggles the function
+                states = self.functions.setdefault(address, {})
+                states[function] = not states.get(function, False)
+                return ["%s<;>F%d%s" % (command, states[function], function)]
+        if value.startswith("f") and len(value) > 2:
+            # Function set outright
+            function = value[2:]
+            states = self.functions.setdefault(address, {})
+            states[function] = value[1] == "1"
+            return ["%s<;>F%d%s" % (command, states[function], function)]
+        return []
+
+    async def send(self, writer, lines):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = "".join(line + "\n" for line in lines).encode()
+        if self.split:
+            # Make lines straddle packets
+            for i in range(0, len(data), self.split):
+                writer.write(data[i:i+self.split])
+                await writer.drain()
+                await asyncio.sleep(0)
+        else:
+            writer.write(data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+#main function
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="Port to listen on. Default: 12090", type=int, default=12090)
+    parser.add_argument("--latency", help="Seconds to wait before each reply. Default: 0", type=float, default=0)
+    parser.add_argument("--split", help="Write replies this many bytes at a time", type=int)
+    parser.add_argument("--drop-every", help="Disconnect all clients every this many seconds", type=float)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        server = FakeServer(args.latency, args.split)
+        await server.start("0.0.0.0", args.port)
+        log.info("Listening on port %d" % args.port)
+        seen = 0
+        start = time.time()
+        while True:
+            await asyncio.sleep(0.1)
+            for (t, line) in server.received[seen:]:
+                print(line)
+            seen = len(server.received)
+            if args.drop_every and time.time() - start > args.drop_every:
+                log.info("Dropping clients")
+                server.disconnect()
+                start = time.time()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
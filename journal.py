@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# journal.py
+#
+"""Keep a journal of MIDI events and withrottle traffic in a fixed-size file, and read it back"""
+
+import argparse
+import datetime
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+log = logging.getLogger("journal-logger")
+
+# Default journal file and size (in MB)
+DEFAULT_FILE = os.path.join("~", ".midi-throttle.journal")
+DEFAULT_SIZE = 16
+
+# Record kinds
+START = 1
+MIDI = 2
+SENT = 3
+RECEIVED = 4
+CANCELLED = 5
+
+KINDS = {START: "start", MIDI: "midi", SENT: "sent", RECEIVED: "received", CANCELLED: "cancelled"}
+
+# Header: magic, number of records the file holds, and how many have been
+# written in all (the next record goes in slot written % capacity)
+MAGIC = b"MTJ1"
+HEADER = struct.Struct("<4sIQ")
+HEAD = 8
+HEAD_SIZE = 64
+INDEX = struct.Struct("<Q")
+
+# Record: time, low 32 bits of its number (so a half-written record can be
+# told apart from the one it replaces), kind, flags (surface for MIDI, 1 for
+# urgent commands), full length of the data (up to 65535) and as much of the
+# data as fits
+RECORD = struct.Struct("<dIBBH48s")
+DATA_SIZE = 48
+# The same for a three byte MIDI message, packed straight from its list
+MIDI_RECORD = struct.Struct("<dIBBH3B")
+
+# Journal open for writing. The file is a ring: once full, each record
+# replaces the oldest. It is kept mapped, so recording is a couple of struct
+# packs into memory, and whatever was recorded survives the process crashing.
+#
+# Times are from the monotonic clock, moved onto the wall clock when the
+# journal is opened, so they only go forwards during a run and can be
+# compared between runs.
+#
+# MIDI events are recorded on the rtmidi input thread and server traffic on
+# the event loop, so each record is written under a lock: otherwise two
+# threads could take the same slot.
+class Journal:
+
+    # size is in MB
+    def __init__(self, filename, size=DEFAULT_SIZE):
+        capacity = 1 << ((size << 20) // RECORD.size).bit_length() - 1
+        length = HEAD_SIZE + capacity * RECORD.size
+        self.filename = filename
+
+        # Carry on from the last run if the file is a journal of the same size
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) == HEADER.size and os.fstat(fd).st_size == length and HEADER.unpack(header)[:2] == (MAGIC, capacity):
+                head = HEADER.unpack(header)[2]
+            else:
+                log.info("Starting new journal in %s", filename)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, length)
+                os.pwrite(fd, HEADER.pack(MAGIC, capacity, 0), 0)
+                head = 0
+            self.map = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.head = head
+        self.lock = threading.Lock()
+        self.offset = time.time() - time.monotonic()
+        self.record(START, 0, b"pid %d" % os.getpid())
+
+    def record(self, kind, flags, data):
+        with self.lock:
+            head = self.head
+            RECORD.pack_into(self.map, HEAD_SIZE + (head & self.mask) * RECORD.size,
+                             time.monotonic() + self.offset, head & 0xFFFFFFFF, kind, flags, min(len(data), 0xFFFF), data)
+            self.head = head = head + 1
+            INDEX.pack_into(self.map, HEAD, head)
+
+    # A MIDI event (list of bytes) from the surface'th surface. Only three
+    # byte messages are kept, as only they are used (and clock would soon
+    # fill the journal).
+    def midi(self, surface, message):
+        if len(message) != 3:
+            return
+        with self.lock:
+            head = self.head
+            MIDI_RECORD.pack_into(self.map, HEAD_SIZE + (head & self.mask) * RECORD.size,
+                                  time.monotonic() + self.offset, head & 0xFFFFFFFF, MIDI, surface, 3, message[0], message[1], message[2])
+            self.head = head = head + 1
+            INDEX.pack_into(self.map, HEAD, head)
+
+    # A command queued for the server, in the two pieces withrottle.write_bytes() takes
+    def sent(self, prefix, suffix, urgent):
+        self.record(SENT, urgent, prefix + suffix)
+
+    # A queued command (without its newline) dropped before it was sent, e.g.
+    # a speed overtaken by a stop
+    def cancelled(self, line):
+        self.record(CANCELLED, 0, line)
+
+    # A line from the server, as bytes
+    def received(self, line):
+        self.record(RECEIVED, 0, line)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
+
+# rtmidi callback that journals each event from the surface'th surface, then
+# passes it on to handler. If the journal fails, events still go to handler.
+def midi_handler(journal, surface, handler):
+    record = journal.midi
+    def journaled(msg, data):
+        nonlocal record
+        if record:
+            try:
+                record(surface, msg[0])
+            except Exception as e:
+                log.error("Journal failed, no longer recording MIDI: %s", e)
+                record = None
+        handler(msg, data)
+    return journaled
+
+# Journal open for reading, mapped rather than read in, so only the records
+# looked at are loaded. Records are numbered as they were written; the ones
+# still in the file are first to last - 1.
+class Reader:
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEAD_SIZE:
+            raise ValueError("%s is not a journal" % filename)
+        (magic, self.capacity, head) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or len(self.map) != HEAD_SIZE + self.capacity * RECORD.size:
+            raise ValueError("%s is not a journal" % filename)
+        self.mask = self.capacity - 1
+        self.last = head
+        self.first = max(0, head - self.capacity)
+
+    # (time, kind, flags, data, full length) for record number n, or None if
+    # it was overwritten or left half-written
+    def get(self, n):
+        (t, number, kind, flags, length, data) = RECORD.unpack_from(self.map, HEAD_SIZE + (n & self.mask) * RECORD.size)
+        if number != n & 0xFFFFFFFF or kind not in KINDS:
+            return None
+        return (t, kind, flags, data[:min(length, DATA_SIZE)], length)
+
+    def time(self, n):
+        return RECORD.unpack_from(self.map, HEAD_SIZE + (n & self.mask) * RECORD.size)[0]
+
+    # Number of the first record at or after time t
+    def find(self, t):
+        (lo, hi) = (self.first, self.last)
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self.time(middle) < t:
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    # Each record from time start to time end (either may be None)
+    def records(self, start=None, end=None):
+        n = self.first if start is None else self.find(start)
+        while n < self.last:
+            record = self.get(n)
+            n += 1
+            if record is None:
+                continue
+            if end is not None and record[0] > end:
+                break
+            yield record
+
+    def close(self):
+        self.map.close()
+
+# Does a record concern any of the locos patterns were made for? Stops sent
+# to every loco ("*") count for all of them.
+def about(data, patterns):
+    for pattern in patterns:
+        if pattern in data:
+            return True
+    return b"A*<;>" in data
+
+# What a loco's address looks like in commands and replies (acquiring,
+# releasing and everything else)
+def loco_patterns(locos):
+    patterns = []
+    for loco in locos:
+        loco = loco.encode()
+        patterns += [b"A" + loco + b"<;>", b"+" + loco + b"<;>", b"-" + loco + b"<;>"]
+    return patterns
+
+# One line of the timeline
+def render(record, previous):
+    (t, kind, flags, data, length) = record
+    stamp = datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")
+    gap = "" if previous is None else "+%.3f ms" % ((t - previous) * 1000)
+    if kind == MIDI:
+        text = "midi %d  %s" % (flags, " ".join("%02X" % byte for byte in data))
+    elif kind == START:
+        text = "=== started (%s) ===" % data.decode(errors='replace')
+        gap = ""
+    else:
+        text = data.rstrip(b"\n").decode(errors='replace')
+        # Commands are kept with their newline
+        if length > DATA_SIZE + (kind == SENT):
+            text += "..."
+        if kind == SENT:
+            text = ("-> " if not flags else "!> ") + text
+        elif kind == CANCELLED:
+            text = "x> " + text + " (cancelled, never sent)"
+        else:
+            text = "<- " + text
+    return "%s %14s  %s" % (stamp, gap, text)
+
+# A time on the command line: a date and time, or a time of day on the date
+# of the last record
+def parse_time(text, last):
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        pass
+    day = datetime.datetime.fromtimestamp(last).date()
+    for pattern in ("%H:%M:%S.%f", "%H:%M:%S", "%H:%M"):
+        try:
+            return datetime.datetime.combine(day, datetime.datetime.strptime(text, pattern).time()).timestamp()
+        except ValueError:
+            pass
+    raise ValueError("Can't read time '%s'" % text)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show what is in a journal as a timeline")
+    parser.add_argument("journal", nargs="?", help="Journal file. Default: %s" % DEFAULT_FILE, default=DEFAULT_FILE)
+    parser.add_argument("-l", "--loco", help="Only show commands and replies for this loco address (e.g. S3 or L1234). Repeat for more", action="append")
+    parser.add_argument("--from", help="Start at this time (HH:MM[:SS] on the last day in the journal, or YYYY-MM-DD HH:MM:SS)", dest="start")
+    parser.add_argument("--to", help="Stop at this time", dest="end")
+    parser.add_argument("--last", help="Only show the last this many seconds", type=float)
+    parser.add_argument("--no-midi", help="Leave out MIDI events", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        reader = Reader(os.path.expanduser(args.journal))
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if reader.last == reader.first:
+        sys.exit(0)
+
+    last = reader.time(reader.last - 1)
+    try:
+        start = parse_time(args.start, last) if args.start else None
+        end = parse_time(args.end, last) if args.end else None
+    except ValueError as e:
+        parser.error(str(e))
+    if args.last is not None:
+        start = max(start or 0, last - args.last)
+
+    patterns = loco_patterns(args.loco) if args.loco else None
+    previous = None
+    try:
+        for record in reader.records(start, end):
+            kind = record[1]
+            if patterns is not None and (kind == MIDI or (kind != START and not about(record[3], patterns))):
+                continue
+            if args.no_midi and kind == MIDI:
+                continue
+            print(render(record, previous))
+            previous = record[0]
+    except BrokenPipeError:
+        # e.g. piped into head
+        sys.stderr.close()
+    reader.close()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+#
+# loadgen.py
+#
+"""Load test a withrottle server with many simulated throttles from one process"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import random
+import sys
+import time
+
+import stats
+from fakeserver import FakeServer
+from withrottle import withrottle
+
+log = logging.getLogger("loadgen-logger")
+
+# Traffic for one simulated throttle (times in seconds, None for none of that kind):
+#   move_interval: average time between slider moves, 0 for always moving
+#   move_time: how long a move takes, with a speed sent every update_interval
+#   function_interval: average time between function button presses
+#   heartbeat: time between heartbeats
+DEFAULTS = {'move_interval': None, 'move_time': 2, 'update_interval': 0.25, 'function_interval': None, 'heartbeat': 5}
+
+TRAFFIC = {
+    # Throttle left on the shelf
+    'idle': {},
+    # Driving a train on the main line
+    'operator': {'move_interval': 10, 'move_time': 2, 'function_interval': 30},
+    # Shunting in a yard - stop, start and horn all the time
+    'switcher': {'move_interval': 3, 'move_time': 1, 'function_interval': 8},
+    # Sliders never still, far faster than any person
+    'stress': {'move_interval': 0, 'move_time': 1, 'update_interval': 0.05, 'function_interval': 1},
+}
+
+# Functions pressed, and how long each press lasts (in seconds)
+FUNCTIONS = (0, 1, 2, 3)
+PRESS_TIME = 0.2
+
+# A loco not confirmed by the server within this long (in seconds) counts as failed
+ACQUIRE_TIMEOUT = 5
+
+# Traffic settings by name: built in, or a JSON file of settings.
+# Raises OSError or ValueError if it can't be read or isn't valid.
+def load_traffic(name):
+    if name in TRAFFIC:
+        settings = TRAFFIC[name]
+    else:
+        with open(name, 'r') as f:
+            settings = json.load(f)
+        if not isinstance(settings, dict):
+            raise ValueError("Traffic must be an object")
+    traffic = dict(DEFAULTS)
+    for (setting, value) in settings.items():
+        if setting not in DEFAULTS:
+            raise ValueError("Unknown setting %r" % (setting,))
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0):
+            raise ValueError("Invalid %s %r" % (setting, value))
+        traffic[setting] = value
+    if not traffic['update_interval'] or not traffic['heartbeat']:
+        raise ValueError("update_interval and heartbeat must be more than 0")
+    return traffic
+
+# Counters and latencies from every client together
+class Results:
+
+    def __init__(self):
+        self.connections = 0
+        self.connect_failures = 0
+        self.dropped = 0
+        self.locos = 0
+        self.acquired = 0
+        self.acquire_failures = 0
+        self.sent = 0
+        self.received = 0
+        self.bytes_sent = 0
+        self.unacknowledged = 0
+        self.latency = collections.OrderedDict((name, stats.Histogram()) for name in ('connect', 'acquire', 'speed ack', 'function ack'))
+
+    @property
+    def failures(self):
+        return self.connect_failures + self.dropped + self.acquire_failures
+
+    def report(self, elapsed):
+        print("  %d connected, %d failed to connect, %d dropped" % (self.connections, self.connect_failures, self.dropped))
+        print("  %d of %d locos acquired, %d timed out" % (self.acquired, self.locos, self.acquire_failures))
+        print("  %d messages sent (%.1f/sec), %d bytes, %d actions received (%.1f/sec)" % (
+            self.sent, self.sent / elapsed, self.bytes_sent, self.received, self.received / elapsed))
+        for (name, histogram) in self.latency.items():
+            print("  %-13s n=%-7d p50 %7.2f ms  p90 %7.2f ms  p99 %7.2f ms  p99.9 %7.2f ms  max %7.2f ms" % (
+                name, histogram.count, histogram.percentile(50) / 1000.0, histogram.percentile(90) / 1000.0,
+                histogram.percentile(99) / 1000.0, histogram.percentile(99.9) / 1000.0, histogram.max / 1000.0))
+        print("  %d speeds never echoed by the server" % self.unacknowledged)
+
+# One simulated throttle: its own connection, driving its own locos. Traffic
+# runs on loop timers, and each callback checks running so that nothing needs
+# cancelling at the end.
+class Client:
+
+    def __init__(self, loop, number, traffic, addresses, results, rng):
+        self.loop = loop
+        self.number = number
+        self.traffic = traffic
+        self.addresses = addresses
+        self.results = results
+        self.rng = rng
+
+        self.throttle = None
+        self.running = False
+        self.done = loop.create_future()
+        # When each loco was asked for, until the server confirms it
+        self.acquiring = {}
+        # Speed last sent for each loco, and (speed, time) of those not yet echoed
+        self.speed = {}
+        self.unacked = {}
+        # Time each function message was last sent, by (loco, function), until the server answers
+        self.pressed = {}
+        self.heartbeat = traffic['heartbeat']
+
+    async def run(self, host, port, nodelay, until):
+        results = self.results
+        results.locos += len(self.addresses)
+        throttle = self.throttle = withrottle(host, port, nodelay, connect=False)
+        start = time.perf_counter()
+        try:
+            s = await self.loop.run_in_executor(None, throttle.open_socket)
+        except OSError as e:
+            log.warning("Connection %d failed: %s" % (self.number, e))
+            results.connect_failures += 1
+            return
+        results.latency['connect'].record(time.perf_counter() - start)
+        results.connections += 1
+
+        throttle.attach(s)
+        throttle.on_pending = lambda: self.loop.call_soon(self.flush)
+        self.loop.add_reader(throttle.s, self.input_ready)
+        self.running = True
+        self.send(throttle.set_name, "loadgen-%d" % self.number)
+        for id in self.addresses:
+            self.acquiring[id] = time.perf_counter()
+            self.send(throttle.add_loco, id)
+        self.loop.call_later(ACQUIRE_TIMEOUT, self.acquire_timeout)
+        self.loop.call_later(self.heartbeat, self.send_heartbeat)
+
+        await asyncio.wait([self.done], timeout=max(until - self.loop.time(), 0))
+        self.stop()
+
+    def stop(self):
+        if self.throttle is None or self.throttle.s is None:
+            return
+        if self.running:
+            self.running = False
+            for id in self.speed:
+                self.throttle.release_loco(id)
+            self.throttle.flush()
+        for (id, pending) in self.unacked.items():
+            self.results.unacknowledged += len(pending)
+        self.unacked.clear()
+        self.results.bytes_sent += self.throttle.bytes_sent
+        self.loop.remove_reader(self.throttle.s)
+        self.loop.remove_writer(self.throttle.s)
+        self.throttle.s.close()
+        self.throttle.s = None
+        if not self.done.done():
+            self.done.set_result(None)
+
+    # Write a command through the withrottle method that builds it
+    def send(self, command, *args):
+        command(*args)
+        self.results.sent += 1
+
+    def flush(self):
+        if not self.running:
+            return
+        throttle = self.throttle
+        if throttle.flush():
+            self.loop.remove_writer(throttle.s)
+        elif throttle.closed:
+            self.lost()
+        else:
+            self.loop.add_writer(throttle.s, self.flush)
+
+    def lost(self):
+        log.warning("Connection %d dropped by server" % self.number)
+        self.results.dropped += 1
+        self.running = False
+        self.stop()
+
+    def input_ready(self):
+        throttle = self.throttle
+        actions = throttle.process_input()
+        self.results.received += len(actions)
+        now = time.perf_counter()
+        for (action, id, key) in actions:
+            if action == withrottle.SPEED:
+                self.speed_echoed(id[0], id[1], now)
+            elif action == withrottle.FUNCTION:
+                sent = self.pressed.pop((id[0], id[1]), None)
+                if sent is not None:
+                    self.results.latency['function ack'].record(now - sent)
+            elif action == withrottle.ADDED:
+                self.added(id, now)
+            elif action == withrottle.HEARTBEAT:
+                try:
+                    # Stay well inside what the server expects
+                    self.heartbeat = min(self.traffic['heartbeat'], int(id) / 2.0) or self.traffic['heartbeat']
+                except ValueError:
+                    pass
+        if throttle.closed and self.running:
+            self.lost()
+
+    def added(self, id, now):
+        sent = self.acquiring.pop(id, None)
+        if sent is None:
+            return
+        self.results.latency['acquire'].record(now - sent)
+        self.results.acquired += 1
+        self.speed[id] = 0
+        self.unacked[id] = collections.deque()
+        if self.traffic['move_interval'] is not None:
+            self.schedule(self.traffic['move_interval'], self.start_move, id)
+        if self.traffic['function_interval'] is not None:
+            self.schedule(self.traffic['function_interval'], self.press, id)
+
+    def acquire_timeout(self):
+        if self.acquiring:
+            log.warning("Connection %d: %d locos not confirmed by the server" % (self.number, len(self.acquiring)))
+            self.results.acquire_failures += len(self.acquiring)
+            self.acquiring.clear()
+
+    # Call callback(id) after a random time averaging interval
+    def schedule(self, interval, callback, id):
+        delay = self.rng.expovariate(1.0 / interval) if interval else 0
+        self.loop.call_later(delay, callback, id)
+
+    # Slider moves to a new position, sending speeds on the way as the
+    # throttle's scheduler would
+    def start_move(self, id):
+        if not self.running:
+            return
+        steps = max(1, int(round(self.traffic['move_time'] / self.traffic['update_interval'])))
+        self.move_step(id, self.speed[id], self.rng.randint(0, withrottle.MAX_SPEED), 1, steps)
+
+    def move_step(self, id, start, target, step, steps):
+        if not self.running:
+            return
+        speed = start + (target - start) * step // steps
+        if speed != self.speed[id]:
+            self.speed[id] = speed
+            self.unacked[id].append((speed, time.perf_counter()))
+            self.send(self.throttle.set_speed, id, speed)
+        if step < steps:
+            self.loop.call_later(self.traffic['update_interval'], self.move_step, id, start, target, step + 1, steps)
+        else:
+            self.schedule(self.traffic['move_interval'], self.start_move, id)
+
+    def speed_echoed(self, id, speed, now):
+        pending = self.unacked.get(id)
+        if not pending or not any(sent == speed for (sent, t) in pending):
+            return
+        # Speeds are echoed in order - earlier ones not seen were skipped
+        while pending:
+            (sent, t) = pending.popleft()
+            if sent == speed:
+                self.results.latency['speed ack'].record(now - t)
+                return
+            self.results.unacknowledged += 1
+
+    def press(self, id):
+        if not self.running:
+            return
+        function = self.rng.choice(FUNCTIONS)
+        self.pressed[(id, function)] = time.perf_counter()
+        self.send(self.throttle.send_function, id, function, True)
+        self.loop.call_later(PRESS_TIME, self.release, id, function)
+
+    def release(self, id, function):
+        if not self.running:
+            return
+        self.pressed[(id, function)] = time.perf_counter()
+        self.send(self.throttle.send_function, id, function, False)
+        self.schedule(self.traffic['function_interval'], self.press, id)
+
+    def send_heartbeat(self):
+        if not self.running:
+            return
+        self.send(self.throttle.send_heartbeat)
+        self.loop.call_later(self.heartbeat, self.send_heartbeat)
+
+# Run connections clients for duration seconds, their start spread over ramp
+# seconds. mix is a list of (traffic settings, weight) shared out between
+# them. Each client drives locos locos, with long addresses counting up from
+# first_address. Returns Results.
+async def run(host, port, connections, mix, locos=1, duration=60, ramp=5, first_address=1000, nodelay=True, seed=None):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    results = Results()
+
+    total = sum(weight for (traffic, weight) in mix)
+    clients = []
+    for number in range(connections):
+        # Share out connections in proportion to weight
+        point = (number + 0.5) * total / connections
+        for (traffic, weight) in mix:
+            point -= weight
+            if point < 0:
+                break
+        addresses = ["L%d" % (first_address + number * locos + i) for i in range(locos)]
+        clients.append(Client(loop, number, traffic, addresses, results, random.Random(rng.random())))
+
+    until = loop.time() + ramp + duration
+    tasks = []
+    for client in clients:
+        tasks.append(loop.create_task(client.run(host, port, nodelay, until)))
+        await asyncio.sleep(ramp / connections)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for client in clients:
+            client.stop()
+    return results
+
+#main function
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--connections", help="Number of throttles to simulate. Default: 10", type=int, default=10)
+    parser.add_argument("-t", "--traffic", help="Traffic for the throttles: %s or a JSON file of settings, optionally with a weight, e.g. operator:4. "
+        "Repeat to mix. Default: operator" % ", ".join(TRAFFIC), action="append")
+    parser.add_argument("--locos", help="Locos driven by each throttle. Default: 1", type=int, default=1)
+    parser.add_argument("--first-address", help="Long address of the first loco, the rest count up from it. Default: 1000", type=int, default=1000)
+    parser.add_argument("--duration", help="Seconds to run for once every throttle has started. Default: 60", type=float, default=60)
+    parser.add_argument("--ramp", help="Seconds over which throttles connect. Default: 5", type=float, default=5)
+    parser.add_argument("--seed", help="Random seed, to repeat a run", type=int)
+    parser.add_argument("--hostname", help="Hostname of withrottle server. Default: localhost", default="localhost")
+    parser.add_argument("--port", help="Port number of withrottle server. Default: 12090", type=int, default=12090)
+    parser.add_argument("--fake", help="Run against the stand-in server (fakeserver.py) in this process", action="store_true")
+    parser.add_argument("--fake-latency", help="Seconds the stand-in server waits before each reply. Default: 0", type=float, default=0)
+    parser.add_argument("--nagle", help="Use Nagle's algorithm on the connections", action="store_true")
+    parser.add_argument("-v", "--verbose", help="Enable verbose output", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.connections < 1 or args.locos < 1:
+        parser.error("Need at least one connection and one loco")
+    mix = []
+    for spec in args.traffic or ["operator"]:
+        (name, weight) = spec.rsplit(":", 1) if ":" in spec else (spec, "1")
+        try:
+            mix.append((load_traffic(name), float(weight)))
+        except (OSError, ValueError) as e:
+            parser.error("%s: %s" % (spec, e))
+    if sum(weight for (traffic, weight) in mix) <= 0:
+        parser.error("Traffic weights must add up to more than 0")
+
+    async def main():
+        host = args.hostname
+        port = args.port
+        server = None
+        if args.fake:
+            server = FakeServer(args.fake_latency)
+            host = "127.0.0.1"
+            port = await server.start(host)
+        print("loadgen: %d connections, %d locos each, to %s:%d for %.0f s" % (args.connections, args.locos, host, port, args.duration))
+        start = time.perf_counter()
+        try:
+            results = await run(host, port, args.connections, mix, args.locos, args.duration, args.ramp,
+                                args.first_address, not args.nagle, args.seed)
+        finally:
+            if server:
+                await server.stop()
+        results.report(time.perf_counter() - start)
+        return results
+
+    try:
+        results = asyncio.run(main())
+    except KeyboardInterrupt:
+        sys.exit(1)
+    sys.exit(1 if results.failures else 0)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# macro.py
+#
+"""Record slider moves and button presses, and play them back on time"""
+
+import json
+import logging
+
+import stats
+
+log = logging.getLogger("macro-logger")
+
+SLIDER = 'slider'
+BUTTON = 'button'
+
+# Pause between the end of a macro and the start of the next pass when repeating (in seconds)
+REPEAT_GAP = 1.0
+
+# Keeps what goes through a controller's slider and button callbacks, with
+# the time from the start of recording
+class Recorder:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.start = loop.time()
+        self.events = []
+
+    def slider(self, channel, value):
+        self.events.append((self.loop.time() - self.start, SLIDER, channel, value))
+
+    def button(self, control_number, is_on):
+        self.events.append((self.loop.time() - self.start, BUTTON, control_number, is_on))
+
+# Events are stored one per line, e.g. {"t": 1.25, "slider": [0, 64]} or {"t": 2.5, "button": [45, 1]}
+# (slider values from 14-bit faders are kept as fractions)
+def save(events, filename):
+    with open(filename, 'w') as f:
+        for (t, kind, number, value) in events:
+            f.write(json.dumps({"t": round(t, 6), kind: [number, value if kind == SLIDER else int(value)]}) + "\n")
+
+# Raises OSError or ValueError if the file can't be read
+def load(filename):
+    events = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if SLIDER in event:
+                (channel, value) = event[SLIDER]
+                events.append((float(event["t"]), SLIDER, channel, value))
+            elif BUTTON in event:
+                (control_number, is_on) = event[BUTTON]
+                events.append((float(event["t"]), BUTTON, control_number, bool(is_on)))
+    events.sort(key=lambda event: event[0])
+    return events
+
+# Plays events into slider(channel, value) and button(control_number, is_on).
+# Each event is scheduled for its own time from the start of the pass, so
+# late events don't push back the ones after them. How late each one runs
+# is kept in a histogram and reported at the end of each pass.
+class Player:
+
+    def __init__(self, loop, events, slider, button, repeat=False, on_done=None):
+        self.loop = loop
+        self.events = events
+        self.slider = slider
+        self.button = button
+        self.repeat = repeat
+        self.on_done = on_done
+
+        self.start_time = None
+        self.index = 0
+        self.timer = None
+        self.passes = 0
+        self.drift = stats.Histogram()
+
+    def start(self):
+        if not self.events:
+            self.finish()
+            return
+        self.start_time = self.loop.time()
+        self.index = 0
+        self.schedule()
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    @property
+    def playing(self):
+        return self.timer is not None
+
+    def schedule(self):
+        self.timer = self.loop.call_at(self.start_time + self.events[self.index][0], self.play)
+
+    def play(self):
+        (t, kind, number, value) = self.events[self.index]
+        self.drift.record(self.loop.time() - (self.start_time + t))
+        if kind == SLIDER:
+            self.slider(number, value)
+        else:
+            self.button(number, value)
+
+        self.index += 1
+        if self.index < len(self.events):
+            self.schedule()
+            return
+
+        self.passes += 1
+        self.report()
+        if self.repeat:
+            # Next pass starts from when this one was due to end, not when it did
+            self.start_time += t + REPEAT_GAP
+            self.index = 0
+            self.schedule()
+        else:
+            self.finish()
+
+    def finish(self):
+        self.timer = None
+        if self.on_done:
+            self.on_done()
+
+    def report(self):
+        drift = self.drift
+        log.info("Macro pass %d: %d events, drift p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+            self.passes, len(self.events), drift.percentile(50) / 1000.0, drift.percentile(99) / 1000.0, drift.max / 1000.0))
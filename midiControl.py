@@ -2,198 +2,364 @@
 #
 # midiControl.py
 #
-"""Library for handling inputs from KORG Nanokontrol2"""
+"""Library for handling inputs from MIDI control surfaces (one or more), as described by profiles.py"""
 
 import logging
 import sys
-import time
 
 log = logging.getLogger("midi-logger")
 
-from rtmidi.midiutil import open_midiinput, open_midioutput
+# Surfaces opened by start(), in order
+_surfaces = []
 
-_pressed = [False] * 0xFF
-_midiout = None
-_midiin = None
+# Time between LEDs in an animation (in seconds)
+ANIMATION_STEP = 0.15
 
-class Button:
-
-    def __init__(self, control_number):
-        self.__set_control_number(control_number)
+# LED state not yet known
+UNKNOWN = 0xFF
 
-    ## getter methods
-    def __get_control_number(self):
-        return self.__control_number
+# Rows of per-channel buttons (Button.button) - S, M and R on the nanoKONTROL2
+SELECT_ROW = 2
+ACQUIRE_ROW = 3
+REVERSE_ROW = 4
 
-    def __get_channel(self):
-        return self.__channel
+# Status bytes (without the channel)
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
 
-    def __get_button(self):
-        return self.__button
+# Highest 14-bit value
+TOP_14BIT = 0x3FFF
 
-    ## setter methods
-    def __set_control_number(self, control_number):
-        self.__control_number = control_number
-        self.__channel = control_number % 0x10
-        self.__button = control_number // 0x10
-
-    def __set_channel(self, channel):
-        self.__channel = channel
-        self.__control_number == self.__channel + (self.__button * 0x10)
+class Button:
 
-    def __set_button(self, button):
-        self.__button = button
-        self.__control_number == self.__channel + (self.__button * 0x10)
+    __slots__ = ('control_number', 'channel', 'button')
 
-    control_number = property(__get_control_number, __set_control_number)
-    channel = property(__get_channel, __set_channel)
-    button = property(__get_button, __set_channel)
+    def __init__(self, control_number):
+        self.control_number = control_number
+        self.channel = control_number % 0x10
+        self.button = control_number // 0x10
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, Button):
             # don't attempt to compare against unrelated types
             return NotImplemented
 
         return self.control_number == other.control_number
 
+    def __hash__(self):
+        return self.control_number
+
+# One Button for every control number, so events don't need to create them
+BUTTONS = tuple(Button(n) for n in range(128))
+
+
+# One connected control surface
+class ControlSurface:
+
+    __slots__ = ('midiin', 'midiout', 'button_callback', 'slider_callback', 'slider_filter', 'pressed', 'profile',
+                 'dispatch', 'led_out', 'position', 'nrpn_param', 'nrpn_msb', 'nrpn_sliders',
+                 'leds', 'shown', 'dirty', 'loop', 'animations', 'led_messages', 'led_skipped')
+
+    # profile is a profiles.Profile, the nanoKONTROL2 if not given
+    def __init__(self, midiin, midiout, button_callback, slider_callback, profile=None):
+        self.midiin = midiin
+        self.midiout = midiout
+        self.button_callback = button_callback
+        self.slider_callback = slider_callback
+        # If set, fader values go through slider_filter.filter(channel, value) first,
+        # and are dropped if it returns None (see faderfilter.py)
+        self.slider_filter = None
+        self.pressed = [False] * 0xFF
+
+        # Where each relative encoder has got to
+        self.position = [0] * 16
+        # NRPN parameter selected and data MSB received on each MIDI channel
+        self.nrpn_param = [0] * 16
+        self.nrpn_msb = [0] * 16
+        self.use_profile(profile)
+
+        # LED framebuffer: what we want each LED to show, what the surface
+        # is showing, and which LEDs have changed since the last frame
+        self.leds = bytearray(128)
+        self.shown = bytearray([UNKNOWN] * 128)
+        self.dirty = set()
+        # Pending animation steps, by row
+        self.animations = {}
+        # Without an event loop, LEDs are sent straight away and animations aren't timed
+        self.loop = None
+
+        # Counters
+        self.led_messages = 0
+        self.led_skipped = 0
+
+    # Draw LED changes once per event loop iteration, and run animations on its timers
+    def use_loop(self, loop):
+        self.loop = loop
+
+    # Compile a profile into lookup tables, so handling an event is two list
+    # lookups whatever the surface. dispatch is indexed by status byte, then
+    # by control or note number, giving (action, argument) to call with the
+    # value. led_out gives (status, number, on value, off value) for each
+    # control number with an LED.
+    def use_profile(self, profile=None):
+        # Imported here as profiles builds its button names from this module
+        import profiles
+        if profile is None:
+            profile = profiles.DEFAULT
+        self.profile = profile
+        cc = [None] * 128
+        note_on = [None] * 128
+        note_off = [None] * 128
+        self.nrpn_sliders = {}
+        led_out = [None] * 128
+        encoders = {
+            profiles.TWOS_COMPLEMENT: self.trigger_encoder_twos_complement,
+            profiles.SIGNED_BIT: self.trigger_encoder_signed_bit,
+            profiles.OFFSET: self.trigger_encoder_offset,
+        }
+
+        for control in profile.controls:
+            if control.kind == profiles.NRPN:
+                self.nrpn_sliders[control.number] = control.index
+                continue
+            if control.target == profiles.SLIDER:
+                entry = (self.trigger_slider, control.index)
+            elif control.target == profiles.ENCODER:
+                entry = (encoders[control.relative], control.index)
+            else:
+                entry = (self.trigger_button, control.index)
+            if control.kind == profiles.NOTE:
+                note_on[control.number] = entry
+                note_off[control.number] = (self.trigger_release, control.index)
+                status = NOTE_ON
+            else:
+                cc[control.number] = entry
+                status = CONTROL_CHANGE
+            if control.led:
+                led_out[control.index] = (status | profile.led_channel, control.number, profile.led_on, profile.led_off)
+
+        dispatch = [None] * 256
+        channels = range(16) if profile.channel is None else (profile.channel,)
+        for channel in channels:
+            if self.nrpn_sliders:
+                # Each channel keeps its own NRPN state, so needs its own table
+                table = dispatch[CONTROL_CHANGE | channel] = list(cc)
+                table[profiles.NRPN_PARAM_MSB] = (self.trigger_nrpn_param_msb, channel)
+                table[profiles.NRPN_PARAM_LSB] = (self.trigger_nrpn_param_lsb, channel)
+                table[profiles.DATA_MSB] = (self.trigger_nrpn_data_msb, channel)
+                table[profiles.DATA_LSB] = (self.trigger_nrpn_data_lsb, channel)
+            elif any(cc):
+                dispatch[CONTROL_CHANGE | channel] = cc
+            if any(note_on):
+                dispatch[NOTE_ON | channel] = note_on
+                dispatch[NOTE_OFF | channel] = note_off
+        self.dispatch = dispatch
+        self.led_out = led_out
+
+    # Called when a slider value changes
+    def trigger_slider(self, channel, value):
+        if self.slider_filter:
+            value = self.slider_filter.filter(channel, value)
+            if value is None:
+                return
+        log.debug("Slider %d value %s", channel, value)
+        if (self.slider_callback):
+            self.slider_callback(channel, value)
+
+    # Called when a button is pressed or released
+    def trigger_button(self, control_number, value):
+        is_on = value > 0
+        self.pressed[control_number] = is_on
+
+        if (self.button_callback != None):
+            self.button_callback(BUTTONS[control_number], is_on)
+        else:
+            log.debug("No button call back function defined")
+
+    # Note off - the value is the release velocity, so isn't passed on
+    def trigger_release(self, control_number, value):
+        self.trigger_button(control_number, 0)
+
+    # Relative encoders send how far they've turned, in one of three encodings
+    def trigger_encoder_twos_complement(self, channel, value):
+        self.move_encoder(channel, value if value < 64 else value - 128)
+
+    def trigger_encoder_signed_bit(self, channel, value):
+        self.move_encoder(channel, value if value < 64 else 64 - value)
+
+    def trigger_encoder_offset(self, channel, value):
+        self.move_encoder(channel, value - 64)
+
+    # Turn an encoder's position into a slider value
+    def move_encoder(self, channel, delta):
+        position = min(max(self.position[channel] + delta, 0), 127)
+        if position != self.position[channel]:
+            self.position[channel] = position
+            self.trigger_slider(channel, position)
+
+    # NRPN: the parameter number comes in two halves, then the value as data
+    # entry MSB and LSB. The slider moves once the LSB arrives, to somewhere
+    # between 0 and 127 in steps of 1/129.
+    def trigger_nrpn_param_msb(self, midi_channel, value):
+        self.nrpn_param[midi_channel] = (value << 7) | (self.nrpn_param[midi_channel] & 0x7F)
+
+    def trigger_nrpn_param_lsb(self, midi_channel, value):
+        self.nrpn_param[midi_channel] = (self.nrpn_param[midi_channel] & 0x3F80) | value
+
+    def trigger_nrpn_data_msb(self, midi_channel, value):
+        self.nrpn_msb[midi_channel] = value
+
+    def trigger_nrpn_data_lsb(self, midi_channel, value):
+        channel = self.nrpn_sliders.get(self.nrpn_param[midi_channel])
+        if channel is not None:
+            self.trigger_slider(channel, ((self.nrpn_msb[midi_channel] << 7) | value) * 127 / TOP_14BIT)
+
+    # Is the specified button pressed?
+    def is_pressed(self, b):
+        return self.pressed[b.control_number]
+
+    # Animate LEDs - switch whole row on or off sequentially
+    def animate(self, row, led_on=True):
+        # A new animation on a row replaces any still running
+        for handle in self.animations.pop(row, []):
+            handle.cancel()
+        if led_on and self.loop:
+            self.animations[row] = [self.loop.call_later(i * ANIMATION_STEP, self.set_led, True, i, row) for i in range(8)]
+        else:
+            for i in range(8):
+                self.set_led(led_on, i, row)
+
+    # Set LED for specified button (drawn at the end of this frame)
+    def set_led(self, led_on, p1, p2 = None):
+        if (p2 == None):
+            control_number = p1.control_number
+        else:
+            control_number = p1 + (p2 * 0x10);
 
-# Called when a slider value changes
-def __trigger_slider(channel, value, slider_callback):
-    log.debug("Slider %d value %d" % (channel, value))
-    if (slider_callback):
-        slider_callback(channel, value)
-
-# Called when a button is pressed or released
-def __trigger_button(control_number, is_on, button_callback):
-
-    if (is_on):
-        _pressed[control_number] = True
-    else:
-        _pressed[control_number] = False
-
-    if (button_callback != None):
-        log.debug("Calling button callback function")
-        button = Button(control_number)
-        button_callback(button, is_on)
-    else:
-        log.debug("No button call back function defined")
-
-# Is the specified button pressed?
+        if (led_on):
+            self.leds[control_number] = 127
+        else:
+            self.leds[control_number] = 0
+
+        if not self.dirty and self.loop:
+            self.loop.call_soon(self.show)
+        self.dirty.add(control_number)
+        if not self.loop:
+            self.show()
+
+    # Send the LEDs that have changed since the last frame
+    def show(self):
+        leds = self.leds
+        shown = self.shown
+        led_out = self.led_out
+        for control_number in self.dirty:
+            value = leds[control_number]
+            if shown[control_number] == value:
+                # Changed and changed back, or already showing
+                self.led_skipped += 1
+                continue
+            shown[control_number] = value
+            out = led_out[control_number]
+            if out is None:
+                # No LED for this button on this surface
+                continue
+            self.midiout.send_message([out[0], out[1], out[2] if value else out[3]])
+            self.led_messages += 1
+        self.dirty.clear()
+
+    # Hand LEDs back to the surface and close the MIDI ports
+    def cleanup(self):
+        for handles in self.animations.values():
+            for handle in handles:
+                handle.cancel()
+        self.animations.clear()
+
+        # e.g. change LEDs back to internal control
+        for message in self.profile.cleanup:
+            self.midiout.send_message(list(message))
+
+        log.debug("Closing midi device")
+        self.midiin.close_port()
+        self.midiout.close_port()
+
+
+# Is the specified button pressed? (first surface)
 def is_pressed(b):
-    log.debug("Checking whether %d %d is pressed" % (b.channel, b.button))
-    return _pressed[b.control_number]
+    return _surfaces[0].is_pressed(b)
 
-# Animate LEDs - switch whole row on or off sequentially
+# Animate LEDs on first surface
 def animate(row, led_on=True):
-    if (led_on):
-        val = 127
-    else:
-        val = 0
-    for i in range(8):
-        control_number = i + (row *0x10)
-        led = [0xBF, control_number, val]
-        log.debug("LED %r" %led)
-        _midiout.send_message(led)
-        if (led_on):
-            time.sleep(0.15)
+    _surfaces[0].animate(row, led_on)
 
-# Set LED for specified button
+# Set LED for specified button on first surface
 def set_led(led_on, p1, p2 = None):
-    if (p2 == None):
-        control_number = p1.control_number
-    else:
-        control_number = p1 + (p2 * 0x10);
+    _surfaces[0].set_led(led_on, p1, p2)
 
-    if (led_on):
-        led = [0xBF, control_number, 127]
-    else:
-        led = [0xBF, control_number, 0]
-    _midiout.send_message(led)
+# Connect MIDI device, returns its ControlSurface. profile is a
+# profiles.Profile, the nanoKONTROL2 if not given.
+def start(port, button_callback, slider_callback, profile=None):
 
-# Connect MIDI device
-def start(port, button_callback, slider_callback):
+    # Imported here so the rest of the module works without a MIDI backend
+    from rtmidi.midiutil import open_midiinput, open_midioutput
 
-    global _midiout, _midiin, _button_callback, _slider_callback
     log = logging.getLogger('midiin_poll')
     logging.basicConfig(level=logging.DEBUG)
 
-    _button_callback = button_callback
-    _slider_callback = slider_callback
-
     try:
-        _midiin, port_in = open_midiinput(port)
+        midiin, port_in = open_midiinput(port)
     except (EOFError, KeyboardInterrupt):
         sys.exit()
 
     try:
-        _midiout, port_out = open_midioutput(port)
+        midiout, port_out = open_midioutput(port)
     except (EOFError, KeyboardInterrupt):
         sys.exit()
 
-    # Change LED modes
-    led_external = [0xf0, 0x42, 0x40, 0x00, 0x01, 0x13, 0x00, 0x00, 0x00, 0x01, 0xf7]
+    surface = ControlSurface(midiin, midiout, button_callback, slider_callback, profile)
+    _surfaces.append(surface)
 
-    # Change LEDs to external control for Korg
-    _midiout.send_message(led_external)
+    # e.g. change LEDs to external control for Korg
+    for message in surface.profile.init:
+        midiout.send_message(list(message))
 
-    _midiin.set_callback(handler)
+    midiin.set_callback(handler, surface)
+    return surface
 
- 
-def handler(msg, data):
 
-    global _button_callback, _slider_callback
-    message, delta = msg
+# rtmidi callback - data is the ControlSurface the message came from
+def handler(msg, surface):
 
-    #log.debug("%X %X %X" % (message[0],message[1],message[2]))
-    try:
-        status_byte = message[0]
-    except IndexError:
-        return
+    message = msg[0]
 
-    if (status_byte >= 0xB0 and status_byte <= 0xBF):
-        # Control change message received
-
-        try:
-            control_number = message[1]
-            value = message[2]
-        except IndexError:
-            return
-
-        # Check for fader slide
-        if (control_number <= 0xF):
-            __trigger_slider(control_number, value, _slider_callback)
-
-        if (control_number >= 0x20 and control_number <= 0x50):
+    # Only three byte messages are used (SysEx and clock are dropped here)
+    if len(message) != 3:
+        return
 
-            if (value > 0):
-                __trigger_button(control_number, True, _button_callback)
-            else:
-                __trigger_button(control_number, False, _button_callback)
+    table = surface.dispatch[message[0]]
+    if table:
+        entry = table[message[1]]
+        if entry:
+            entry[0](entry[1], message[2])
 
 
+# Close all surfaces
 def cleanup():
 
-    global _midiout, _midiin
-    led_internal = [0xf0, 0x42, 0x40, 0x00, 0x01, 0x13, 0x00, 0x00, 0x00, 0x00, 0xf7]
-
-    # Change LEDs back to internal control
-    _midiout.send_message(led_internal)
-
-    log.debug("Closing midi device")
-    _midiin.close_port()
-    _midiout.close_port()
-    del _midiin
-    del _midiout
-
-
-CYCLE_BUTTON = Button(0x2E)
-SET_BUTTON = Button(0x3C)
-TRACK_L_BUTTON = Button(0x3A)
-TRACK_R_BUTTON = Button(0x3B)
-MARKER_L_BUTTON = Button(0x3D)
-MARKER_R_BUTTON = Button(0x3E)
-RW_BUTTON = Button(0x2B)
-FF_BUTTON = Button(0x2C)
-STOP_BUTTON = Button(0x2A)
-PLAY_BUTTON = Button(0x29)
-REC_BUTTON = Button(0x2D)
+    while _surfaces:
+        _surfaces.pop().cleanup()
+
+
+CYCLE_BUTTON = BUTTONS[0x2E]
+SET_BUTTON = BUTTONS[0x3C]
+TRACK_L_BUTTON = BUTTONS[0x3A]
+TRACK_R_BUTTON = BUTTONS[0x3B]
+MARKER_L_BUTTON = BUTTONS[0x3D]
+MARKER_R_BUTTON = BUTTONS[0x3E]
+RW_BUTTON = BUTTONS[0x2B]
+FF_BUTTON = BUTTONS[0x2C]
+STOP_BUTTON = BUTTONS[0x2A]
+PLAY_BUTTON = BUTTONS[0x29]
+REC_BUTTON = BUTTONS[0x2D]
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# midirecord.py
+#
+"""Record and replay MIDI event streams, and virtual ports to replay them into"""
+
+import asyncio
+import json
+import logging
+import time
+
+import midiControl
+
+log = logging.getLogger("midirecord-logger")
+
+# Stands in for an rtmidi port. Messages sent to it are counted and kept.
+class VirtualPort:
+
+    def __init__(self, keep=1000):
+        self.sent = []
+        self.count = 0
+        self.keep = keep
+        self.callback = None
+        self.data = None
+
+    def send_message(self, message):
+        self.count += 1
+        if len(self.sent) < self.keep:
+            self.sent.append(list(message))
+
+    def set_callback(self, callback, data=None):
+        self.callback = callback
+        self.data = data
+
+    def close_port(self):
+        pass
+
+# Drop-in for midiControl.start that opens a surface on virtual ports
+def virtual_start(port, button_callback, slider_callback, profile=None):
+    surface = midiControl.ControlSurface(VirtualPort(), VirtualPort(), button_callback, slider_callback, profile)
+    midiControl._surfaces.append(surface)
+    surface.midiin.set_callback(midiControl.handler, surface)
+    return surface
+
+# Sits between rtmidi and the handler, keeping every event with its time
+class Recorder:
+
+    def __init__(self, surface, callback=midiControl.handler):
+        self.surface = surface
+        self.callback = callback
+        self.events = []
+        self.start = time.monotonic()
+        surface.midiin.set_callback(self.handler, surface)
+
+    def handler(self, msg, surface):
+        self.events.append((time.monotonic() - self.start, list(msg[0])))
+        self.callback(msg, surface)
+
+    def save(self, filename):
+        save(self.events, filename)
+
+# Events are stored one per line: {"t": seconds from start, "msg": [bytes]}
+def save(events, filename):
+    with open(filename, 'w') as f:
+        for (t, message) in events:
+            f.write(json.dumps({"t": round(t, 6), "msg": message}) + "\n")
+
+def load(filename):
+    events = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                events.append((event["t"], event["msg"]))
+    return events
+
+# Feed events to the handler for surface, in real time (scaled by speed)
+# or as fast as possible if speed is None
+async def replay(events, surface, speed=1.0, handler=midiControl.handler):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    last = 0
+    for (t, message) in events:
+        if speed:
+            wait = start + t / speed - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        handler((message, t - last), surface)
+        last = t
+
+# Scripted sessions
+
+# Press and release a button
+def press(control_number, t):
+    return [(t, [0xB0, control_number, 127]), (t + 0.05, [0xB0, control_number, 0])]
+
+# Take control of the locos on the first channels sliders
+def acquire(channels, t=0):
+    events = []
+    for channel in range(channels):
+        events += press(0x30 + channel, t + channel * 0.1)
+    return events
+
+# Faders moving from 0 to 127 and back together, one value every interval
+def fader_sweep(channels=8, sweeps=1, interval=0.002, t=0):
+    events = []
+    values = list(range(128)) + list(range(127, -1, -1))
+    for sweep in range(sweeps):
+        for value in values:
+            for channel in range(channels):
+                events.append((t, [0xB0, channel, value]))
+            t += interval
+    return events
+
+# Stop button pressed over and over with no loco selected
+def stop_storm(presses=50, interval=0.02, t=0):
+    events = []
+    for i in range(presses):
+        events += press(midiControl.STOP_BUTTON.control_number, t + i * interval)
+    return sorted(events)
+
+# Faders resting on a value boundary, flickering between two values, then
+# each moved to a new resting place and flickering there
+def fader_jitter(channels=8, seconds=2.0, interval=0.01, t=0):
+    events = []
+    steps = int(seconds / interval)
+    for channel in range(channels):
+        value = 20 + channel * 10
+        for step in range(steps):
+            if step == steps // 2:
+                # A real move
+                for v in range(value, value + 6):
+                    events.append((t + step * interval, [0xB0, channel, v]))
+                value += 5
+            events.append((t + step * interval + channel * 0.001, [0xB0, channel, value + step % 2]))
+    return sorted(events)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# midiworker.py
+#
+"""Run each surface's MIDI in its own process, passing events to the throttle through shared memory"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import midiControl
+import faderfilter
+import ringbuffer
+import stats
+
+log = logging.getLogger("midiworker-logger")
+
+# Event kinds in the rings
+SLIDER = 1
+BUTTON = 2
+MIDI = 3
+
+# Records in each ring
+CAPACITY = 4096
+
+# Seconds a worker waits before trying again when the throttle has fallen a
+# whole ring behind. Events are never dropped: a fader's last value matters.
+FULL_WAIT = 0.0005
+
+# Seconds to wait for a worker to hand its surface back before killing it
+JOIN_TIMEOUT = 2.0
+
+# Workers are started fresh rather than forked from a process with threads and an event loop
+_context = multiprocessing.get_context("spawn")
+
+# Wake the other side: one byte down a pipe. If the pipe is full it has plenty to wake up for already.
+def ring(bell):
+    try:
+        os.write(bell, b"\0")
+    except BlockingIOError:
+        pass
+
+# Worker side: the surface's callbacks, which put its events in the ring
+class EventSender:
+
+    def __init__(self, events, bell):
+        self.events = events
+        self.bell = bell
+
+    def slider(self, channel, value):
+        self.send(SLIDER, channel, 0, value)
+
+    def button(self, button, is_on):
+        self.send(BUTTON, button.control_number, is_on, 0.0)
+
+    def send(self, kind, a, b, value):
+        t = time.perf_counter()
+        while not self.events.put(kind, a, b, 0, t, value):
+            ring(self.bell)
+            time.sleep(FULL_WAIT)
+        ring(self.bell)
+
+# Worker process: open the surface on port and handle its MIDI here, with the
+# fader filter if given. LED messages from the throttle arrive in the leds ring.
+# start opens the surface (midirecord.virtual_start runs without hardware);
+# feed, if given, is called with the surface on a thread of its own, standing
+# in for MIDI input.
+def main(port, profile, fader_filter, events_name, leds_name, events_bell, leds_bell, start=midiControl.start, feed=None):
+    # Ctrl-C is for the throttle, which closes workers down in turn
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    events = ringbuffer.Ring(events_name)
+    leds = ringbuffer.Ring(leds_name)
+    sender = EventSender(events, events_bell.fileno())
+    os.set_blocking(events_bell.fileno(), False)
+
+    surface = start(port, sender.button, sender.slider, profile)
+    if fader_filter is not None:
+        surface.slider_filter = faderfilter.FaderFilter(**fader_filter)
+    if feed is not None:
+        threading.Thread(target=feed, args=(surface,), daemon=True).start()
+
+    send = lambda kind, a, b, c, t, value: surface.midiout.send_message([a, b, c])
+    wait = leds_bell.fileno()
+    try:
+        # Until the throttle closes its end of the LED bell
+        while os.read(wait, 4096):
+            leds.drain(send)
+    finally:
+        leds.drain(send)
+        surface.cleanup()
+        events.close()
+        leds.close()
+        if surface.slider_filter:
+            log.debug("Port %s: %d fader events suppressed", port, surface.slider_filter.suppressed)
+
+# Throttle side: stands in for both rtmidi ports of a surface whose MIDI is
+# handled by a worker. Events from the worker are passed to the surface's
+# callbacks on the event loop; LED messages are passed to the worker.
+class WorkerPorts:
+
+    def __init__(self, loop, port, profile, fader_filter, start, feed):
+        self.loop = loop
+        self.port = port
+        self.surface = None
+        self.events = ringbuffer.Ring(capacity=CAPACITY)
+        self.leds = ringbuffer.Ring(capacity=CAPACITY)
+        (self.events_wait, events_bell) = _context.Pipe(duplex=False)
+        (leds_wait, self.leds_bell) = _context.Pipe(duplex=False)
+        self.process = _context.Process(target=main, name="midi-%s" % port, daemon=True,
+            args=(port, profile, fader_filter, self.events.name, self.leds.name, events_bell, leds_wait, start, feed))
+        self.process.start()
+        # The worker has its own copies now
+        events_bell.close()
+        leds_wait.close()
+        os.set_blocking(self.leds_bell.fileno(), False)
+        os.set_blocking(self.events_wait.fileno(), False)
+        loop.add_reader(self.events_wait.fileno(), self.ready)
+        self.closed = False
+
+    # LED messages go to the worker. Anything longer (the profile's init and
+    # cleanup SysEx) is sent by the worker itself. The event loop can't wait
+    # for room, so a worker a whole ring behind misses LED changes.
+    def send_message(self, message):
+        if self.closed or len(message) > 3:
+            return
+        if self.leds.put(MIDI, message[0], message[1], message[2], 0.0, 0.0):
+            ring(self.leds_bell.fileno())
+
+    # The worker runs the MIDI handler
+    def set_callback(self, callback, data=None):
+        pass
+
+    # Called by the event loop when the worker has rung
+    def ready(self):
+        try:
+            if not os.read(self.events_wait.fileno(), 4096):
+                log.error("MIDI worker for port %s has stopped", self.port)
+                self.loop.remove_reader(self.events_wait.fileno())
+        except BlockingIOError:
+            pass
+        self.events.drain(self.event)
+
+    def event(self, kind, a, b, c, t, value):
+        if stats.enabled:
+            stats.record('bridge', time.perf_counter() - t)
+        if kind == SLIDER:
+            # Whole steps stay ints, as they are in a single process
+            self.surface.slider_callback(a, int(value) if value.is_integer() else value)
+        elif kind == BUTTON:
+            self.surface.trigger_button(a, b)
+
+    # Stop the worker and free the rings. Called for both ports, so only acts once.
+    def close_port(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.events_wait.fileno())
+        self.leds_bell.close()
+        self.process.join(JOIN_TIMEOUT)
+        if self.process.is_alive():
+            log.warning("MIDI worker for port %s didn't stop, killing it", self.port)
+            self.process.kill()
+            self.process.join()
+        self.events_wait.close()
+        if self.events.full:
+            log.info("MIDI worker for port %s waited for the throttle %d times", self.port, self.events.full)
+        self.events.close()
+        self.leds.close()
+
+# Drop-in for midiControl.start that handles the surface's MIDI in a worker
+# process. Must be called on the event loop the callbacks should run on.
+# fader_filter is a dict of faderfilter.FaderFilter settings, applied in the
+# worker; worker_start and feed are passed to the worker as start and feed
+# (see main).
+def start(port, button_callback, slider_callback, profile=None, fader_filter=None, worker_start=midiControl.start, feed=None):
+    ports = WorkerPorts(asyncio.get_running_loop(), port, profile, fader_filter, worker_start, feed)
+    surface = midiControl.ControlSurface(ports, ports, button_callback, slider_callback, profile)
+    ports.surface = surface
+    midiControl._surfaces.append(surface)
+    return surface
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# momentum.py
+#
+"""Simulated inertia and braking: ease each loco's speed towards its slider"""
+
+import logging
+
+log = logging.getLogger("momentum-logger")
+
+# How often moving locos are stepped (per second)
+RATE = 20
+
+class Momentum:
+
+    # send(channel, speed) is called whenever a channel's speed reaches a new
+    # whole speed step. All channels are stepped together on one timer, which
+    # only runs while something is moving.
+    def __init__(self, loop, send, channels=8, rate=RATE):
+        self.loop = loop
+        self.send = send
+        self.step_time = 1.0 / rate
+
+        # Where each channel is heading, where it is, and what was last sent
+        self.target = [0] * channels
+        self.current = [0.0] * channels
+        self.emitted = [0] * channels
+        # Speed steps per step_time when speeding up and slowing down (0 means no momentum)
+        self.acceleration = [0.0] * channels
+        self.braking = [0.0] * channels
+        self.timer = None
+
+        # Counters
+        self.steps = 0
+        self.emits = 0
+        self.skipped = 0
+
+    # Set how fast a channel can speed up and slow down, in speed steps per second.
+    # Either being None means that direction changes straight away.
+    def configure(self, channel, acceleration=None, braking=None):
+        self.acceleration[channel] = (acceleration or 0) * self.step_time
+        self.braking[channel] = (braking or 0) * self.step_time
+
+    # Speed last sent for a channel
+    def speed(self, channel):
+        return self.emitted[channel]
+
+    # Slider has moved - head for speed
+    def set_target(self, channel, speed):
+        self.target[channel] = speed
+        if speed > self.current[channel]:
+            rate = self.acceleration[channel]
+        else:
+            rate = self.braking[channel]
+        if not rate:
+            self.current[channel] = speed
+            self._emit(channel, speed)
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.step_time, self._step)
+
+    # Stop channel dead, e.g. emergency stop or loco released. Nothing is
+    # sent - the caller has already told the server.
+    def halt(self, channel):
+        self.target[channel] = 0
+        self.current[channel] = 0.0
+        self.emitted[channel] = 0
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    # Move every channel one step towards its target
+    def _step(self):
+        self.timer = None
+        self.steps += 1
+        moving = False
+        current = self.current
+        for (channel, (target, speed, up, down)) in enumerate(zip(self.target, current, self.acceleration, self.braking)):
+            if speed == target:
+                continue
+            if target > speed:
+                speed = min(target, speed + up) if up else target
+            else:
+                speed = max(target, speed - down) if down else target
+            current[channel] = speed
+            if speed != target:
+                moving = True
+
+            step = int(round(speed))
+            if step != self.emitted[channel]:
+                self._emit(channel, step)
+            else:
+                self.skipped += 1
+
+        if moving:
+            self.timer = self.loop.call_later(self.step_time, self._step)
+
+    def _emit(self, channel, speed):
+        self.emitted[channel] = speed
+        self.emits += 1
+        self.send(channel, speed)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# profiles.py
+#
+"""Control surface profiles: which MIDI messages are which sliders and buttons"""
+
+import json
+import logging
+
+import midiControl
+
+log = logging.getLogger("profiles-logger")
+
+# MIDI message types a control can send
+CC = 'cc'
+NOTE = 'note'
+NRPN = 'nrpn'
+
+# What a control drives
+SLIDER = 'slider'
+BUTTON = 'button'
+ENCODER = 'encoder'
+
+# How relative encoders send a move: TWOS_COMPLEMENT 1 up, 127 down;
+# SIGNED_BIT 1 up, 65 down; OFFSET 65 up, 63 down
+TWOS_COMPLEMENT = 'twos-complement'
+SIGNED_BIT = 'signed-bit'
+OFFSET = 'offset'
+RELATIVE = (TWOS_COMPLEMENT, SIGNED_BIT, OFFSET)
+
+# Control changes that carry NRPN parameter numbers and values
+NRPN_PARAM_MSB = 99
+NRPN_PARAM_LSB = 98
+DATA_MSB = 6
+DATA_LSB = 38
+
+# Buttons a profile can map to, by name. The throttle works in terms of the
+# nanoKONTROL2's control numbers, so these are what every surface's buttons
+# turn into.
+BUTTONS = {
+    'cycle': midiControl.CYCLE_BUTTON.control_number,
+    'set': midiControl.SET_BUTTON.control_number,
+    'track_l': midiControl.TRACK_L_BUTTON.control_number,
+    'track_r': midiControl.TRACK_R_BUTTON.control_number,
+    'marker_l': midiControl.MARKER_L_BUTTON.control_number,
+    'marker_r': midiControl.MARKER_R_BUTTON.control_number,
+    'rw': midiControl.RW_BUTTON.control_number,
+    'ff': midiControl.FF_BUTTON.control_number,
+    'stop': midiControl.STOP_BUTTON.control_number,
+    'play': midiControl.PLAY_BUTTON.control_number,
+    'rec': midiControl.REC_BUTTON.control_number,
+}
+for (row, prefix) in ((midiControl.SELECT_ROW, 's'), (midiControl.ACQUIRE_ROW, 'm'), (midiControl.REVERSE_ROW, 'r')):
+    for channel in range(8):
+        BUTTONS["%s%d" % (prefix, channel)] = channel + row * 0x10
+
+# One control on a surface: the message it sends (kind and number), what it
+# drives (target, and the slider channel or button control number), how it
+# encodes moves if it's a relative encoder, and whether it has an LED
+class Control:
+
+    __slots__ = ('kind', 'number', 'target', 'index', 'relative', 'led')
+
+    def __init__(self, kind, number, target, index, relative=None, led=False):
+        self.kind = kind
+        self.number = number
+        self.target = target
+        self.index = index
+        self.relative = relative
+        self.led = led
+
+# Everything needed to drive one model of surface
+class Profile:
+
+    def __init__(self, name, controls, channel=None, led_channel=None, led_on=127, led_off=0, init=(), cleanup=()):
+        self.name = name
+        self.controls = controls
+        # MIDI channel the surface sends on (0-15), or None for any
+        self.channel = channel
+        # MIDI channel LED messages are sent on
+        if led_channel is None:
+            led_channel = channel or 0
+        self.led_channel = led_channel
+        # Values that turn an LED on and off
+        self.led_on = led_on
+        self.led_off = led_off
+        # Messages (usually SysEx) to send when the surface is opened and closed
+        self.init = init
+        self.cleanup = cleanup
+
+def _number(value, what, top=127):
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= top:
+        raise ValueError("Invalid %s %r" % (what, value))
+    return value
+
+def _channel(value, what):
+    if value is None:
+        return None
+    # Channels are numbered 1-16 in profiles, as on the surfaces themselves
+    return _number(value, what, 16) - 1
+
+def _messages(messages, what):
+    if not isinstance(messages, list) or not all(isinstance(message, list) for message in messages):
+        raise ValueError("%s must be a list of messages" % what)
+    return tuple(tuple(_number(byte, "byte in %s" % what, 255) for byte in message) for message in messages)
+
+def _control(entry):
+    if not isinstance(entry, dict):
+        raise ValueError("Controls must be objects")
+    kinds = [kind for kind in (CC, NOTE, NRPN) if kind in entry]
+    targets = [target for target in (SLIDER, BUTTON, ENCODER) if target in entry]
+    if len(kinds) != 1:
+        raise ValueError("Give one of cc, note or nrpn for each control")
+    if len(targets) != 1:
+        raise ValueError("Give one of slider, button or encoder for each control")
+    kind = kinds[0]
+    target = targets[0]
+    number = _number(entry[kind], kind, 0x3FFF if kind == NRPN else 127)
+
+    relative = None
+    if target == BUTTON:
+        name = entry[BUTTON]
+        if name not in BUTTONS:
+            raise ValueError("Unknown button %r" % (name,))
+        index = BUTTONS[name]
+        if kind == NRPN:
+            raise ValueError("Buttons can't send NRPN")
+    else:
+        index = _number(entry[target], target, 7)
+        if target == ENCODER:
+            relative = entry.get('relative', TWOS_COMPLEMENT)
+            if relative not in RELATIVE:
+                raise ValueError("Unknown relative encoding %r" % (relative,))
+            if kind != CC:
+                raise ValueError("Encoders must send control changes")
+    led = bool(entry.get('led', False))
+    if led and target != BUTTON:
+        raise ValueError("Only buttons can have LEDs")
+    return Control(kind, number, target, index, relative, led)
+
+# Check and compile a profile as loaded from JSON. Raises ValueError if it isn't valid.
+def parse(profile):
+    if not isinstance(profile, dict):
+        raise ValueError("Profile must be an object")
+    controls = profile.get('controls')
+    if not isinstance(controls, list) or not controls:
+        raise ValueError("Profile has no controls")
+    controls = [_control(entry) for entry in controls]
+
+    # Each message can only mean one thing, and with NRPN controls the
+    # control changes that carry NRPN are taken
+    seen = set()
+    nrpn = any(control.kind == NRPN for control in controls)
+    for control in controls:
+        if nrpn and control.kind == CC and control.number in (NRPN_PARAM_MSB, NRPN_PARAM_LSB, DATA_MSB, DATA_LSB):
+            raise ValueError("Control change %d is used by NRPN" % control.number)
+        message = (control.kind, control.number)
+        if message in seen:
+            raise ValueError("More than one control for %s %d" % message)
+        seen.add(message)
+
+    led_on = _number(profile.get('led_on', 127), "LED on value")
+    led_off = _number(profile.get('led_off', 0), "LED off value")
+    return Profile(str(profile.get('name', "")), controls, _channel(profile.get('channel'), "channel"),
+                   _channel(profile.get('led_channel'), "LED channel"), led_on, led_off,
+                   _messages(profile.get('init', []), "init"), _messages(profile.get('cleanup', []), "cleanup"))
+
+# Korg nanoKONTROL2 with its factory settings. LEDs are put under our control
+# while it's open, and handed back afterwards.
+NANOKONTROL2 = {
+    'name': "Korg nanoKONTROL2",
+    'led_channel': 16,
+    'init': [[0xf0, 0x42, 0x40, 0x00, 0x01, 0x13, 0x00, 0x00, 0x00, 0x01, 0xf7]],
+    'cleanup': [[0xf0, 0x42, 0x40, 0x00, 0x01, 0x13, 0x00, 0x00, 0x00, 0x00, 0xf7]],
+    'controls': [{'cc': channel, 'slider': channel} for channel in range(8)] +
+                [{'cc': number, 'button': name, 'led': True} for (name, number) in sorted(BUTTONS.items())],
+}
+
+# Behringer X-Touch Mini in standard mode. Layer A drives locos: the knobs are
+# the throttles, pushing a knob selects its loco, the top row of buttons takes
+# control and the bottom row reverses. Layer B's buttons are the transport
+# buttons.
+XTOUCH_MINI = {
+    'name': "Behringer X-Touch Mini",
+    'channel': 11,
+    'led_on': 1,
+    'controls': [{'cc': channel + 1, 'slider': channel} for channel in range(8)] +
+                [{'note': channel, 'button': "s%d" % channel} for channel in range(8)] +
+                [{'note': channel + 8, 'button': "m%d" % channel, 'led': True} for channel in range(8)] +
+                [{'note': channel + 16, 'button': "r%d" % channel, 'led': True} for channel in range(8)] +
+                [{'note': 32 + i, 'button': name, 'led': True} for (i, name) in enumerate(
+                    ("stop", "cycle", "rec", "play", "rw", "ff", "track_l", "track_r", "set", "marker_l", "marker_r"))],
+}
+
+# The same, with the knobs set to relative mode in the X-Touch editor, so a
+# knob carries on from wherever its loco's speed was left
+XTOUCH_MINI_RELATIVE = dict(XTOUCH_MINI)
+XTOUCH_MINI_RELATIVE['name'] = "Behringer X-Touch Mini (relative knobs)"
+XTOUCH_MINI_RELATIVE['controls'] = ([{'cc': channel + 1, 'encoder': channel, 'relative': TWOS_COMPLEMENT} for channel in range(8)] +
+                                   XTOUCH_MINI['controls'][8:])
+
+# Akai LPD8 on program 1. Knobs 1-7 are throttles, pads 1-7 take control of
+# their locos, and pad 8 is stop. The pads' LEDs can't be set from outside.
+LPD8 = {
+    'name': "Akai LPD8",
+    'channel': 1,
+    'controls': [{'cc': channel + 1, 'slider': channel} for channel in range(7)] +
+                [{'note': channel + 36, 'button': "m%d" % channel} for channel in range(7)] +
+                [{'note': 43, 'button': "stop"}],
+}
+
+# Novation Launch Control on factory template 1. The bottom row of knobs are
+# throttles, the pads take control (lit green while held), and the arrow
+# buttons are power, stop and the two function shift keys.
+LAUNCH_CONTROL = {
+    'name': "Novation Launch Control",
+    'channel': 9,
+    'led_on': 0x3C,
+    'led_off': 0x0C,
+    'controls': [{'cc': channel + 41, 'slider': channel} for channel in range(8)] +
+                [{'note': number, 'button': "m%d" % channel, 'led': True} for (channel, number) in enumerate((9, 10, 11, 12, 25, 26, 27, 28))] +
+                [{'cc': 114, 'button': "cycle"}, {'cc': 115, 'button': "stop"},
+                 {'cc': 116, 'button': "track_l"}, {'cc': 117, 'button': "track_r"}],
+}
+
+BUILT_IN = {
+    'nanokontrol2': NANOKONTROL2,
+    'xtouch-mini': XTOUCH_MINI,
+    'xtouch-mini-relative': XTOUCH_MINI_RELATIVE,
+    'lpd8': LPD8,
+    'launch-control': LAUNCH_CONTROL,
+}
+
+DEFAULT = parse(NANOKONTROL2)
+
+# A built-in profile by name, or a JSON profile file.
+# Raises OSError or ValueError if it can't be read or isn't valid.
+def load(name):
+    if name in BUILT_IN:
+        return parse(BUILT_IN[name])
+    with open(name, 'r') as f:
+        profile = parse(json.load(f))
+    log.debug("Loaded profile %s from %s" % (profile.name, name))
+    return profile
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# ringbuffer.py
+#
+"""Fixed-size records passed from one process to another through shared memory"""
+
+import logging
+import struct
+from multiprocessing import shared_memory
+
+log = logging.getLogger("ringbuffer-logger")
+
+# Header: records written so far (only the writer changes it), records read so
+# far (only the reader), each on its own cache line, then the capacity and
+# how many times the writer has found the ring full
+HEAD = 0
+TAIL = 64
+CAPACITY = 128
+FULL = 136
+HEADER = 192
+INDEX = struct.Struct("<Q")
+
+# Record: sequence number, kind, three bytes, a time (time.perf_counter(),
+# which is the same clock in every process) and a value
+RECORD = struct.Struct("<IBBBBdd")
+
+# Single writer, single reader. The writer fills in a record, then moves the
+# head on; the reader checks each record's sequence number as well, so a
+# record whose head has been seen before its contents is left for next time.
+class Ring:
+
+    # Create a ring (capacity must be a power of two), or attach to the one called name
+    def __init__(self, name=None, capacity=4096):
+        if name is None:
+            if capacity & (capacity - 1):
+                raise ValueError("Capacity must be a power of two")
+            self.shm = shared_memory.SharedMemory(create=True, size=HEADER + capacity * RECORD.size)
+            INDEX.pack_into(self.shm.buf, CAPACITY, capacity)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.buf = self.shm.buf
+        self.name = self.shm.name
+        self.capacity = INDEX.unpack_from(self.buf, CAPACITY)[0]
+        self.mask = self.capacity - 1
+        # This side's own copy of the index it moves on
+        self.head = INDEX.unpack_from(self.buf, HEAD)[0]
+        self.tail = INDEX.unpack_from(self.buf, TAIL)[0]
+
+    @property
+    def full(self):
+        return INDEX.unpack_from(self.buf, FULL)[0]
+
+    # Writer: add a record. Returns False, and counts it, if the ring is full.
+    def put(self, kind, a, b, c, t, value):
+        buf = self.buf
+        head = self.head
+        if head - INDEX.unpack_from(buf, TAIL)[0] >= self.capacity:
+            INDEX.pack_into(buf, FULL, INDEX.unpack_from(buf, FULL)[0] + 1)
+            return False
+        RECORD.pack_into(buf, HEADER + (head & self.mask) * RECORD.size, head & 0xFFFFFFFF, kind, a, b, c, t, value)
+        self.head = head = head + 1
+        INDEX.pack_into(buf, HEAD, head)
+        return True
+
+    # Reader: call callback(kind, a, b, c, t, value) for each record waiting.
+    # Returns how many there were.
+    def drain(self, callback):
+        buf = self.buf
+        mask = self.mask
+        size = RECORD.size
+        head = INDEX.unpack_from(buf, HEAD)[0]
+        tail = start = self.tail
+        while tail < head:
+            (sequence, kind, a, b, c, t, value) = RECORD.unpack_from(buf, HEADER + (tail & mask) * size)
+            if sequence != tail & 0xFFFFFFFF:
+                break
+            tail += 1
+            callback(kind, a, b, c, t, value)
+        self.tail = tail
+        INDEX.pack_into(buf, TAIL, tail)
+        return tail - start
+
+    # Detach, and remove the shared memory if this side created it
+    def close(self):
+        if self.buf is None:
+            return
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
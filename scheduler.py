@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# scheduler.py
+#
+"""Coalesce slider movements into as few speed messages as possible"""
+
+import logging
+
+log = logging.getLogger("scheduler-logger")
+
+# How long a speed echo from the server can lag behind a speed we sent (in seconds)
+ACK_WINDOW = 1.0
+
+NEVER = float('-inf')
+
+class SpeedScheduler:
+
+    # send(id, speed) is called to put a speed on the wire. interval is the
+    # latency budget: the longest a new slider position waits to be sent,
+    # and the shortest time between two sends for the same loco. If given,
+    # drop(id) is called when a new position for a loco won't be sent after
+    # all (the server already has that speed, or the loco was reset).
+    def __init__(self, loop, send, interval, max_speed, drop=None):
+        self.loop = loop
+        self.send = send
+        self.drop = drop
+        self.interval = interval
+        self.max_speed = max_speed
+
+        # Speed the server has, or will have once our last send arrives
+        self.known = {}
+        # Latest position waiting for the interval to pass
+        self.pending = {}
+        self.timers = {}
+        self.sent_at = {}
+
+        # Counters
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    # Slider for loco has moved
+    def update(self, id, speed):
+        if speed > self.max_speed:
+            speed = self.max_speed
+
+        # Already waiting to send for this loco - just replace the value
+        if id in self.timers:
+            self.pending[id] = speed
+            self.coalesced += 1
+            return
+
+        if self.known.get(id) == speed:
+            self.dropped += 1
+            if self.drop:
+                self.drop(id)
+            return
+
+        # Idle loco goes straight out, otherwise wait for the rest of the interval
+        wait = self.sent_at.get(id, NEVER) + self.interval - self.loop.time()
+        if wait <= 0:
+            self._send(id, speed)
+        else:
+            self.pending[id] = speed
+            self.timers[id] = self.loop.call_later(wait, self._flush, id)
+
+    # Interval has passed - send the resting position
+    def _flush(self, id):
+        del self.timers[id]
+        speed = self.pending.pop(id)
+        if self.known.get(id) == speed:
+            self.dropped += 1
+            if self.drop:
+                self.drop(id)
+            return
+        self._send(id, speed)
+
+    def _send(self, id, speed):
+        self.sent_at[id] = self.loop.time()
+        self.known[id] = speed
+        self.sent += 1
+        self.send(id, speed)
+
+    # Server has reported the speed of a loco
+    def acknowledge(self, id, speed):
+        # Ignore echoes of older sends that are still arriving
+        if speed != self.known.get(id) and self.loop.time() - self.sent_at.get(id, NEVER) < ACK_WINDOW:
+            return
+        self.known[id] = speed
+
+    # Forget loco, e.g. when released or stopped
+    def reset(self, id):
+        timer = self.timers.pop(id, None)
+        if timer:
+            timer.cancel()
+            if self.drop:
+                self.drop(id)
+        self.pending.pop(id, None)
+        self.known.pop(id, None)
+        self.sent_at.pop(id, None)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# serverstate.py
+#
+"""What the withrottle server has told us, kept up to date from parsed actions"""
+
+import logging
+
+from withrottle import withrottle
+
+log = logging.getLogger("serverstate-logger")
+
+# Everything known about one loco, as last reported by the server
+class Loco:
+
+    __slots__ = ('address', 'name', 'speed', 'reverse', 'functions', 'throttles')
+
+    def __init__(self, address, name=None):
+        # DCC address with S or L prefix, e.g. L41
+        self.address = address
+        # Roster name, if the loco is in the roster
+        self.name = name
+        self.speed = None
+        self.reverse = None
+        # Function number -> on, for functions the server has reported
+        self.functions = {}
+        # Throttle keys that hold this loco
+        self.throttles = set()
+
+    def function(self, number):
+        return self.functions.get(number, False)
+
+# The server's state: locos (by address and roster name), turnouts, consists,
+# track power and the fast clock. Feed it every action list from withrottle.
+class ServerState:
+
+    def __init__(self):
+        self.locos = {}
+        self.roster = {}
+        # Turnout name -> state ('2' closed, '4' thrown)
+        self.turnouts = {}
+        # Consist address -> (name, [(loco address, forward)])
+        self.consists = {}
+        self.power = None
+        # (seconds since 1970, rate) or None if the server has no fast clock
+        self.fast_clock = None
+        self.heartbeat = None
+
+        self._handlers = {
+            withrottle.ADDED: self._added,
+            withrottle.REMOVED: self._removed,
+            withrottle.FORWARD: self._forward,
+            withrottle.REVERSE: self._reverse,
+            withrottle.SPEED: self._speed,
+            withrottle.FUNCTION: self._function,
+            withrottle.POWER_ON: self._power_on,
+            withrottle.POWER_OFF: self._power_off,
+            withrottle.HEARTBEAT: self._heartbeat,
+            withrottle.ROSTER: self._roster,
+            withrottle.TURNOUT: self._turnout,
+            withrottle.CONSIST: self._consist,
+            withrottle.FAST_CLOCK: self._fast_clock,
+        }
+
+    # Apply a list of (action, id, key) tuples from withrottle.process_input()
+    def update(self, actionlist):
+        handlers = self._handlers
+        for (action, id, key) in actionlist:
+            handler = handlers.get(action)
+            if handler:
+                handler(id, key)
+
+    # Loco for an address, created if we haven't heard of it
+    def loco(self, address):
+        loco = self.locos.get(address)
+        if loco is None:
+            loco = self.locos[address] = Loco(address)
+        return loco
+
+    # Address for a roster name, or None
+    def address_for(self, name):
+        loco = self.roster.get(name)
+        if loco is None:
+            return None
+        return loco.address
+
+    # Speed the server last reported for address, or None
+    def speed(self, address):
+        loco = self.locos.get(address)
+        if loco is None:
+            return None
+        return loco.speed
+
+    # Forget what only holds for one connection. The roster, turnouts and
+    # consists are kept as the server will send them again anyway.
+    def reset(self):
+        for loco in self.locos.values():
+            loco.speed = None
+            loco.reverse = None
+            loco.functions.clear()
+            loco.throttles.clear()
+        self.power = None
+        self.heartbeat = None
+
+    def _added(self, address, key):
+        self.loco(address).throttles.add(key)
+
+    def _removed(self, address, key):
+        loco = self.locos.get(address)
+        if loco is not None:
+            loco.throttles.discard(key)
+
+    def _forward(self, address, key):
+        self.loco(address).reverse = False
+
+    def _reverse(self, address, key):
+        self.loco(address).reverse = True
+
+    def _speed(self, id, key):
+        self.loco(id[0]).speed = id[1]
+
+    def _function(self, id, key):
+        (address, number, on) = id
+        self.loco(address).functions[number] = on
+
+    def _power_on(self, id, key):
+        self.power = True
+
+    def _power_off(self, id, key):
+        self.power = False
+
+    def _heartbeat(self, id, key):
+        self.heartbeat = int(id)
+
+    # A new roster list replaces the old one
+    def _roster(self, roster, key):
+        for loco in self.roster.values():
+            loco.name = None
+        self.roster = {}
+        for (name, address) in roster:
+            loco = self.loco(address)
+            loco.name = name
+            self.roster[name] = loco
+        log.debug("Roster has %d locos" % len(self.roster))
+
+    def _turnout(self, id, key):
+        (name, state) = id
+        self.turnouts[name] = state
+
+    def _consist(self, id, key):
+        (address, name, members) = id
+        self.consists[address] = (name, members)
+
+    def _fast_clock(self, id, key):
+        self.fast_clock = id
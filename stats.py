@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# stats.py
+#
+"""Latency histograms for each stage between a fader move and the server"""
+
+import json
+import logging
+import sys
+
+log = logging.getLogger("stats-logger")
+
+# Nothing is recorded unless this is set (see enable())
+enabled = False
+
+# Values are recorded in microseconds, in log-linear buckets: each power of two
+# is split into 16 sub-buckets, so any value is within about 6% of its bucket.
+SUB_BUCKETS = 16
+BUCKETS = 64 * SUB_BUCKETS
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Stages, in the order they happen
+STAGES = [
+    ('midi_delta', "Time between MIDI events (rtmidi delta)"),
+    ('handler', "Time spent in midiControl.handler"),
+    ('bridge', "rtmidi thread to event loop"),
+    ('schedule', "Slider move to speed being sent (coalescing)"),
+    ('wire', "Speed sent to written to socket"),
+    ('slider_to_wire', "Slider move to written to socket"),
+    ('server_ack', "Written to socket to speed echoed by server"),
+    ('flush', "Time spent writing to socket"),
+    ('process_input', "Time spent processing server input"),
+]
+
+# Histogram of durations, with constant cost to record
+class Histogram:
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    # Record a duration in seconds
+    def record(self, seconds):
+        us = int(seconds * 1000000)
+        if us < 0:
+            us = 0
+        shift = us.bit_length() - 5
+        if shift < 0:
+            shift = 0
+        index = shift * SUB_BUCKETS + (us >> shift)
+        if index >= BUCKETS:
+            index = BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += us
+        if self.min is None or us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+
+    # Lowest value (in microseconds) that falls in a bucket
+    @staticmethod
+    def bucket_value(index):
+        shift = index // SUB_BUCKETS - 1
+        if shift <= 0:
+            return index
+        return (index - shift * SUB_BUCKETS) << shift
+
+    # Value (in microseconds) below which the given percentage of samples fall
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        target = self.count * percent / 100.0
+        seen = 0
+        for (index, n) in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        s = {
+            'count': self.count,
+            'min_ms': (self.min or 0) / 1000.0,
+            'mean_ms': (self.total / self.count / 1000.0) if self.count else 0,
+            'max_ms': self.max / 1000.0,
+        }
+        for p in PERCENTILES:
+            s['p%s_ms' % p] = self.percentile(p) / 1000.0
+        return s
+
+histograms = {}
+
+# Loco speed changes being followed through the stages, by (key, id, speed)
+moved = {}
+unflushed = []
+on_wire = {}
+
+# Turn instrumentation on
+def enable():
+    global enabled
+    for (name, description) in STAGES:
+        histograms[name] = Histogram()
+    enabled = True
+
+def record(name, seconds):
+    histograms[name].record(seconds)
+
+# Slider for loco has moved (first move since the last send counts)
+def slider_moved(key, id, now):
+    if (key, id) not in moved:
+        moved[(key, id)] = now
+
+# Slider moves for loco won't be sent after all (the scheduler dropped them)
+def speed_dropped(key, id):
+    moved.pop((key, id), None)
+
+# Speed for loco has been written to the output buffer
+def speed_sent(key, id, speed, now):
+    start = moved.pop((key, id), None)
+    if start is not None:
+        record('schedule', now - start)
+    unflushed.append((key, id, speed, start, now))
+
+# Output buffer has been written to the socket
+def flushed(now):
+    for (key, id, speed, start, sent) in unflushed:
+        record('wire', now - sent)
+        if start is not None:
+            record('slider_to_wire', now - start)
+        on_wire[(key, id, speed)] = now
+    del unflushed[:]
+    # Don't grow forever if the server isn't echoing speeds
+    if len(on_wire) > 1000:
+        on_wire.clear()
+
+# Server has echoed a speed
+def speed_echoed(key, id, speed, now):
+    sent = on_wire.pop((key, id, speed), None)
+    if sent is not None:
+        record('server_ack', now - sent)
+
+# Everything recorded so far, as a dict
+def snapshot():
+    return dict((name, histograms[name].summary()) for (name, description) in STAGES if name in histograms)
+
+# Human readable table
+def report():
+    lines = ["%-15s %8s %9s %9s %9s %9s %9s" % ('stage', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms', 'max ms')]
+    for (name, s) in snapshot().items():
+        lines.append("%-15s %8d %9.3f %9.3f %9.3f %9.3f %9.3f" % (name, s['count'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['p99.9_ms'], s['max_ms']))
+    return "\n".join(lines)
+
+# Print the table to stderr (on SIGUSR1)
+def dump():
+    sys.stderr.write(report() + "\n")
+
+# Answer any connection to the stats port with the histograms as JSON
+async def serve_client(reader, writer):
+    body = json.dumps(snapshot(), indent=1).encode()
+    writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(body))
+    writer.write(body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
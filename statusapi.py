@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# statusapi.py
+#
+"""Local HTTP and WebSocket interface: live state for dashboards, and commands"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import struct
+import time
+
+log = logging.getLogger("statusapi-logger")
+
+# How often state is checked for changes while clients are connected (in seconds)
+UPDATE_INTERVAL = 0.1
+
+# How often counters are sent (in seconds) - they change all the time and cost more to gather
+COUNTER_INTERVAL = 1.0
+
+# A client with more than this many bytes waiting is skipped, and sent the
+# full state once it has caught up
+MAX_BUFFER = 64 * 1024
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# WebSocket opcodes
+TEXT = 0x1
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# Changes from old to new, for dicts of dicts. Anything else that differs is
+# replaced whole, and keys that have gone are given as None.
+def diff(old, new):
+    changes = {}
+    for (name, value) in new.items():
+        before = old.get(name)
+        if before == value:
+            continue
+        if isinstance(value, dict) and isinstance(before, dict):
+            changes[name] = diff(before, value)
+        else:
+            changes[name] = value
+    for name in old:
+        if name not in new:
+            changes[name] = None
+    return changes
+
+# One server frame (never masked)
+def frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+def text_frame(message):
+    return frame(TEXT, json.dumps(message, separators=(',', ':')).encode())
+
+# Read one client frame, returning (opcode, payload)
+async def read_frame(reader):
+    (first, second) = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for (i, b) in enumerate(payload))
+    return (first & 0x0F, payload)
+
+class Client:
+
+    __slots__ = ('writer', 'behind')
+
+    def __init__(self, writer):
+        self.writer = writer
+        # Missed an update, so needs the full state
+        self.behind = False
+
+# Serves the state as JSON on GET /, pushes changes to WebSocket clients on
+# /ws, and runs commands sent as JSON on either. state() and counters()
+# return dicts; commands maps a command name to a function taking the rest
+# of the command as keyword arguments.
+class StatusServer:
+
+    def __init__(self, loop, state, counters, commands, interval=UPDATE_INTERVAL):
+        self.loop = loop
+        self.state = state
+        self.counters = counters
+        self.commands = commands
+        self.interval = interval
+
+        self.clients = []
+        # What clients have been sent
+        self.published = None
+        self.counters_at = 0
+        self.timer = None
+        self.server = None
+        self.tasks = set()
+
+        # Counters
+        self.publishes = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.skipped = 0
+        self.publish_time = 0.0
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        for client in self.clients:
+            client.writer.close()
+        self.clients = []
+        for task in self.tasks:
+            task.cancel()
+        if self.server:
+            self.server.close()
+
+    # Current state, with counters if they're due
+    def snapshot(self, now):
+        state = self.state()
+        if self.published is None or now - self.counters_at >= COUNTER_INTERVAL:
+            state['counters'] = self.counters()
+            self.counters_at = now
+        elif 'counters' in self.published:
+            state['counters'] = self.published['counters']
+        return state
+
+    # Send what has changed since last time to every client, encoded once
+    def publish(self):
+        self.timer = None
+        if not self.clients:
+            return
+        start = time.perf_counter()
+        state = self.snapshot(self.loop.time())
+        changes = diff(self.published, state)
+        self.published = state
+        update = text_frame({'type': 'update', 'changes': changes}) if changes else None
+        full = None
+
+        for client in list(self.clients):
+            transport = client.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > MAX_BUFFER:
+                # Slow client - let it catch up, then send it everything
+                client.behind = True
+                self.skipped += 1
+                continue
+            if client.behind:
+                if full is None:
+                    full = text_frame({'type': 'state', 'state': state})
+                data = full
+                client.behind = False
+            elif update:
+                data = update
+            else:
+                continue
+            client.writer.write(data)
+            self.frames_sent += 1
+            self.bytes_sent += len(data)
+
+        self.publishes += 1
+        self.publish_time += time.perf_counter() - start
+        self.timer = self.loop.call_later(self.interval, self.publish)
+
+    # Run a command, e.g. {"command": "power", "on": true}. Returns the reply.
+    def run_command(self, message):
+        if not isinstance(message, dict) or message.get('command') not in self.commands:
+            return {'ok': False, 'error': "Unknown command"}
+        arguments = dict(message)
+        command = self.commands[arguments.pop('command')]
+        try:
+            command(**arguments)
+        except (TypeError, ValueError, KeyError, IndexError) as e:
+            return {'ok': False, 'error': str(e)}
+        # Let clients see the result without waiting for the next update
+        if self.timer and self.clients:
+            self.timer.cancel()
+            self.timer = self.loop.call_soon(self.publish)
+        return {'ok': True}
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            lines = request.decode(errors="replace").split("\r\n")
+            (method, path) = lines[0].split(" ")[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    (name, value) = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+
+            if path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self.websocket(reader, writer, headers)
+            elif method == "GET" and path == "/":
+                self.respond(writer, "200 OK", self.snapshot(self.loop.time()))
+            elif method == "POST" and path == "/command":
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    reply = self.run_command(json.loads(body))
+                except ValueError:
+                    reply = {'ok': False, 'error': "Invalid JSON"}
+                self.respond(writer, "200 OK" if reply['ok'] else "400 Bad Request", reply)
+            else:
+                self.respond(writer, "404 Not Found", {'error': "Not found"})
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.tasks.discard(task)
+            writer.close()
+
+    def respond(self, writer, status, message):
+        body = json.dumps(message).encode()
+        writer.write(b"HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status.encode(), len(body)))
+        writer.write(body)
+
+    async def websocket(self, reader, writer, headers):
+        accept = base64.b64encode(hashlib.sha1(headers.get("sec-websocket-key", "").encode() + WEBSOCKET_GUID).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n" % accept)
+
+        client = Client(writer)
+        if self.published is None:
+            self.published = self.snapshot(self.loop.time())
+        writer.write(text_frame({'type': 'state', 'state': self.published}))
+        self.clients.append(client)
+        if self.timer is None:
+            self.timer = self.loop.call_later(self.interval, self.publish)
+        log.debug("WebSocket client connected, %d now" % len(self.clients))
+
+        try:
+            while True:
+                (opcode, payload) = await read_frame(reader)
+                if opcode == CLOSE:
+                    writer.write(frame(CLOSE, payload[:2]))
+                    break
+                elif opcode == PING:
+                    writer.write(frame(PONG, payload))
+                elif opcode == TEXT:
+                    try:
+                        reply = self.run_command(json.loads(payload))
+                    except ValueError:
+                        reply = {'ok': False, 'error': "Invalid JSON"}
+                    reply['type'] = 'reply'
+                    writer.write(text_frame(reply))
+        finally:
+            self.clients.remove(client)
+            if not self.clients:
+                # Nobody watching - stop looking for changes
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+                self.published = None
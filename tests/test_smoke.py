@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# test_smoke.py
+#
+"""Smoke tests: the throttle on a virtual surface against the stand-in server, and each benchmark run small"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import config
+import midiControl
+import midirecord
+from bench_session import Session, ADDRESSES
+
+UPDATE_INTERVAL = 0.02
+
+def session(split=None):
+    return Session(argparse.Namespace(latency=0, split=split, update_interval=UPDATE_INTERVAL))
+
+# Wait until check() is true, failing the test if it takes too long
+async def wait_for(check, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not check():
+        assert loop.time() < end, "Timed out"
+        await asyncio.sleep(0.01)
+
+def fader(channel, value, t=0):
+    return [(t, [0xB0, channel, value])]
+
+async def round_trip(split):
+    async with session(split) as s:
+        controller = s.controller
+        assert controller.train == ADDRESSES
+        await s.play(fader(0, 64), None)
+        await wait_for(lambda: s.server.lines("MTAS1<;>V"))
+        assert s.server.lines("MTAS1<;>V")[-1] != "MTAS1<;>V0"
+        await s.play(midirecord.press(midiControl.STOP_BUTTON.control_number, 0), None)
+        await wait_for(lambda: any(line.endswith("<;>X") for line in s.server.lines("MTA")))
+
+# Take control of eight locos, set a speed and stop
+def test_acquire_speed_stop():
+    asyncio.run(round_trip(None))
+
+# The same, with every reply from the server arriving a few bytes at a time
+def test_split_lines():
+    asyncio.run(round_trip(3))
+
+# After the server drops the connection, the same locos are taken back
+def test_reconnect_resync():
+    async def main():
+        async with session() as s:
+            s.server.disconnect()
+            await wait_for(lambda: s.server.connections == 2)
+            await wait_for(lambda: len(s.server.lines("MT+")) == len(ADDRESSES))
+            assert sorted(line.split("<;>")[1] for line in s.server.lines("MT+")) == sorted(ADDRESSES)
+            assert s.controller.train == ADDRESSES
+    asyncio.run(main())
+
+# A latching function turns on with one press of its button and off with the next
+def test_latching_function():
+    async def main():
+        async with session() as s:
+            rec = midiControl.REC_BUTTON.control_number
+            s.controller.apply_config(config.SurfaceConfig(list(ADDRESSES), [{(config.NORMAL, rec): 3} for a in ADDRESSES],
+                latching=[frozenset([3])] * len(ADDRESSES)))
+            # Select the first slider's loco
+            await s.play(midirecord.press(0x20, 0), 1.0)
+            assert s.controller.selected == 0
+            functions = s.server.functions
+            await s.play(midirecord.press(rec, 0), 1.0)
+            await wait_for(lambda: functions.get("S1", {}).get("3") is True)
+            assert s.controller.function_on("S1", 3)
+            await s.play(midirecord.press(rec, 0), 1.0)
+            await wait_for(lambda: functions["S1"]["3"] is False)
+            assert not s.controller.function_on("S1", 3)
+    asyncio.run(main())
+
+BENCHMARKS = [
+    ["benchmarks/bench_session.py", "--sweeps", "1", "--stops", "3", "--jitter-seconds", "0.2"],
+    ["benchmarks/bench_status.py", "--clients", "2", "--sweeps", "1"],
+    ["benchmarks/bench_parser.py", "--lines", "1000", "--repeat", "1"],
+    ["benchmarks/bench_encoder.py", "--commands", "1000", "--repeat", "1"],
+    ["benchmarks/bench_handler.py", "--events", "1000", "--repeat", "1"],
+    ["benchmarks/bench_workers.py", "--sweeps", "1"],
+    ["benchmarks/bench_journal.py", "--events", "1000", "--repeat", "1", "--size", "1"],
+    ["loadgen.py", "--fake", "-n", "2", "--duration", "0.5", "--ramp", "0.1"],
+]
+
+@pytest.mark.parametrize("command", BENCHMARKS, ids=[command[0] for command in BENCHMARKS])
+def test_benchmark(command):
+    result = subprocess.run([sys.executable] + command, cwd=ROOT, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
@@ -2,218 +2,1049 @@
 #
 # main.py
 #
-"""Control trains using MIDI control surface"""
+"""Control trains using MIDI control surfaces"""
 
 import argparse
+import asyncio
 import socket
 import re
 import os, sys
 import time
 import logging
-import json
 from withrottle import withrottle
+from scheduler import SpeedScheduler
+from momentum import Momentum
+from serverstate import ServerState
+import config
+import stats
+import signal
+import midirecord
+import midiworker
+import journal
+import statusapi
+import macro
+import faderfilter
+import profiles
 from pprint import pprint
 import midiControl
-from time import sleep
 
 log = logging.getLogger("throttle-logger")
 
-# How often to send throttle position to server (in seconds)
+# Minimum time between speed updates for each loco (in seconds)
 UPDATE_INTERVAL = 0.25
 
-locked = False
+# Delay before trying to reconnect to the server (in seconds), doubling after each failure
+RECONNECT_MIN = 0.1
+RECONNECT_MAX = 10
+
+# Seconds between heartbeats the server wants, until it says
+HEARTBEAT_INTERVAL = 1
+
+# Throttle keys given to each surface on the shared connection (MT, MS, M1...)
+THROTTLE_KEYS = "TS123456789"
+
+# Macros are saved in macro_dir, one file for each surface
+MACRO_FILE = "macro-%s.jsonl"
+
+# Throttle keys for consists, handed out as they are acquired. Each consist gets
+# a key of its own, so one '*' command reaches every loco in it.
+CONSIST_KEYS = "ABCDEFGHIJKLMNOPQRUVWXYZ"
+
 power = False
 
-train = [None] * 8
-reverse = [False] * 8
-selected = None
-
-slider_updated = [False] * 8
-slider_value = [0] * 8
-
-# Called when server has confirmed that loco has been added
-def add_confirmed(id):
-    global train
-    if id in dcc_address_list:
-        channel = dcc_address_list.index(id)
-        midiControl.set_led(True, channel, 3)
-        train[channel] = id
-
-# Called when server has confirmed that loco has been released
-def release_confirmed(id):
-    global train
-    if id in dcc_address_list:
-        channel = dcc_address_list.index(id)
-        midiControl.set_led(False, channel, 3)
-        train[channel] = None
-
-# Called when server indicates that (new) loco is in reverse
-def reverse_confirmed(id):
-    global train
-    if id in dcc_address_list:
-        channel = dcc_address_list.index(id)
-        midiControl.set_led(True, channel, 4)
-        reverse[channel] = True
-
-# Called when server indicates that (new) loco is facing forwards
-def forward_confirmed(id):
-    global train
-    if id in dcc_address_list:
-        channel = dcc_address_list.index(id)
-        midiControl.set_led(False, channel, 4)
-        reverse[channel] = False
+heartbeat_interval = HEARTBEAT_INTERVAL
+
+# Event loop, server connection and controllers by throttle key (created in run())
+loop = None
+throttle = None
+controllers = {}
+reconnect_task = None
+status_server = None
+
+# Where macros are kept, and whether playing one repeats until stopped (set from the command line)
+macro_dir = "."
+macro_repeat = False
+
+# Controllers by the throttle key of each consist they hold
+consist_owners = {}
+next_consist_key = 0
+
+# Everything the server has told us (roster, loco speeds and functions, turnouts...)
+state = ServerState()
+
+# DCC address for each roster name: the server's roster, or until that arrives,
+# the one saved in the roster cache last time (set up in run())
+roster = {}
+roster_cache = None
+
+# One control surface and the locos it drives
+class Controller:
+
+    # profile is the surface's profiles.Profile, or None for the nanoKONTROL2
+    def __init__(self, key, config_file, surface_config, profile=None):
+        self.key = key
+        self.config_file = config_file
+        self.profile = profile
+        # Config as loaded, before roster names are looked up
+        self.config = surface_config
+        # List of DCC addresses, corresponding to sliders 0-7 (None if not known yet)
+        self.dcc_address_list = surface_config.dcc_address_list
+        # Function lookups, corresponding to sliders 0-7
+        self.functions = surface_config.functions
+        # Functions that latch, corresponding to sliders 0-7
+        self.latching = surface_config.latching
+        # Latching function states asked for but not yet confirmed by the
+        # server, by (address, function number)
+        self.wanted = {}
+        # Speed for each slider position, corresponding to sliders 0-7
+        self.speed_tables = surface_config.speed_tables
+        # Consist on each slider, or None for a single loco
+        self.consists = surface_config.consists
+        # Throttle key for each slider whose consist we hold, and which of its locos the server has confirmed
+        self.consist_keys = {}
+        self.held = {}
+
+        self.surface = None
+        self.scheduler = None
+        self.momentum = None
+        self.watcher = None
+
+        self.locked = False
+        self.train = [None] * 8
+        self.reverse = [False] * 8
+        self.selected = None
+        self.slider_value = [0] * 8
+
+        # Direction to put back on locos re-acquired after reconnecting
+        self.restore = {}
+
+        # Macro being recorded or played, if any
+        self.recorder = None
+        self.player = None
+
+    # Throttle key and id to send commands for a slider to - a whole consist
+    # is sent to at once with the '*' wildcard
+    def address(self, channel):
+        key = self.consist_keys.get(channel)
+        if key is None:
+            return (self.dcc_address_list[channel], self.key)
+        return ('*', key)
+
+    # Slider driven by a consist's throttle key
+    def consist_channel(self, key):
+        for (channel, consist_key) in self.consist_keys.items():
+            if consist_key == key:
+                return channel
+        return None
+
+    # Take control of the loco (or every loco in the consist) on a slider
+    def acquire(self, channel):
+        if self.consists[channel] is None:
+            throttle.add_loco(self.dcc_address_list[channel], self.key)
+            return
+        if channel in self.consist_keys:
+            # Still waiting for the server from last time - start again
+            self.release(channel, self.dcc_address_list[channel])
+        key = consist_key()
+        if key is None:
+            log.warning("Too many consists, unable to take control of slider %d" % channel)
+            return
+        consist_owners[key] = self
+        self.consist_keys[channel] = key
+        self.add_units(channel)
+
+    def add_units(self, channel):
+        key = self.consist_keys[channel]
+        self.held[channel] = set()
+        for (address, flipped) in self.consists[channel]:
+            throttle.add_loco(address, key)
+
+    # Give up the loco (or consist) on a slider. A consist is forgotten
+    # straight away, rather than when the server confirms, as its key may be reused.
+    def release(self, channel, id):
+        key = self.consist_keys.pop(channel, None)
+        if key is None:
+            throttle.release_loco(id, self.key)
+            return
+        throttle.release_loco('*', key)
+        del consist_owners[key]
+        self.held.pop(channel, None)
+        self.released(channel, id)
+
+    # Loco (or consist) on a slider is no longer ours
+    def released(self, channel, id):
+        self.surface.set_led(False, channel, midiControl.ACQUIRE_ROW)
+        self.train[channel] = None
+        self.scheduler.reset(id)
+        self.momentum.halt(channel)
+
+    # Send the direction for a slider's loco, or for each loco in its consist
+    def send_direction(self, channel):
+        reverse = self.reverse[channel]
+        consist = self.consists[channel]
+        if consist is None or channel not in self.consist_keys or not any(flipped for (address, flipped) in consist):
+            set_direction(*self.address(channel), reverse)
+            return
+        for (address, flipped) in consist:
+            set_direction(address, self.consist_keys[channel], reverse != flipped)
+
+    # Called when server has confirmed that loco has been added
+    def add_confirmed(self, id, key):
+        if key != self.key:
+            self.unit_added(id, key)
+        elif id in self.dcc_address_list:
+            channel = self.dcc_address_list.index(id)
+            self.surface.set_led(True, channel, midiControl.ACQUIRE_ROW)
+            self.train[channel] = id
+            if id in self.restore:
+                # Wait until the rest of the server's reply has been processed
+                loop.call_soon(self.restore_loco, id)
+        else:
+            # Slider was given another loco while this one was being added
+            log.info("Releasing %s, no longer in config" % id)
+            throttle.release_loco(id, self.key)
+
+    # Called when server has confirmed that a loco in one of our consists has been added
+    def unit_added(self, id, key):
+        channel = self.consist_channel(key)
+        if channel is None:
+            return
+        units = dict(self.consists[channel])
+        if id not in units:
+            throttle.release_loco(id, key)
+            return
+        self.held[channel].add(id)
+        # Point it the right way in the consist
+        set_direction(id, key, self.reverse[channel] != units[id])
+
+        lead = self.dcc_address_list[channel]
+        if self.train[channel] == None:
+            self.surface.set_led(True, channel, midiControl.ACQUIRE_ROW)
+            self.train[channel] = lead
+        if id == lead and lead in self.restore:
+            loop.call_soon(self.restore_loco, lead)
+
+    # Called when server has confirmed that loco has been released
+    def release_confirmed(self, id, key):
+        if key == self.key and id in self.dcc_address_list:
+            self.released(self.dcc_address_list.index(id), id)
+
+    # Called when server indicates that (new) loco is in reverse.
+    # Consists keep the direction we give them.
+    def reverse_confirmed(self, id, key):
+        if key == self.key and id in self.dcc_address_list:
+            channel = self.dcc_address_list.index(id)
+            self.surface.set_led(True, channel, midiControl.REVERSE_ROW)
+            self.reverse[channel] = True
+
+    # Called when server indicates that (new) loco is facing forwards
+    def forward_confirmed(self, id, key):
+        if key == self.key and id in self.dcc_address_list:
+            channel = self.dcc_address_list.index(id)
+            self.surface.set_led(False, channel, midiControl.REVERSE_ROW)
+            self.reverse[channel] = False
+
+    # Config file has changed, or roster names now point to different
+    # addresses - only touch the channels that are different
+    def apply_config(self, surface_config):
+        self.config = surface_config
+        surface_config = surface_config.resolve(roster.get)
+        old = self.dcc_address_list
+        new = surface_config.dcc_address_list
+        self.dcc_address_list = new
+        self.functions = surface_config.functions
+        self.latching = surface_config.latching
+        self.speed_tables = surface_config.speed_tables
+        for (channel, rates) in enumerate(surface_config.momentum):
+            self.momentum.configure(channel, *(rates or ()))
+        old_consists = self.consists
+        self.consists = surface_config.consists
+
+        # Sliders whose loco changes, and locos of ours that are only moving
+        # to another slider (which keep being held, and keep their direction)
+        changed = []
+        moved = {}
+        for channel in range(max(len(old), len(new))):
+            old_id = old[channel] if channel < len(old) else None
+            new_id = new[channel] if channel < len(new) else None
+            old_consist = old_consists[channel] if channel < len(old_consists) else None
+            new_consist = self.consists[channel] if channel < len(self.consists) else None
+            if (old_id == new_id and old_consist == new_consist) or self.train[channel] == None:
+                continue
+            log.info("Slider %d changed from %s to %s" % (channel, old_id, new_id))
+            changed.append((channel, old_id, new_id))
+            if old_consist is None and old_id in new:
+                to = new.index(old_id)
+                if to != channel and self.consists[to] is None:
+                    moved[old_id] = (to, self.reverse[channel])
+
+        # Release everything first, so a loco given up by one slider can't
+        # be released again after another slider has acquired it
+        for (channel, old_id, new_id) in changed:
+            if old_id not in moved:
+                self.release(channel, old_id)
+            self.scheduler.reset(old_id)
+            self.momentum.halt(channel)
+            self.restore.pop(old_id, None)
+            self.train[channel] = None
+            self.surface.set_led(False, channel, midiControl.ACQUIRE_ROW)
+            if self.reverse[channel]:
+                self.reverse[channel] = False
+                self.surface.set_led(False, channel, midiControl.REVERSE_ROW)
+
+        for (channel, old_id, new_id) in changed:
+            if new_id != None:
+                if new_id not in moved:
+                    self.acquire(channel)
+            elif self.selected == channel:
+                self.selected = None
+                self.surface.set_led(False, channel, midiControl.SELECT_ROW)
+        for (id, (channel, reverse)) in moved.items():
+            self.train[channel] = id
+            self.surface.set_led(True, channel, midiControl.ACQUIRE_ROW)
+            self.restore[id] = reverse
+            self.restore_loco(id)
+        self.paint_functions()
+
+    # Set the M, R and S LEDs to match our state
+    def repaint(self):
+        surface = self.surface
+        for channel in range(8):
+            surface.set_led(self.train[channel] != None, channel, midiControl.ACQUIRE_ROW)
+            surface.set_led(self.reverse[channel], channel, midiControl.REVERSE_ROW)
+            surface.set_led(self.selected == channel, channel, midiControl.SELECT_ROW)
+        surface.set_led(power, midiControl.CYCLE_BUTTON)
+        self.paint_functions()
+
+    # Which bank of functions the buttons are on: TRACK L and TRACK R are shift keys
+    def shift(self):
+        if self.surface.is_pressed(midiControl.TRACK_L_BUTTON):
+            return config.LSHIFT
+        if self.surface.is_pressed(midiControl.TRACK_R_BUTTON):
+            return config.RSHIFT
+        return config.NORMAL
+
+    # Whether a function is on: as asked for, until the server says otherwise
+    def function_on(self, address, function):
+        on = self.wanted.get((address, function))
+        if on is None:
+            loco = state.locos.get(address)
+            on = loco is not None and loco.function(function)
+        return on
+
+    # Light the function buttons (REC, PLAY, FF, RW) whose functions are on
+    # for the selected loco, in the current shift state. Nothing is asked of
+    # the server: function states are kept as it reports them. REC and PLAY
+    # show a macro being recorded or played instead.
+    def paint_functions(self):
+        surface = self.surface
+        if surface is None:
+            return
+        selected = self.selected
+        functions = self.functions[selected] if selected is not None and selected < len(self.functions) else {}
+        shift = self.shift()
+        for control_number in config.FUNCTION_BUTTONS.values():
+            function = functions.get((shift, control_number))
+            on = function is not None and self.function_on(self.dcc_address_list[selected], function)
+            if control_number == midiControl.REC_BUTTON.control_number and self.recorder is not None:
+                on = True
+            elif control_number == midiControl.PLAY_BUTTON.control_number and self.player is not None:
+                on = True
+            surface.set_led(on, midiControl.BUTTONS[control_number])
+
+    # Called when the server reports a function's state (which is kept in state)
+    def function_confirmed(self, id, function, on, key):
+        self.wanted.pop((id, function), None)
+        if self.selected is not None and self.dcc_address_list[self.selected] == id:
+            self.paint_functions()
+
+    # Function button pressed or released for the selected loco. Momentary
+    # functions follow the button; latching ones are set to the opposite of
+    # what they are now when it is pressed, in one command.
+    def operate_function(self, channel, function, is_on):
+        address = self.dcc_address_list[channel]
+        key = self.consist_keys.get(channel, self.key)
+        if function not in self.latching[channel]:
+            throttle.send_function(address, function, is_on, key)
+        elif is_on:
+            on = not self.function_on(address, function)
+            self.wanted[(address, function)] = on
+            throttle.force_function(address, function, on, key)
+            self.paint_functions()
+
+    # Take back our locos after reconnecting to the server
+    def resync(self):
+        self.wanted.clear()
+        for (channel, id) in enumerate(self.train):
+            if id != None:
+                self.scheduler.reset(id)
+                self.restore[id] = self.reverse[channel]
+                if channel in self.consist_keys:
+                    self.add_units(channel)
+                else:
+                    throttle.add_loco(id, self.key)
+
+    # Put direction and speed back as they were before the connection dropped
+    def restore_loco(self, id):
+        if id not in self.restore or id not in self.dcc_address_list:
+            return
+        channel = self.dcc_address_list.index(id)
+        self.reverse[channel] = self.restore.pop(id)
+        self.send_direction(channel)
+        self.surface.set_led(self.reverse[channel], channel, midiControl.REVERSE_ROW)
+        self.scheduler.update(id, self.momentum.speed(channel))
+        self.momentum.set_target(channel, self.speed_for(channel, self.slider_value[channel]))
+
+    # Speed for a slider position. Positions from 14-bit faders fall between
+    # two entries in the speed table, so the speed is taken from between them.
+    def speed_for(self, channel, value):
+        table = self.speed_tables[channel]
+        if value.__class__ is int:
+            return table[value]
+        low = int(value)
+        if low >= 127:
+            return table[127]
+        return int(round(table[low] + (table[low + 1] - table[low]) * (value - low)))
+
+    # Send speed for one of our locos (or consists, by its lead loco)
+    def send_speed(self, id, speed):
+        if stats.enabled:
+            stats.speed_sent(self.key, id, speed, time.perf_counter())
+        key = self.key
+        if self.consist_keys and id in self.dcc_address_list:
+            (id, key) = self.address(self.dcc_address_list.index(id))
+        throttle.set_speed(id, speed, key)
+
+    # Scheduler won't be sending the latest slider position for a loco
+    def speed_dropped(self, id):
+        if stats.enabled:
+            stats.speed_dropped(self.key, id)
+
+    # Called when server reports the speed of a loco. For a consist only the
+    # lead loco counts.
+    def speed_confirmed(self, id, speed, key):
+        if key != self.key:
+            channel = self.consist_channel(key)
+            if channel is None or id != self.dcc_address_list[channel]:
+                return
+        if stats.enabled:
+            stats.speed_echoed(self.key, id, speed, time.perf_counter())
+        self.scheduler.acknowledge(id, speed)
+
+    # Emergency stop the loco (or consist) on a slider
+    def stop(self, channel):
+        self.scheduler.reset(self.dcc_address_list[channel])
+        self.momentum.halt(channel)
+        throttle.stop(*self.address(channel))
+
+    # Emergency stop every loco in the config. If the server allows, one
+    # '*' stop covers every loco on our key (consists have keys of their own).
+    def stop_all(self):
+        wildcard = throttle.supports_wildcard()
+        if wildcard:
+            throttle.stop('*', self.key)
+        for (channel, loco) in enumerate(self.dcc_address_list):
+            if loco == None:
+                continue
+            if wildcard and channel not in self.consist_keys:
+                self.scheduler.reset(loco)
+                self.momentum.halt(channel)
+            else:
+                self.stop(channel)
+
+    # Forget speeds waiting to be sent, and any momentum still ramping towards
+    # one, e.g. when track power goes off
+    def cancel_speeds(self):
+        for (channel, loco) in enumerate(self.dcc_address_list):
+            if loco != None:
+                self.scheduler.reset(loco)
+                self.momentum.halt(channel)
+
+    # State for the status API
+    def status(self):
+        return {
+            'locos': list(self.dcc_address_list),
+            'train': list(self.train),
+            'reverse': list(self.reverse),
+            'sliders': list(self.slider_value),
+            'speeds': list(self.momentum.emitted),
+            'selected': self.selected,
+            'locked': self.locked,
+            'macro': 'recording' if self.recorder else 'playing' if self.player else None,
+        }
+
+    # Momentum has brought a loco to a new speed step
+    def momentum_step(self, channel, speed):
+        if (channel < len(self.dcc_address_list) and self.train[channel] != None):
+            self.scheduler.update(self.dcc_address_list[channel], speed)
+
+    # Start recording a macro, or stop and save it
+    def toggle_recording(self):
+        filename = os.path.join(macro_dir, MACRO_FILE % self.key)
+        if self.recorder is None:
+            self.recorder = macro.Recorder(loop)
+            log.info("Recording macro")
+        else:
+            events = self.recorder.events
+            self.recorder = None
+            try:
+                macro.save(events, filename)
+                log.info("Saved macro of %d events to %s" % (len(events), filename))
+            except OSError as e:
+                log.error("Unable to save macro: %s" % e)
+        self.paint_functions()
+
+    # Start playing the saved macro, or stop it
+    def toggle_playback(self):
+        if self.player is not None:
+            self.player.stop()
+            self.playback_done()
+            return
+        filename = os.path.join(macro_dir, MACRO_FILE % self.key)
+        try:
+            events = macro.load(filename)
+        except (OSError, ValueError) as e:
+            log.error("Unable to load macro: %s" % e)
+            return
+        log.info("Playing %d events from %s" % (len(events), filename))
+        self.player = macro.Player(loop, events, self.slider_callback, self.play_button, macro_repeat, self.playback_done)
+        self.paint_functions()
+        self.player.start()
+
+    def playback_done(self):
+        self.player = None
+        self.paint_functions()
+
+    # Button from a macro - as if it had been pressed on the surface
+    def play_button(self, control_number, is_on):
+        self.surface.pressed[control_number] = is_on
+        self.button_callback(midiControl.BUTTONS[control_number], is_on)
+
+    # Called when slider is moved
+    def slider_callback(self, channel, value):
+        if self.recorder:
+            self.recorder.slider(channel, value)
+        self.slider_value[channel] = value
+        if (channel < len(self.dcc_address_list) and self.train[channel] != None):
+            if stats.enabled:
+                stats.slider_moved(self.key, self.dcc_address_list[channel], time.perf_counter())
+            self.momentum.set_target(channel, self.speed_for(channel, value))
+        return
+
+    # Called when a button is pressed
+    def button_callback(self, b, is_on):
+
+        channel = b.channel
+        button = b.button
+        surface = self.surface
+        dcc_address_list = self.dcc_address_list
+        train = self.train
+        reverse = self.reverse
+
+        # Macros: SET + REC starts and stops recording, SET + PLAY starts and
+        # stops playback (not while locked, as a macro moves trains). SET does
+        # nothing by itself, and every other button works as usual while it's held.
+        if (b == midiControl.SET_BUTTON):
+            return
+        if ((b == midiControl.REC_BUTTON or b == midiControl.PLAY_BUTTON)
+                and surface.is_pressed(midiControl.SET_BUTTON) and not self.locked):
+            if (is_on and b == midiControl.REC_BUTTON):
+                self.toggle_recording()
+            elif (is_on):
+                self.toggle_playback()
+            return
+        if self.recorder:
+            self.recorder.button(b.control_number, is_on)
+
+        # Button pressed
+        if (is_on):
+            log.debug("Pressed %d %d" % (channel, button))
+
+            # Lock controls?
+            if (b == midiControl.MARKER_L_BUTTON and surface.is_pressed(midiControl.MARKER_R_BUTTON)):
+                self.locked = not self.locked
+
+            # Power cycle (works even when buttons are locked)
+            if (b == midiControl.CYCLE_BUTTON):
+                set_power(not power)
+
+            # If controls are locked, do nothing
+            if self.locked:
+                return
+
+            # Select throttles to use (M buttons)
+            if button == midiControl.ACQUIRE_ROW and channel <= 8 and channel < len(dcc_address_list) and dcc_address_list[channel] != None:
+                if (train[channel] == None):
+                    self.acquire(channel)
+                else:
+                    # Unselect throttle
+                    self.release(channel, dcc_address_list[channel])
+                    # Turn off reverse LED
+                    if reverse[channel]:
+                        reverse[channel] = False
+                        surface.set_led(False, channel, midiControl.REVERSE_ROW)
+                    # Turn off 'selected' LED and unselect
+                    if self.selected == channel:
+                        self.selected = None
+                        surface.set_led(False, channel, midiControl.SELECT_ROW)
+                        self.paint_functions()
+
+            # Reverse (R buttons)
+            if (button == midiControl.REVERSE_ROW and channel <= 8 and train[channel] != None):
+                reverse[channel] = not reverse[channel]
+                self.send_direction(channel)
+                surface.set_led(reverse[channel], channel, midiControl.REVERSE_ROW)
+
+            # Select train (S butons)
+            if (button == midiControl.SELECT_ROW and channel <= 8 and train[channel] != None):
+                if (self.selected != None):
+                    # turn old LED off
+                    surface.set_led(False, self.selected, midiControl.SELECT_ROW)
+                # Toggle off
+                if (self.selected == channel):
+                    self.selected = None
+                else:
+                    self.selected = channel
+                    surface.set_led(True, self.selected, midiControl.SELECT_ROW)
+                # Show the new loco's functions
+                self.paint_functions()
+
+            # Stop button
+            if (b == midiControl.STOP_BUTTON and self.selected != None):
+                self.stop(self.selected)
+
+            # Stop all (when no trains are selected)
+            if (b == midiControl.STOP_BUTTON and self.selected == None):
+                self.stop_all()
+
+        # Function buttons - only operated if a loco is selected using corresponding S button
+
+        selected = self.selected
+        if (selected != None):
+
+            # The 'track left' and 'track right' buttons act as different shift keys
+            if b == midiControl.TRACK_L_BUTTON or b == midiControl.TRACK_R_BUTTON:
+                self.paint_functions()
+                return
+
+            # Map button to function
+            function = self.functions[selected].get((self.shift(), b.control_number))
+            if (function is not None):
+                self.operate_function(selected, function, is_on)
+
+# Live state and counters for the status API
+def status():
+    return {
+        'connected': reconnect_task is None,
+        'power': power,
+        'controllers': dict((key, controller.status()) for (key, controller) in controllers.items()),
+    }
+
+def counters():
+    c = {
+        'bytes_sent': throttle.bytes_sent,
+        'send_calls': throttle.send_calls,
+        'flushes': throttle.flushes,
+        'speeds_cancelled': throttle.cancelled,
+        'controllers': dict((key, {
+            'speeds_sent': controller.scheduler.sent,
+            'speeds_coalesced': controller.scheduler.coalesced,
+            'speeds_dropped': controller.scheduler.dropped,
+            'momentum_steps': controller.momentum.emits,
+            'led_messages': controller.surface.led_messages,
+            'fader_events_suppressed': controller.surface.slider_filter.suppressed if controller.surface.slider_filter else 0,
+        }) for (key, controller) in controllers.items()),
+    }
+    if stats.enabled:
+        c['latency'] = stats.snapshot()
+    return c
+
+# Status API commands - the same things the buttons do
+def command_acquire(key, channel):
+    controller = controllers[key]
+    if controller.train[channel] == None and controller.dcc_address_list[channel] != None:
+        controller.acquire(channel)
+
+def command_release(key, channel):
+    controller = controllers[key]
+    if controller.train[channel] != None:
+        controller.release(channel, controller.dcc_address_list[channel])
+
+def command_stop(key, channel):
+    controller = controllers[key]
+    if controller.train[channel] != None and controller.dcc_address_list[channel] != None:
+        controller.stop(channel)
+
+def command_stop_all():
+    for controller in controllers.values():
+        controller.stop_all()
+
+def command_power(on):
+    set_power(bool(on))
+
+def command_record(key):
+    controllers[key].toggle_recording()
+
+def command_play(key):
+    controllers[key].toggle_playback()
+
+COMMANDS = {
+    'acquire': command_acquire,
+    'release': command_release,
+    'stop': command_stop,
+    'stop_all': command_stop_all,
+    'power': command_power,
+    'record': command_record,
+    'play': command_play,
+}
+
+# Set the direction of a loco
+def set_direction(id, key, reverse):
+    if reverse:
+        throttle.set_reverse(id, key)
+    else:
+        throttle.set_forward(id, key)
+
+# Throttle key for a consist that's being acquired, or None if they're all in use
+def consist_key():
+    global next_consist_key
+    for i in range(len(CONSIST_KEYS)):
+        key = CONSIST_KEYS[(next_consist_key + i) % len(CONSIST_KEYS)]
+        if key not in consist_owners:
+            # Go round all the keys before reusing one, so late replies for a released consist are ignored
+            next_consist_key = (next_consist_key + i + 1) % len(CONSIST_KEYS)
+            return key
+    return None
+
+# Turn track power on or off. Power goes out ahead of anything else waiting,
+# and turning it off drops speeds that haven't been sent yet.
+def set_power(on):
+    if not on:
+        for controller in controllers.values():
+            controller.cancel_speeds()
+    throttle.power(on)
 
 # Called when server indicates power is on
 def power_on_confirmed():
     global power
-    midiControl.set_led(True, midiControl.CYCLE_BUTTON)
+    for controller in controllers.values():
+        controller.surface.set_led(True, midiControl.CYCLE_BUTTON)
     power = True
 
 # Called when server indicates power is off
 def power_off_confirmed():
     global power
-    midiControl.set_led(False, midiControl.CYCLE_BUTTON)
+    for controller in controllers.values():
+        controller.surface.set_led(False, midiControl.CYCLE_BUTTON)
     power = False
 
-# Called periodlically to send new slider positions
-def update_throttles():
-    global throttle, train
-    for i, updated in enumerate(slider_updated):
-        if updated:
-            slider_updated[i] = False
-            log.debug("Slider %d updated to %d" % (i, slider_value[i]))
-            if (train[i] != None):
-                throttle.set_speed(dcc_address_list[i], slider_value[i])
-
-# Called when slider is moved
-def slider_callback(channel, value):
-    global slider_updated, slider_value
-    slider_updated[channel] = True
-    slider_value[channel] = value
-    return
-
-# Called when a button is pressed
-def button_callback(b, is_on):
-
-    global locked, train, reverse, selected, throttle, power
-
-    channel = b.channel
-    button = b.button
-
-    # Button pressed
-    if (is_on):
-        log.debug("Pressed %d %d" % (channel, button))
-
-        # Lock controls?
-        if (b == midiControl.MARKER_L_BUTTON and midiControl.is_pressed(midiControl.MARKER_R_BUTTON)):
-            locked = not locked
-
-        # Power cycle (works even when buttons are locked)
-        if (b == midiControl.CYCLE_BUTTON):
-            throttle.power(not power)
-
-        # If controls are locked, do nothing
-        if locked:
-            return
+# Called when the server has sent us something
+def process_actions(actionlist):
+    global heartbeat_interval
 
-        # Select throttles to use (M buttons)
-        if button == 3 and channel <= 8 and channel < len(dcc_address_list):
-            if (train[channel] == None):
-                throttle.add_loco(dcc_address_list[channel])
-            else:
-                # Unselect throttle
-                throttle.release_loco(dcc_address_list[channel])
-                # Turn off reverse LED
-                if reverse[channel]:
-                    reverse[channel] = False
-                    midiControl.set_led(False, channel, 4)
-                # Turn off 'selected' LED and unselect
-                if selected == channel:
-                    selected = None
-                    midiControl.set_led(False, channel, 2)
-
-        # Reverse (R buttons)
-        if (button == 4 and channel <= 8 and train[channel] != None):
-            reverse[channel] = not reverse[channel]
-            if reverse[channel]:
-                throttle.set_reverse(dcc_address_list[channel])
-            else:
-                throttle.set_forward(dcc_address_list[channel])
-            midiControl.set_led(reverse[channel], channel, 4)
-
-        # Select train (S butons)
-        if (button == 2 and channel <= 8 and train[channel] != None):
-            if (selected != None):
-                # turn old LED off
-                midiControl.set_led(False, selected, 2)
-            # Toggle off
-            if (selected == channel):
-                selected = None
-            else:
-                selected = channel
-                midiControl.set_led(True, selected, 2)
+    state.update(actionlist)
 
-        # Stop button
-        if (b == midiControl.STOP_BUTTON and selected != None):
-            throttle.stop(dcc_address_list[selected])
+    for item in actionlist:
+        (action, id, key) =  item
 
-	# Stop all (when no trains are selected)
-        if (b == midiControl.STOP_BUTTON and selected == None):
-            for loco in dcc_address_list:
-                throttle.stop(loco)
+        # Throttle lines go to the controller that owns that throttle key
+        if key is not None:
+            controller = controllers.get(key) or consist_owners.get(key)
+            if controller is None:
+                continue
+            if (action == withrottle.ADDED):
+                controller.add_confirmed(id, key)
+            elif (action == withrottle.REMOVED):
+                controller.release_confirmed(id, key)
+            elif (action == withrottle.REVERSE):
+                controller.reverse_confirmed(id, key)
+            elif (action == withrottle.FORWARD):
+                controller.forward_confirmed(id, key)
+            elif (action == withrottle.SPEED):
+                controller.speed_confirmed(id[0], id[1], key)
+            elif (action == withrottle.FUNCTION):
+                controller.function_confirmed(id[0], id[1], id[2], key)
 
-    # Function buttons - only operated if a loco is selected using corresponding S button
+        elif (action == withrottle.ROSTER):
+            roster_received()
+        elif (action == withrottle.POWER_ON):
+            power_on_confirmed()
+        elif (action == withrottle.POWER_OFF):
+            power_off_confirmed()
+        elif (action == withrottle.HEARTBEAT):
+            heartbeat_interval = int(id)
+            log.debug("Got heartbeat interval of %d" % (heartbeat_interval))
+            log.info("Received response from withrottle server")
+            for controller in controllers.values():
+                controller.surface.animate(4)
+            loop.call_later(1, clear_animation)
 
-    if (selected != None):
+# Look up roster names again now the server has sent its roster
+def roster_received():
+    global roster
+    roster = dict((name, loco.address) for (name, loco) in state.roster.items())
+    if roster_cache:
+        roster_cache.update(roster)
+    for controller in controllers.values():
+        for name in controller.config.roster_names:
+            if name and name not in roster:
+                log.warning("%s is not in the server's roster" % name)
+        controller.apply_config(controller.config)
 
-        # The 'track left' and 'track right' buttons act as different shift keys
-        if midiControl.is_pressed(midiControl.TRACK_L_BUTTON):
-            function_bank = function_list[selected].get('lshift')
-        elif midiControl.is_pressed(midiControl.TRACK_R_BUTTON):
-            function_bank = function_list[selected].get('rshift')
+# Turn off the start-up LEDs once the server has responded
+def clear_animation():
+    for controller in controllers.values():
+        for i in range(3):
+            controller.surface.animate(i+2, False)
+        controller.repaint()
+
+# Wrap a callback so that it runs on the event loop rather than the rtmidi thread
+def on_loop(callback):
+    if stats.enabled:
+        def timed_wrapper(*args):
+            loop.call_soon_threadsafe(bridged, time.perf_counter(), callback, args)
+        return timed_wrapper
+    def wrapper(*args):
+        loop.call_soon_threadsafe(callback, *args)
+    return wrapper
+
+# Run a callback from the rtmidi thread, recording how long it took to get here
+def bridged(start, callback, args):
+    stats.record('bridge', time.perf_counter() - start)
+    callback(*args)
+
+# midiControl.handler, timed (only used when stats are enabled)
+def timed_handler(msg, surface):
+    start = time.perf_counter()
+    midiControl.handler(msg, surface)
+    stats.record('handler', time.perf_counter() - start)
+    stats.record('midi_delta', msg[1])
+
+# Called by the event loop when the withrottle socket is readable
+def input_ready():
+    if stats.enabled:
+        start = time.perf_counter()
+        process_actions(throttle.process_input())
+        stats.record('process_input', time.perf_counter() - start)
+    else:
+        process_actions(throttle.process_input())
+    if throttle.closed:
+        connection_lost()
+
+# Send everything written during this loop iteration in one go
+def flush_output():
+    if reconnect_task is not None:
+        # Nowhere to send it - the buffer is cleared on reconnect
+        return
+    if stats.enabled:
+        start = time.perf_counter()
+        done = throttle.flush()
+        end = time.perf_counter()
+        stats.record('flush', end - start)
+        if done:
+            stats.flushed(end)
+    else:
+        done = throttle.flush()
+    if done:
+        loop.remove_writer(throttle.s)
+    elif throttle.closed:
+        connection_lost()
+    else:
+        # Socket buffer is full - carry on when there is room
+        loop.add_writer(throttle.s, flush_output)
+
+# Stop using the socket and start trying to reconnect
+def connection_lost():
+    global reconnect_task
+    if reconnect_task is not None:
+        return
+    log.error("Connection to withrottle server lost, reconnecting")
+    loop.remove_reader(throttle.s)
+    loop.remove_writer(throttle.s)
+    reconnect_task = loop.create_task(reconnect())
+
+# Open a socket to the server after delay seconds, trying again with
+# exponential backoff until it can be reached
+async def open_connection(delay):
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            return await loop.run_in_executor(None, throttle.open_socket)
+        except OSError as e:
+            delay = min(max(delay * 2, RECONNECT_MIN), RECONNECT_MAX)
+            log.warning("Unable to connect to %s %d (%s), trying again in %.1f seconds" % (throttle.host, throttle.port, e, delay))
+
+# Reconnect with exponential backoff, then re-acquire our locos in one burst
+async def reconnect():
+    global reconnect_task
+    s = await open_connection(RECONNECT_MIN)
+    throttle.attach(s)
+    reconnect_task = None
+    state.reset()
+    if stats.enabled:
+        # Whatever was waiting to be sent has been thrown away
+        del stats.unflushed[:]
+    loop.add_reader(throttle.s, input_ready)
+    log.info("Reconnected to withrottle server")
+
+    throttle.set_name(throttle.name)
+    for controller in controllers.values():
+        controller.resync()
+
+# Keep the connection alive, at twice the rate the server asks for
+async def send_heartbeats():
+    while True:
+        await asyncio.sleep(heartbeat_interval / 2)
+        throttle.send_heartbeat()
+
+# Main loop - everything happens in response to MIDI, socket or timer events.
+# surfaces is a list of (midi port, controller) pairs sharing one connection.
+# start opens a surface (midirecord.virtual_start runs without hardware).
+# If record is given, MIDI events from the first surface are saved to it.
+# Roster names are looked up in roster_file until the server sends its roster.
+# The status API is served on status_port if given.
+# fader_filter is a dict of faderfilter.FaderFilter settings, or None for no filtering.
+# With workers, each surface's MIDI is handled in a process of its own, opened
+# by midiworker.start (or start, if given).
+# MIDI events and server traffic are recorded in event_journal (a
+# journal.Journal) if given. MIDI handled by workers isn't.
+async def run(surfaces, host, port, update_interval, nodelay, stats_port=None, start=midiControl.start, record=None, roster_file=None,
+              status_port=None, fader_filter=None, workers=False, event_journal=None):
+    global loop, throttle, reconnect_task, roster, roster_cache, status_server, heartbeat_interval
+
+    loop = asyncio.get_running_loop()
+
+    # Addresses for roster names from last time, so locos can be acquired straight away
+    roster = {}
+    if roster_file and any(any(controller.config.roster_names) for (midiport, controller) in surfaces):
+        roster_cache = config.RosterCache(roster_file, "%s:%d" % (host, port))
+        roster = roster_cache.addresses()
+        log.debug("Loaded %d roster entries from %s" % (len(roster), roster_file))
+    for (midiport, controller) in surfaces:
+        controller.momentum = Momentum(loop, controller.momentum_step)
+        controller.apply_config(controller.config)
+
+    # Connect to midi controllers and set up callback functions
+    if workers and start is midiControl.start:
+        start = midiworker.start
+    handlers = []
+    for (i, (midiport, controller)) in enumerate(surfaces):
+        if workers:
+            # Events arrive on the event loop, and are filtered in the worker
+            controller.surface = start(midiport, controller.button_callback, controller.slider_callback, controller.profile, fader_filter)
         else:
-            function_bank = function_list[selected].get('normal')
+            controller.surface = start(midiport, on_loop(controller.button_callback), on_loop(controller.slider_callback), controller.profile)
+            if fader_filter is not None:
+                controller.surface.slider_filter = faderfilter.FaderFilter(**fader_filter)
+            handler = timed_handler if stats.enabled else midiControl.handler
+            if event_journal:
+                handler = journal.midi_handler(event_journal, i, handler)
+            if handler is not midiControl.handler:
+                controller.surface.midiin.set_callback(handler, controller.surface)
+            handlers.append(handler)
+        controller.surface.use_loop(loop)
+        controller.surface.animate(2)
+        controllers[controller.key] = controller
+    log.info("Connected %d MIDI controller(s)" % len(controllers))
 
-        if (function_bank):
-            log.debug("Function bank is %s" % function_bank)
+    recorder = None
+    if record and not workers:
+        recorder = midirecord.Recorder(surfaces[0][1].surface, handlers[0])
 
-            # function mapped to this button
-            function = None
-            # is pressed button a function button?
-            is_f_button = False
+    throttle = withrottle(host, port, nodelay, connect=False)
+    throttle.journal = event_journal
+    throttle.on_pending = lambda: loop.call_soon(flush_output)
+    for controller in controllers.values():
+        controller.scheduler = SpeedScheduler(loop, controller.send_speed, update_interval, withrottle.MAX_SPEED, controller.speed_dropped)
+        if controller.config_file:
+            controller.watcher = config.ConfigWatcher(loop, controller.config_file, controller.apply_config)
 
-            # Map button to function
-            if (b == midiControl.REC_BUTTON):
-                is_f_button = True
-                log.debug("REC button pressed")
-                function = function_bank.get('rec')
-            elif (b == midiControl.PLAY_BUTTON):
-                is_f_button = True
-                log.debug("PLAY button pressed")
-                function = function_bank.get('play')
-            elif (b == midiControl.FF_BUTTON):
-                is_f_button = True
-                log.debug("FF button pressed")
-                function = function_bank.get('ff')
-            elif (b == midiControl.RW_BUTTON):
-                is_f_button = True
-                log.debug("RW button pressed")
-                function = function_bank.get('rw')
-
-            if is_f_button:
-                if (function is not None):
-                    throttle.send_function(dcc_address_list[selected], function, is_on)
-                else:
-                    log.debug("No function button mapped")
+    tasks = []
+    stats_server = None
+    try:
+        # Connect to withrottle server, waiting for it as reconnect() does.
+        # Until then anything written is held back (see flush_output).
+        reconnect_task = loop.create_task(open_connection(0))
+        throttle.attach(await reconnect_task)
+        reconnect_task = None
+        for controller in controllers.values():
+            controller.surface.animate(3)
+        log.info("Connected to withrottle server")
+        throttle.set_name("Korg" + "+".join(str(midiport) for (midiport, controller) in surfaces))
+
+        loop.add_reader(throttle.s, input_ready)
+        tasks.append(loop.create_task(send_heartbeats()))
+
+        # Latency stats are dumped on SIGUSR1, and served on stats_port if given
+        if stats.enabled:
+            loop.add_signal_handler(signal.SIGUSR1, stats.dump)
+            if stats_port:
+                stats_server = await asyncio.start_server(stats.serve_client, "127.0.0.1", stats_port)
+                log.info("Serving latency stats on port %d" % stats_port)
+
+        if status_port is not None:
+            status_server = statusapi.StatusServer(loop, status, counters, COMMANDS)
+            status_port = await status_server.start("127.0.0.1", status_port)
+            log.info("Serving status API on port %d" % status_port)
+
+        # Run until interrupted
+        await loop.create_future()
+    finally:
+        if throttle.s is not None:
+            loop.remove_reader(throttle.s)
+        for task in tasks:
+            task.cancel()
+        for controller in controllers.values():
+            if controller.watcher:
+                controller.watcher.stop()
+            controller.momentum.stop()
+            if controller.player:
+                controller.player.stop()
+        if stats_server:
+            stats_server.close()
+        if status_server:
+            status_server.stop()
+            status_server = None
+        if reconnect_task:
+            reconnect_task.cancel()
+            reconnect_task = None
+        if recorder:
+            recorder.save(record)
+            log.info("Saved %d MIDI events to %s" % (len(recorder.events), record))
+        controllers.clear()
+        consist_owners.clear()
+        state.reset()
+        roster_cache = None
+        # The next server tells us its own
+        heartbeat_interval = HEARTBEAT_INTERVAL
 
 #main function
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-m", "--midiport", help="Midi port that surface is connected to", type=int)
-    parser.add_argument("-c", "--config", help="Config file to use for this controller. Default: config.json")
+    parser.add_argument("-m", "--midiport", help="Midi port that surface is connected to. Repeat for more surfaces", type=int, action="append")
+    parser.add_argument("-c", "--config", help="Config file to use for this controller, one per midi port. Default: config.json", action="append")
+    parser.add_argument("-p", "--profile", help="Surface profile: %s or a JSON profile file. Give one for all midi ports, or one per port. Default: nanokontrol2" %
+        ", ".join(profiles.BUILT_IN), action="append")
     parser.add_argument("--hostname", help="Hostname of withrottle server. Default: localhost")
     parser.add_argument("--port", help="Port number of withrottle server. Default: 12090", type=int)
+    parser.add_argument("--update-interval", help="Minimum seconds between speed updates for each loco. Default: %s" % UPDATE_INTERVAL, type=float, default=UPDATE_INTERVAL)
+    parser.add_argument("--nagle", help="Use Nagle's algorithm on the withrottle connection", action="store_true")
+    parser.add_argument("--stats", help="Record latency stats (dumped to stderr on SIGUSR1)", action="store_true")
+    parser.add_argument("--stats-port", help="Serve latency stats as JSON on this local port (implies --stats)", type=int)
+    parser.add_argument("--deadband", help="Fader steps a slider must turn back by before it counts (0 for none). Default: 1", type=int, default=1)
+    parser.add_argument("--smoothing", help="Smooth fader values. Default: none", choices=faderfilter.SMOOTHING, default=faderfilter.NONE)
+    parser.add_argument("--smoothing-alpha", help="Weight of the newest value for exponential smoothing. Default: 0.5", type=float, default=0.5)
+    parser.add_argument("--snap-to-zero", help="Fader values up to this count as 0. Default: 0", type=int, default=0)
+    parser.add_argument("--status-port", help="Serve live state and take commands over HTTP and WebSocket on this local port", type=int)
+    parser.add_argument("--roster-cache", help="File to keep roster name lookups in between runs. Default: ~/.midi-throttle-roster.json", default=os.path.join("~", ".midi-throttle-roster.json"))
+    parser.add_argument("--macro-dir", help="Directory to keep macros in (SET + REC records, SET + PLAY plays). Default: current directory", default=".")
+    parser.add_argument("--macro-repeat", help="Play macros over and over until stopped", action="store_true")
+    parser.add_argument("--record-midi", help="Save MIDI events from the (first) surface to this file, for replaying later")
+    parser.add_argument("--journal", help="File to keep a journal of MIDI events and server traffic in (read it with journal.py). Default: %s" % journal.DEFAULT_FILE, default=journal.DEFAULT_FILE)
+    parser.add_argument("--journal-size", help="Size of the journal in MB, after which the oldest entries are overwritten. Default: %d" % journal.DEFAULT_SIZE, type=int, default=journal.DEFAULT_SIZE)
+    parser.add_argument("--no-journal", help="Don't keep a journal", action="store_true")
+    parser.add_argument("--workers", help="Handle each surface's MIDI in a process of its own (needs -m for every surface)", action="store_true")
     parser.add_argument("-v", "--verbose", help="Enable verbose output", action="store_true")
     parser.add_argument("-d", "--debug", help="Enable debugging output", action="store_true")
 
@@ -222,13 +1053,40 @@ if __name__ == "__main__":
     # Prompts user for MIDI input and output port, unless a valid port number
     # is given as an argument on the command line.
     # API backend defaults to ALSA on Linux.
-    midiport = args.midiport
+    if args.midiport:
+        midiports = args.midiport
+    else:
+        midiports = [None]
 
-    # JSON config file
+    # JSON config files
     if args.config:
-        config_file = args.config
+        config_files = args.config
     else:
-        config_file = "config.json" 
+        config_files = ["config.json"]
+
+    if len(config_files) != len(midiports):
+        parser.error("Give one config file for each midi port")
+
+    # Surface profiles
+    profile_names = args.profile or ["nanokontrol2"]
+    if len(profile_names) == 1:
+        profile_names = profile_names * len(midiports)
+    if len(profile_names) != len(midiports):
+        parser.error("Give one profile for all midi ports, or one for each")
+    surface_profiles = {}
+    for name in set(profile_names):
+        try:
+            surface_profiles[name] = profiles.load(name)
+        except (OSError, ValueError) as e:
+            parser.error("%s: %s" % (name, e))
+    if len(midiports) > len(THROTTLE_KEYS):
+        parser.error("At most %d surfaces can share a connection" % len(THROTTLE_KEYS))
+
+    if args.workers:
+        if not args.midiport:
+            parser.error("--workers needs a midi port (-m) for each surface")
+        if args.record_midi:
+            parser.error("--record-midi can't be used with --workers")
 
     # Hostname of withrottle server, default localhost
     if args.hostname:
@@ -249,81 +1107,48 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    # read config file and import
+    # read config files and import
     dirname = os.path.dirname(__file__)
-    config_file = os.path.join(dirname, config_file)
 
-    with open(config_file, 'r') as f:
-        config = json.load(f)
+    surfaces = []
+    for (i, midiport) in enumerate(midiports):
+        config_file = os.path.join(dirname, config_files[i])
+        try:
+            surface_config = config.load(config_file)
+        except (OSError, ValueError) as e:
+            parser.error("%s: %s" % (config_file, e))
+        surfaces.append((midiport, Controller(THROTTLE_KEYS[i], config_file, surface_config, surface_profiles[profile_names[i]])))
 
-    # List of DCC addresses, corresponding to sliders 0-7
-    dcc_address_list = []
-    # List of function button mappings, corresponding to sliders 0-7
-    function_list = []
+    if args.stats or args.stats_port:
+        stats.enable()
 
-    for entry in config:
-        if 'dcc_address' in entry:
-            dcc_address_list.append(entry['dcc_address'])
-            log.debug("Adding DCC address %s" % entry['dcc_address']) 
-        else:
-            log.warn("Missing DCC address in config")
-        if 'functions' in entry:
-            function_list.append(entry['functions'])
-            log.debug("Adding function key mapping")
-        else:
-            function_list.append(None)
-
-    # Connect to midi controller and set up callback functions
-    midiControl.start(midiport, button_callback, slider_callback)
-    midiControl.animate(2)
-    log.info("Connected MIDI controller")
-
-    # Connect to withrottle server
-    throttle = withrottle(host, port)
-    midiControl.animate(3)
-    log.info("Connected to withrottle server")
-    throttle.set_name("Korg"+str(midiport))
-
-    heartbeat_interval = 1
-    start = time.time()
-    # Main loop
-    try:
-        while True:
-
-            actionlist = throttle.process_input()
-
-            for item in actionlist:
-                (action, id) =  item
-
-                if (action == withrottle.ADDED):
-                    add_confirmed(id)
-                elif (action == withrottle.REMOVED):
-                    release_confirmed(id)
-                elif (action == withrottle.REVERSE):
-                    reverse_confirmed(id)
-                elif (action == withrottle.FORWARD):
-                    forward_confirmed(id)
-                elif (action == withrottle.POWER_ON):
-                    power_on_confirmed()
-                elif (action == withrottle.POWER_OFF):
-                    power_off_confirmed()
-                elif (action == withrottle.HEARTBEAT):
-                    heartbeat_interval = int(id)
-                    log.debug("Got heartbeat interval of %d" % (heartbeat_interval))
-                    log.info("Received response from withrottle server")
-                    midiControl.animate(4)
-                    sleep(1)
-                    for i in range(3):
-                        midiControl.animate(i+2, False)
-
-            # Send throttle positions to server
-            update_throttles()
-
-            sleep(UPDATE_INTERVAL)
-            if time.time() - start > (heartbeat_interval / 2):
-                throttle.send_heartbeat()
-                start = time.time()
+    fader_filter = None
+    if args.deadband or args.smoothing != faderfilter.NONE or args.snap_to_zero:
+        fader_filter = {'deadband': args.deadband, 'smoothing': args.smoothing, 'alpha': args.smoothing_alpha, 'snap_to_zero': args.snap_to_zero}
+        try:
+            faderfilter.FaderFilter(**fader_filter)
+        except ValueError as e:
+            parser.error(str(e))
 
-    except KeyboardInterrupt:
-        midiControl.cleanup()
+    if args.journal_size < 1:
+        parser.error("--journal-size must be at least 1")
+    event_journal = None
+    if not args.no_journal:
+        # Better to run without a journal than not at all
+        try:
+            event_journal = journal.Journal(os.path.expanduser(args.journal), args.journal_size)
+        except OSError as e:
+            log.warning("Unable to open journal %s: %s" % (args.journal, e))
+
+    macro_dir = args.macro_dir
+    macro_repeat = args.macro_repeat
 
+    try:
+        asyncio.run(run(surfaces, host, port, args.update_interval, not args.nagle, args.stats_port,
+            record=args.record_midi, roster_file=os.path.expanduser(args.roster_cache), status_port=args.status_port,
+            fader_filter=fader_filter, workers=args.workers, event_journal=event_journal))
+    except KeyboardInterrupt:
+        pass
+    midiControl.cleanup()
+    if event_journal:
+        event_journal.close()
@@ -1,8 +1,29 @@
-import socket, select, string, sys, re, logging
+import socket, select, string, sys, logging
 from time import sleep
 
 log = logging.getLogger("withrottle-logger")
 
+# Throttle key used when only one throttle shares the connection ("MT...")
+DEFAULT_KEY = 'T'
+
+# Give up on a connection attempt after this long (in seconds)
+CONNECT_TIMEOUT = 5
+
+# TCP keepalive: idle seconds before probing, seconds between probes, probes before giving up
+KEEPALIVE = [('TCP_KEEPIDLE', 5), ('TCP_KEEPINTVL', 2), ('TCP_KEEPCNT', 3)]
+
+# Loco commands are a prefix for the loco (b"MTAS11<;>", kept from when it
+# was acquired) and one of these suffixes, so sending one builds nothing
+SPEED_SUFFIXES = tuple(b"V%d\n" % speed for speed in range(127))
+# By the digit after F, then function number
+FUNCTION_SUFFIXES = tuple(tuple(b"F%d%d\n" % (x, fn) for fn in range(29)) for x in (0, 1))
+# Setting a function outright, by state (0 off, 1 on), then function number
+FORCE_SUFFIXES = tuple(tuple(b"f%d%d\n" % (x, fn) for fn in range(29)) for x in (0, 1))
+FORWARD = b"R1\n"
+REVERSE = b"R0\n"
+STOP = b"X\n"
+NEWLINE = b"\n"
+
 class withrottle:
 
     ADDED = 1
@@ -13,148 +34,450 @@ class withrottle:
     REVERSE = 6
     POWER_ON = 7
     POWER_OFF = 8
+    FUNCTION = 9
+    SPEED = 10
+    ROSTER = 11
+    TURNOUT = 12
+    CONSIST = 13
+    FAST_CLOCK = 14
+
+    # Highest speed step that can be sent
+    MAX_SPEED = 126
+
+    # Connects straight away unless connect is False, in which case the
+    # caller connects with attach(open_socket())
+    def __init__(self, host, port, nodelay=True, connect=True):
+        self.host = host
+        self.port = port
+        self.nodelay = nodelay
+        self.s = None
+        self.name = None
+
+        # Messages waiting to be sent. If on_pending is set it is called when
+        # the buffer stops being empty, and the caller must call flush();
+        # otherwise every write is flushed straight away.
+        self.outgoing = bytearray()
+        self.on_pending = None
+        # Urgent messages (stops and power) jump the queue at the next flush
+        self.urgent = bytearray()
+        # Length of the rest of a line that has been partly sent - it has to go first
+        self.in_flight = 0
+        # Protocol version the server reported, e.g. (2, 0)
+        self.version = None
+        # Command prefix for each loco, by throttle key then id
+        self.prefixes = {}
+        # If set, every command queued and line received is recorded in it (see journal.py)
+        self.journal = None
 
-    def __init__(self, host, port):
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Counters
+        self.bytes_sent = 0
+        self.send_calls = 0
+        self.flushes = 0
+        self.cancelled = 0
 
         # connect to remote host
+        if not connect:
+            return
         try :
-            self.s.connect((host, port))
-        except :
-            log.error('Unable to connect to %s %d' % (host, port))
+            self.attach(self.open_socket())
+        except OSError:
+            log.error('Unable to connect to %s %d', host, port)
             sys.exit()
 
-        self.s.setblocking(0)
-        log.debug("Connected")
+    # Connect a new socket to the server. Blocks, so can be run in another
+    # thread. Raises OSError if the server can't be reached.
+    def open_socket(self):
+        s = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+        s.setblocking(0)
+        # Messages are batched by flush(), so Nagle's algorithm only adds delay
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+        # Notice a dead link (e.g. Wi-Fi dropped) in seconds rather than hours
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for (option, value) in KEEPALIVE:
+            if hasattr(socket, option):
+                s.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        return s
 
+    # Start using a newly connected socket, dropping anything left from the old one
+    def attach(self, s):
+        if self.s is not None:
+            self.s.close()
+        self.s = s
+        self.closed = False
+        # Incomplete line left over from the last read
+        self.partial = b''
+        del self.outgoing[:]
+        del self.urgent[:]
+        self.in_flight = 0
+        self.version = None
+        log.debug("Connected")
 
-    # Read latest input from withrottle server
+    # Read everything waiting on the socket
     def read(self):
-        try:
-            data = self.s.recv(4096)
-            return data.decode()
-        except:
-            return ''
+        chunks = []
+        while True:
+            try:
+                data = self.s.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                log.debug("Read failed: %s", e)
+                self.closed = True
+                break
+            if not data:
+                # Server has closed the connection
+                self.closed = True
+                break
+            chunks.append(data)
+        return b''.join(chunks)
+
+    # Stop using a journal that has failed - talking to the server matters more
+    def journal_failed(self, e):
+        log.error("Journal failed, no longer recording: %s", e)
+        self.journal = None
+
+    # Queue message (a str, without the newline) for withrottle server.
+    # Urgent messages go ahead of anything else waiting to be sent.
+    def write(self, message, urgent=False):
+        self.write_bytes(message.encode(), NEWLINE, urgent)
+
+    # Queue a command made of two pieces of bytes, the second ending in a newline
+    def write_bytes(self, prefix, suffix, urgent=False):
+        log.debug("Sending %s%s", prefix, suffix)
+        if self.journal:
+            try:
+                self.journal.sent(prefix, suffix, urgent)
+            except Exception as e:
+                self.journal_failed(e)
+        was_empty = not self.outgoing and not self.urgent
+        buffer = self.urgent if urgent else self.outgoing
+        buffer += prefix
+        buffer += suffix
+        if self.on_pending is None:
+            self.flush()
+        elif was_empty:
+            self.on_pending()
 
-    # Send message to withrottle server
-    def write(self, message):
-        message = message + '\n'
-        log.debug("Sending %s" % (message))
-        self.s.send(message.encode())
+    # Send as much queued output as the socket will take.
+    # Returns True when everything has been sent.
+    def flush(self):
+        if self.urgent:
+            self.outgoing[self.in_flight:self.in_flight] = self.urgent
+            del self.urgent[:]
+        if not self.outgoing:
+            return True
+        sent = 0
+        calls = 0
+        last = ord('\n')
+        while self.outgoing:
+            try:
+                n = self.s.send(self.outgoing)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                log.debug("Write failed: %s", e)
+                self.closed = True
+                break
+            calls += 1
+            sent += n
+            if n:
+                last = self.outgoing[n - 1]
+            del self.outgoing[:n]
+        # If nothing went, whatever was partly sent before still is
+        if sent:
+            if self.outgoing and last != ord('\n'):
+                self.in_flight = self.outgoing.find(b'\n') + 1
+            else:
+                self.in_flight = 0
+        self.bytes_sent += sent
+        self.send_calls += calls
+        self.flushes += 1
+        log.debug("Flushed %d bytes in %d send calls, %d bytes left", sent, calls, len(self.outgoing))
+        return not self.outgoing
+
+    # Drop speed commands that haven't started going out yet: for one loco,
+    # for every loco on a throttle key if id is None, or for every key if key
+    # is None. Returns how many were dropped.
+    def cancel_speeds(self, key=None, id=None):
+        start = self.in_flight
+        if b'<;>V' not in self.outgoing[start:]:
+            return 0
+        kept = []
+        dropped = 0
+        for line in bytes(self.outgoing[start:]).split(b'\n')[:-1]:
+            end = line.find(b'<;>V')
+            if (end > 3 and line[2:3] == b'A'
+                    and (key is None or line[1:2] == key.encode())
+                    and (id is None or line[3:end] == id.encode())):
+                dropped += 1
+                if self.journal:
+                    try:
+                        self.journal.cancelled(line)
+                    except Exception as e:
+                        self.journal_failed(e)
+            else:
+                kept.append(line + b'\n')
+        self.outgoing[start:] = b''.join(kept)
+        self.cancelled += dropped
+        return dropped
+
+    # Can one command be sent to every loco on a throttle key ('*')?
+    def supports_wildcard(self):
+        return self.version is not None and self.version >= (2, 0)
 
     # Set name of throttle
     def set_name(self, name):
+        self.name = name
         message = "N%s" % (name)
         self.write(message)
 
     # Send a stay-alive heartbeat
     def send_heartbeat(self):
-        message = "*"
-        self.write(message)
+        self.write_bytes(b"*", NEWLINE)
+
+    # Commands for a loco take its address as id. For speed, direction, stop
+    # and release, an id of '*' means every loco on that throttle key.
+
+    # Action prefix for a loco, e.g. b"MTAS11<;>", built the first time it's needed
+    def prefix(self, id, key=DEFAULT_KEY):
+        try:
+            return self.prefixes[key][id]
+        except KeyError:
+            prefix = ("M%sA%s<;>" % (key, id)).encode()
+            self.prefixes.setdefault(key, {})[id] = prefix
+            return prefix
 
     # Add a loco to this controller
-    def add_loco(self, id):
-        message = "MT+%s<;>%s" % (id,id)
+    def add_loco(self, id, key=DEFAULT_KEY):
+        self.prefix(id, key)
+        message = "M%s+%s<;>%s" % (key,id,id)
         self.write(message)
 
     # Release a loco from this controller
-    def release_loco(self, id):
-        message = "MT-%s<;>r" % (id)
+    def release_loco(self, id, key=DEFAULT_KEY):
+        self.prefixes.get(key, {}).pop(id, None)
+        message = "M%s-%s<;>r" % (key,id)
         self.write(message)
 
     # Set forward direction
-    def set_forward(self, id):
-        message = "MTA%s<;>R1" % (id)
-        self.write(message)
+    def set_forward(self, id, key=DEFAULT_KEY):
+        self.write_bytes(self.prefix(id, key), FORWARD)
 
     # Set reverse direction
-    def set_reverse(self, id):
-        message = "MTA%s<;>R0" % (id)   
-        self.write(message)
+    def set_reverse(self, id, key=DEFAULT_KEY):
+        self.write_bytes(self.prefix(id, key), REVERSE)
 
     # Set speed of loco
-    def set_speed(self, id, speed):
-        if (speed > 126):
-            speed = 126
-        message = "MTA%s<;>V%d" % (id, speed)
-        self.write(message)
+    def set_speed(self, id, speed, key=DEFAULT_KEY):
+        if (speed > self.MAX_SPEED):
+            speed = self.MAX_SPEED
+        self.write_bytes(self.prefix(id, key), SPEED_SUFFIXES[speed] if speed >= 0 else b"V%d\n" % speed)
 
-    # Emergency stop loco
-    def stop(self, id):
-        message = "MTA%s<;>X" % (id)
-        self.write(message)
+    # Emergency stop loco - goes ahead of, and cancels, speeds waiting to be sent
+    def stop(self, id, key=DEFAULT_KEY):
+        self.cancel_speeds(key, None if id == '*' else id)
+        self.write_bytes(self.prefix(id, key), STOP, True)
 
-    # Track power 
+    # Track power - goes ahead of anything waiting. Turning it off cancels
+    # speeds waiting to be sent.
     def power(self, status):
         if (status):
-            message = "PPA1" 
+            message = b"PPA1"
         else:
-            message = "PPA0"
-        self.write(message)
+            self.cancel_speeds()
+            message = b"PPA0"
+        self.write_bytes(message, NEWLINE, True)
 
     # Send dcc decoder function (lights etc.)
-    def send_function(self, id, fn, is_pressed):
+    def send_function(self, id, fn, is_pressed, key=DEFAULT_KEY):
         if (is_pressed):
             x = 0
         else:
             x = 1
-        message = "MTA%s<;>F%d%s" % (id, x, fn)
-        self.write(message)
+        suffixes = FUNCTION_SUFFIXES[x]
+        if 0 <= fn < len(suffixes):
+            suffix = suffixes[fn]
+        else:
+            suffix = b"F%d%d\n" % (x, fn)
+        self.write_bytes(self.prefix(id, key), suffix)
+
+    # Turn a function on or off, whatever it was before (for latching
+    # functions, which would otherwise take a press and a release)
+    def force_function(self, id, fn, on, key=DEFAULT_KEY):
+        x = 1 if on else 0
+        suffixes = FORCE_SUFFIXES[x]
+        if 0 <= fn < len(suffixes):
+            suffix = suffixes[fn]
+        else:
+            suffix = b"f%d%d\n" % (x, fn)
+        self.write_bytes(self.prefix(id, key), suffix)
 
+    # Read from the server and return a list of (action, id, key) tuples.
+    # key is the throttle the line was for, or None if it was not a throttle line.
     def process_input(self):
-        message = self.read()
-        if message != '':
-            log.debug(message)
-        lines = message.split('\n')
+        return self.feed(self.read())
+
+    # Split incoming data into lines, keeping any incomplete line for next time
+    def feed(self, data):
         r = []
+        if not data:
+            return r
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        journal = self.journal
         for line in lines:
+            line = line.rstrip(b'\r')
+            if journal and line:
+                try:
+                    journal.received(line)
+                except Exception as e:
+                    self.journal_failed(e)
+                    journal = None
+            line = line.decode(errors='replace')
+            if line:
+                log.debug(line)
+                parse = self._parsers.get(line[0])
+                if parse:
+                    parse(self, line, r)
+        return r
 
-            # Added loco to controller
-            m = re.match("MT\+(.*?)\<;\>", line)
-            if m:
-                log.debug("Added %s successfully" % (m.group(1)))
-                r.append((self.ADDED, m.group(1)))
-
-            # Removed loco from controller
-            m = re.match("MT\-(.*?)\<;\>", line)
-            if m:
-                log.debug("Removed %s successfully" % (m.group(1)))
-                r.append((self.REMOVED, m.group(1)))
-
-            # Loco is set to reverse direction
-            m = re.match("MTA(.*?)\<;\>R0", line)
-            if m:
-                log.debug("Loco %s set to reverse" % (m.group(1)))
-                r.append((self.REVERSE, m.group(1)))
-
-            # Loco is set to forward direction
-            m = re.match("MTA(.*?)\<;\>R1", line)
-            if m:
-                log.debug("Loco %s set to forward" % (m.group(1)))
-                r.append((self.FORWARD, m.group(1)))
-
-            # Controller is connected to server
-            m = re.match("PW(.*)", line)
-            if m:
-                log.debug("Connected successfully to port %s" % (m.group(1)))
-                r.append((self.CONNECTED, m.group(1)))
-
-            # Track power is off
-            m = re.match("PPA0", line)
-            if m:
-                log.debug("Power off")
-                r.append((self.POWER_OFF, 1))
-
-            # Track power is on
-            m = re.match("PPA1", line)
-            if m:
-                log.debug("Power on")
-                r.append((self.POWER_ON, 0))
-
-            # Heartbeat interval
-            m = re.match("\*(\d*)", line)
-            if m:
-                log.debug("Heartbeat required every %s seconds" % (m.group(1)))
-                r.append((self.HEARTBEAT, m.group(1)))
+    # Throttle lines: M<key>+, M<key>-, M<key>A
+    def _parse_throttle(self, line, r):
+        end = line.find('<;>', 3)
+        if end < 0:
+            return
+        key = line[1]
+        id = line[3:end]
+        kind = line[2]
 
-        return r
+        # Added loco to controller
+        if kind == '+':
+            log.debug("Added %s successfully", id)
+            r.append((self.ADDED, id, key))
+
+        # Removed loco from controller
+        elif kind == '-':
+            log.debug("Removed %s successfully", id)
+            r.append((self.REMOVED, id, key))
+
+        elif kind == 'A':
+            value = line[end+3:]
+            if not value:
+                return
+            code = value[0]
+
+            # Loco direction: R0 is reverse, R1 is forward
+            if code == 'R':
+                if value == 'R0':
+                    log.debug("Loco %s set to reverse", id)
+                    r.append((self.REVERSE, id, key))
+                elif value == 'R1':
+                    log.debug("Loco %s set to forward", id)
+                    r.append((self.FORWARD, id, key))
+
+            # Function state, e.g. F112 is function 12 on
+            elif code == 'F' and len(value) > 2:
+                try:
+                    r.append((self.FUNCTION, (id, int(value[2:]), value[1] == '1'), key))
+                except ValueError:
+                    pass
+
+            # Speed echo
+            elif code == 'V':
+                try:
+                    r.append((self.SPEED, (id, int(value[1:])), key))
+                except ValueError:
+                    pass
+
+    # Panel lines: PW, PPA, PTA, PTL, PFT
+    def _parse_panel(self, line, r):
+        kind = line[1:2]
+
+        # Controller is connected to server
+        if kind == 'W':
+            log.debug("Connected successfully to port %s", line[2:])
+            r.append((self.CONNECTED, line[2:], None))
+
+        # Track power
+        elif line == 'PPA0':
+            log.debug("Power off")
+            r.append((self.POWER_OFF, 1, None))
+        elif line == 'PPA1':
+            log.debug("Power on")
+            r.append((self.POWER_ON, 0, None))
+
+        # Turnout state change, e.g. PTA2LT12 (2 is closed, 4 is thrown)
+        elif line.startswith('PTA') and len(line) > 4:
+            r.append((self.TURNOUT, (line[4:], line[3]), None))
+
+        # Turnout list, e.g. PTL]\[LT12}|{Station}|{2]\[...
+        elif line.startswith('PTL'):
+            for entry in line.split(']\\[')[1:]:
+                fields = entry.split('}|{')
+                if len(fields) >= 3:
+                    r.append((self.TURNOUT, (fields[0], fields[2]), None))
+
+        # Fast clock, e.g. PFT1570291200<;>4.0 (seconds since 1970, and rate)
+        elif line.startswith('PFT'):
+            fields = line[3:].split('<;>')
+            try:
+                r.append((self.FAST_CLOCK, (int(fields[0]), float(fields[1]) if len(fields) > 1 else 1.0), None))
+            except ValueError:
+                pass
+
+    # Roster lines: RL (roster list), RCD (consist data)
+    def _parse_roster(self, line, r):
+        kind = line[1:2]
+
+        # Roster list, e.g. RL2]\[Name}|{41}|{S]\[...
+        if kind == 'L':
+            roster = []
+            for entry in line.split(']\\[')[1:]:
+                fields = entry.split('}|{')
+                if len(fields) >= 3:
+                    roster.append((fields[0], fields[2] + fields[1]))
+            r.append((self.ROSTER, roster, None))
+
+        # Consist, e.g. RCD}|{10(S)}|{Coal train]\[41(S)}|{true]\[66(L)}|{false
+        # (true if that loco faces forward)
+        elif line.startswith('RCD'):
+            entries = line.split(']\\[')
+            fields = entries[0].split('}|{')
+            if len(fields) < 2:
+                return
+            members = []
+            for entry in entries[1:]:
+                loco = entry.split('}|{')
+                if len(loco) >= 2:
+                    members.append((self._address(loco[0]), loco[1] == 'true'))
+            name = fields[2] if len(fields) > 2 else ''
+            r.append((self.CONSIST, (self._address(fields[1]), name, members), None))
+
+    # Turn JMRI's "41(S)" into "S41"
+    @staticmethod
+    def _address(text):
+        if text.endswith(')') and len(text) > 3:
+            return text[-2] + text[:-3]
+        return text
+
+    # Heartbeat interval
+    def _parse_heartbeat(self, line, r):
+        log.debug("Heartbeat required every %s seconds", line[1:])
+        r.append((self.HEARTBEAT, line[1:], None))
+
+    # Protocol version, e.g. VN2.0
+    def _parse_version(self, line, r):
+        if line[1:2] == 'N':
+            try:
+                self.version = tuple(int(n) for n in line[2:].split('.'))
+            except ValueError:
+                pass
+            log.debug("Server protocol version %s", line[2:])
+
+    _parsers = {
+        'M': _parse_throttle,
+        'P': _parse_panel,
+        'R': _parse_roster,
+        '*': _parse_heartbeat,
+        'V': _parse_version,
+    }